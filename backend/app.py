@@ -32,6 +32,10 @@ from flask_talisman import Talisman
 from dotenv import load_dotenv
 import os
 from models.property import db
+from services.database import engine_options, init_engine_profiles, upgrade_schema
+from services.query_log import init_query_log
+from services.sharding import get_shard_router, init_sharding
+from services.admission import init_admission
 import logging
 from logging.handlers import RotatingFileHandler
 from flask import redirect
@@ -42,10 +46,69 @@ load_dotenv()
 # Initialize Flask app
 app = Flask(__name__)
 
-# Configure database
+# Configure database. Engine options must be set before init_app creates the engine.
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///realtor.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 db.init_app(app)
+init_engine_profiles(app, db)
+
+# Slow-query log and N+1 detection
+app.config['SLOW_QUERY_MS'] = float(os.getenv('SLOW_QUERY_MS', '200'))
+app.config['N_PLUS_ONE_THRESHOLD'] = int(os.getenv('N_PLUS_ONE_THRESHOLD', '5'))
+init_query_log(app)
+
+# Optional sharding of listings by state, e.g.
+# PROPERTY_SHARDS=west=sqlite:///shard_west.db;east=sqlite:///shard_east.db
+app.config['PROPERTY_SHARDS'] = os.getenv('PROPERTY_SHARDS', '')
+app.config['PROPERTY_SHARD_STATES'] = os.getenv('PROPERTY_SHARD_STATES', '')
+# Threads running shard queries for all requests (0: 16 per shard)
+app.config['PROPERTY_SHARD_WORKERS'] = int(os.getenv('PROPERTY_SHARD_WORKERS', '0'))
+init_sharding(app)
+
+# Configure image storage
+app.config['IMAGE_STORAGE_PATH'] = os.getenv('IMAGE_STORAGE_PATH', 'media/images')
+app.config['IMAGE_MAX_BYTES'] = int(os.getenv('IMAGE_MAX_BYTES', str(15 * 1024 * 1024)))
+app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', '2'))
+
+# Configure virtual-tour asset storage
+app.config['TOUR_ASSET_PATH'] = os.getenv('TOUR_ASSET_PATH', 'media/tours')
+app.config['TOUR_ASSET_MAX_AGE'] = int(os.getenv('TOUR_ASSET_MAX_AGE', '3600'))
+
+# Configure the similar-listings index
+app.config['SIMILARITY_INDEX_PATH'] = os.getenv('SIMILARITY_INDEX_PATH', 'media/similarity')
+app.config['SIMILARITY_MAX_OVERLAY'] = int(os.getenv('SIMILARITY_MAX_OVERLAY', '1000'))
+
+# Optional in-memory column engine for listing searches
+app.config['COLUMN_ENGINE'] = os.getenv('COLUMN_ENGINE', 'False').lower() == 'true'
+app.config['COLUMN_ENGINE_PATH'] = os.getenv('COLUMN_ENGINE_PATH', 'media/columns')
+app.config['COLUMN_ENGINE_MAX_CHANGES'] = int(os.getenv('COLUMN_ENGINE_MAX_CHANGES', '1000'))
+
+# Optional group commit of listing creates and updates
+app.config['GROUP_COMMIT'] = os.getenv('GROUP_COMMIT', 'False').lower() == 'true'
+app.config['GROUP_COMMIT_WINDOW_MS'] = float(os.getenv('GROUP_COMMIT_WINDOW_MS', '2'))
+app.config['GROUP_COMMIT_MAX_BATCH'] = int(os.getenv('GROUP_COMMIT_MAX_BATCH', '64'))
+
+# Configure near-duplicate detection
+app.config['DEDUPE_ON_CREATE'] = os.getenv('DEDUPE_ON_CREATE', 'flag')
+app.config['DEDUPE_THRESHOLD'] = float(os.getenv('DEDUPE_THRESHOLD', '0.7'))
+app.config['DEDUPE_NUM_PERM'] = int(os.getenv('DEDUPE_NUM_PERM', '64'))
+app.config['DEDUPE_BANDS'] = int(os.getenv('DEDUPE_BANDS', '16'))
+app.config['DEDUPE_MAX_OVERLAY'] = int(os.getenv('DEDUPE_MAX_OVERLAY', '1000'))
+# Seconds after which a worker rebuilds its index to see other workers' writes
+app.config['DEDUPE_MAX_AGE'] = int(os.getenv('DEDUPE_MAX_AGE', '3600'))
+
+# Configure autocomplete
+app.config['AUTOCOMPLETE_MAX_ENTRIES'] = int(os.getenv('AUTOCOMPLETE_MAX_ENTRIES', '200000'))
+# Seconds after which a worker rebuilds its index to see other workers' writes
+app.config['AUTOCOMPLETE_MAX_AGE'] = int(os.getenv('AUTOCOMPLETE_MAX_AGE', '3600'))
+
+# Coalesce identical concurrent reads
+app.config['SINGLE_FLIGHT_TIMEOUT_MS'] = int(os.getenv('SINGLE_FLIGHT_TIMEOUT_MS', '5000'))
+
+# Configure saved-search alerts
+app.config['SAVED_SEARCH_REFRESH_SECONDS'] = int(os.getenv('SAVED_SEARCH_REFRESH_SECONDS', '60'))
+app.config['SAVED_SEARCH_QUEUE_SIZE'] = int(os.getenv('SAVED_SEARCH_QUEUE_SIZE', '10000'))
 
 # Security headers with Talisman
 Talisman(app,
@@ -65,7 +128,8 @@ Talisman(app,
 CORS(app, 
      resources={r"/api/*": {"origins": os.getenv('ALLOWED_ORIGINS', '*').split(','),
                            "methods": ["GET", "POST", "PUT", "DELETE"],
-                           "allow_headers": ["Content-Type", "Authorization"]}},
+                           "allow_headers": ["Content-Type", "Authorization", "Idempotency-Key"],
+                           "expose_headers": ["Idempotent-Replayed", "Retry-After"]}},
      supports_credentials=True)
 
 # Rate limiting
@@ -76,6 +140,23 @@ limiter = Limiter(
     storage_uri=os.getenv('REDIS_URL', 'memory://')
 )
 
+# Adaptive admission control: shed low-priority work once requests queue too long
+app.config['ADMISSION_INITIAL_LIMIT'] = int(os.getenv('ADMISSION_INITIAL_LIMIT', '20'))
+app.config['ADMISSION_MIN_LIMIT'] = int(os.getenv('ADMISSION_MIN_LIMIT', '2'))
+app.config['ADMISSION_MAX_LIMIT'] = int(os.getenv('ADMISSION_MAX_LIMIT', '200'))
+app.config['ADMISSION_TARGET_DELAY_MS'] = int(os.getenv('ADMISSION_TARGET_DELAY_MS', '50'))
+app.config['ADMISSION_MAX_WAIT_MS'] = int(os.getenv('ADMISSION_MAX_WAIT_MS', '2000'))
+app.config['ADMISSION_LOW_SHARE'] = float(os.getenv('ADMISSION_LOW_SHARE', '0.5'))
+app.config['ADMISSION_BACKOFF'] = float(os.getenv('ADMISSION_BACKOFF', '0.9'))
+init_admission(app)
+
+# Idempotency-Key support for create endpoints ('database' or 'redis')
+app.config['IDEMPOTENCY_STORE'] = os.getenv('IDEMPOTENCY_STORE', 'database')
+app.config['IDEMPOTENCY_TTL'] = int(os.getenv('IDEMPOTENCY_TTL', '86400'))
+app.config['IDEMPOTENCY_LOCK_SECONDS'] = int(os.getenv('IDEMPOTENCY_LOCK_SECONDS', '60'))
+app.config['IDEMPOTENCY_WAIT_MS'] = int(os.getenv('IDEMPOTENCY_WAIT_MS', '5000'))
+app.config['IDEMPOTENCY_REDIS_URL'] = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
 # Configure logging
 if not app.debug:
     if not os.path.exists('logs'):
@@ -89,13 +170,6 @@ if not app.debug:
     app.logger.setLevel(logging.INFO)
     app.logger.info('Realtor startup')
 
-# Configure SQLAlchemy with connection pooling
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
-    'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '30')),
-    'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
-}
-
 # Basic security middleware
 @app.before_request
 def before_request():
@@ -150,11 +224,22 @@ def health_check():
 
 # Import and register blueprints
 from routes.property_routes import property_bp
+from routes.image_routes import image_bp
+from routes.asset_routes import asset_bp
+from routes.metrics_routes import metrics_bp
+from routes.saved_search_routes import saved_search_bp
 app.register_blueprint(property_bp, url_prefix='/api')
+app.register_blueprint(image_bp, url_prefix='/api')
+app.register_blueprint(asset_bp, url_prefix='/api')
+app.register_blueprint(metrics_bp, url_prefix='/api')
+app.register_blueprint(saved_search_bp, url_prefix='/api')
 
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()  # Create database tables
+        upgrade_schema(db.engine, db.metadata)  # Add columns new since the database was created
+        if get_shard_router(app) is not None:
+            get_shard_router(app).create_all()
     app.run(
         host=os.getenv('HOST', '0.0.0.0'),
         port=int(os.getenv('PORT', 8000)),
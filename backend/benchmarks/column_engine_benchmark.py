@@ -0,0 +1,90 @@
+"""
+Search latency of the column engine against SQL.
+
+Fills a temporary SQLite database with synthetic listings, builds the column
+engine snapshot and times the id page of typical list queries both ways: the
+SQL query GET /api/properties runs without the engine (count plus the page),
+and ColumnEngine.search.
+
+Usage:
+    $ python benchmarks/column_engine_benchmark.py --listings 1000000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models.property import Property, db
+from services.column_engine import ColumnEngine
+from services.filters import apply_filters, apply_sort
+from similarity_benchmark import synthetic_rows
+
+# (filters, sort) pairs in the spirit of the search page
+QUERIES = [
+    ({}, None),
+    ({'listing_type': 'sale', 'min_bedrooms': 3}, ('price', False)),
+    ({'property_type': 'condo', 'max_price': 500000}, ('price', True)),
+    ({'listing_type': 'rent', 'min_square_feet': 1500}, ('created_at', True)),
+    ({'min_price': 200000, 'max_price': 400000, 'min_bathrooms': 2}, ('square_feet', True)),
+]
+
+
+def timed(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return result, timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--listings', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--per-page', type=int, default=12)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(root, "bench.db")}'
+        db.init_app(app)
+        with app.app_context():
+            db.create_all()
+            started = time.perf_counter()
+            rows, batch = synthetic_rows(args.listings), []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == 50000:
+                    db.session.execute(Property.__table__.insert(), batch)
+                    batch = []
+            if batch:
+                db.session.execute(Property.__table__.insert(), batch)
+            db.session.commit()
+            print(f'inserted {args.listings} listings in {time.perf_counter() - started:.1f} s')
+
+            engine = ColumnEngine(os.path.join(root, 'columns'))
+            started = time.perf_counter()
+            engine.build()
+            print(f'built snapshot in {time.perf_counter() - started:.1f} s')
+
+            for filters, sort in QUERIES:
+                def sql():
+                    query = apply_filters(Property.query.with_entities(Property.id), filters)
+                    return [id for id, in apply_sort(query, sort).limit(args.per_page)], query.count()
+
+                expected, sql_ms = timed(sql, args.repeat)
+                found, engine_ms = timed(lambda: engine.search(filters, sort, 1, args.per_page), args.repeat)
+                assert found == expected, (filters, sort)
+                print(f'{str(filters):>65} {str(sort):>22}: sql {sql_ms:8.2f} ms, '
+                      f'engine {engine_ms:7.2f} ms ({sql_ms / engine_ms:5.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Duplicate lookups with the LSH index against comparing with every listing.
+
+Fills a temporary SQLite database with synthetic listings, a share of which are
+relisted copies of another listing with an edited description and a
+differently written address. Then times DedupeIndex.find for the copies
+against a vectorized scan of every signature and address in the catalog,
+reports how many of the scan's duplicates the index finds, and times
+clustering the whole catalog.
+
+Usage:
+    $ python benchmarks/dedupe_benchmark.py --listings 200000 --duplicates 0.05
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models.property import Property, db
+from services.dedupe import DedupeIndex
+from similarity_benchmark import synthetic_rows
+
+WORDS = ('bright spacious cozy modern renovated updated charming quiet sunny private open corner '
+         'kitchen bathroom bedroom garage garden yard patio balcony pool fireplace basement view '
+         'floors windows ceilings closets laundry storage parking schools park shops transit '
+         'hardwood granite stainless marble tile carpet deck porch fence roof hvac solar').split()
+STREETS = (('Street', 'St'), ('Avenue', 'Ave'), ('Road', 'Rd'), ('Drive', 'Dr'), ('Lane', 'Ln'))
+
+
+def description(length):
+    return ' '.join(random.choice(WORDS) for _ in range(length))
+
+
+def edited(text, edits):
+    """Return text with a few words replaced, as another broker would rewrite it."""
+    words = text.split()
+    for _ in range(edits):
+        words[random.randrange(len(words))] = random.choice(WORDS)
+    return ' '.join(words)
+
+
+def catalog(count, share, zip_codes):
+    """Yield (row, source id or None) for count listings, share of them copies."""
+    originals = []
+    for i, row in enumerate(synthetic_rows(count)):
+        street, short = random.choice(STREETS)
+        if originals and random.random() < share:
+            source, number, street_index = random.choice(originals)
+            # Half the copies name a unit, so only their description can match
+            unit = ' Unit 2' if random.random() < 0.5 else ''
+            row.update(description=edited(source['description'], 2), zip_code=source['zip_code'],
+                       listing_type=source['listing_type'],
+                       address=f'{number} Oak {STREETS[street_index][1]}.{unit}')
+            yield row, source['id']
+            continue
+        row.update(description=description(random.randint(30, 80)),
+                   zip_code=f'{random.randrange(zip_codes):05d}', address=f'{i} Oak {street}')
+        row['id'] = i + 1
+        originals.append((row, i, STREETS.index((street, short))))
+        yield row, None
+
+
+def timed(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--listings', type=int, default=200000)
+    parser.add_argument('--duplicates', type=float, default=0.05, help='share of relisted copies')
+    parser.add_argument('--zip-codes', type=int, default=5000)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(root, "bench.db")}'
+        db.init_app(app)
+        with app.app_context():
+            db.create_all()
+            rows, copies, batch = [], [], []
+            for i, (row, source) in enumerate(catalog(args.listings, args.duplicates, args.zip_codes)):
+                row['id'] = i + 1
+                rows.append(row)
+                if source is not None:
+                    copies.append(i)
+                batch.append(row)
+                if len(batch) == 50000:
+                    db.session.execute(Property.__table__.insert(), batch)
+                    batch = []
+            if batch:
+                db.session.execute(Property.__table__.insert(), batch)
+            db.session.commit()
+            print(f'inserted {len(rows)} listings, {len(copies)} of them relisted copies')
+
+            index = DedupeIndex()
+            started = time.perf_counter()
+            index.build()
+            print(f'built index in {time.perf_counter() - started:.1f} s, '
+                  f"{index.metrics()['bytes'] / 2**20:.1f} MiB")
+
+            snapshot = index._snapshot
+            found = expected = lsh_ms = scan_ms = 0
+            for i in random.sample(copies, min(args.queries, len(copies))):
+                row = rows[i]
+                result, elapsed = timed(lambda: index.find(row, exclude_id=row['id']), 3)
+                lsh_ms += elapsed
+
+                def scan():
+                    signatures, _, addresses = index._keys([row])
+                    similar = (snapshot['signatures'] == signatures[0]).mean(axis=1) >= index.threshold
+                    matches = np.flatnonzero(similar | (snapshot['addresses'] == addresses[0]))
+                    return {int(snapshot['ids'][m]) for m in matches} - {row['id']}
+
+                truth, elapsed = timed(scan, 3)
+                scan_ms += elapsed
+                # Description matches only count within the zip code and listing type, as in the index
+                truth = {id_ for id_ in truth
+                         if rows[id_ - 1]['zip_code'] == row['zip_code']
+                         and rows[id_ - 1]['listing_type'] == row['listing_type']}
+                expected += len(truth)
+                found += len(truth & {d['id'] for d in result})
+
+            queries = min(args.queries, len(copies))
+            print(f'lookup: lsh {lsh_ms / queries:7.3f} ms, full scan {scan_ms / queries:7.3f} ms '
+                  f'({scan_ms / lsh_ms:5.1f}x), recall {found / max(expected, 1):.3f}')
+
+            clusters, elapsed = timed(index.clusters, 1)
+            print(f'clustered catalog in {elapsed / 1000:.1f} s: {len(clusters)} clusters, '
+                  f'{sum(len(c) for c in clusters)} listings')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Write throughput with and without group commit.
+
+Creates listings from 1 to 256 concurrent writer threads in a temporary SQLite
+database configured like the app (WAL, pooled connections), once with a
+commit per write and once through the GroupCommitWriter, and reports writes
+per second for each.
+
+The writer threads call the writer directly and hold no connection of their
+own while they wait, as PUT /api/properties/<id> releases the one of its
+existence check before submitting. A route that kept its request connection
+checked out would need a pool larger than the number of concurrent writes.
+
+Usage:
+    $ python benchmarks/group_commit_benchmark.py --writes 20 --synchronous FULL
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy.orm import Session
+from models.property import Property, db
+from services.database import engine_options, init_engine_profiles
+from services.group_commit import GroupCommitWriter
+
+WRITERS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def new_listing(i):
+    return Property(title=f'Listing {i}', description='A listing', price=250000 + i,
+                    address=f'{i} Main St', city='Test City', state='CA', zip_code='12345')
+
+
+def direct_write(i):
+    with Session(db.engine) as session:
+        session.add(new_listing(i))
+        session.commit()
+
+
+def run(app, writers, writes, write):
+    def worker(start):
+        with app.app_context():
+            for i in range(start, start + writes):
+                write(i)
+
+    threads = [threading.Thread(target=worker, args=(n * writes,)) for n in range(writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return writers * writes / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--writes', type=int, default=20, help='writes per writer')
+    parser.add_argument('--synchronous', default='FULL', help='SQLite synchronous pragma')
+    parser.add_argument('--window-ms', type=float, default=2)
+    parser.add_argument('--max-batch', type=int, default=64)
+    args = parser.parse_args()
+    env = {'SQLITE_SYNCHRONOUS': args.synchronous}
+
+    with tempfile.TemporaryDirectory() as root:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(root, "bench.db")}'
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'], env)
+        db.init_app(app)
+        init_engine_profiles(app, db, env)
+        with app.app_context():
+            db.create_all()
+
+        writer = GroupCommitWriter(app, window=args.window_ms / 1000, max_batch=args.max_batch)
+
+        def group_write(i):
+            writer.submit(lambda session: session.add(new_listing(i)))
+
+        print(f'synchronous={args.synchronous}, {args.writes} writes per writer')
+        for writers in WRITERS:
+            direct = run(app, writers, args.writes, direct_write)
+            grouped = run(app, writers, args.writes, group_write)
+            print(f'{writers:4} writers: commit per write {direct:8.0f} writes/s, '
+                  f'group commit {grouped:8.0f} writes/s ({grouped / direct:4.1f}x)')
+        metrics = writer.metrics()
+        print(f"group commit: {metrics['batches']} batches, average {metrics['avg_batch_size']:.1f} writes, "
+              f"largest {metrics['max_batch_size']}")
+
+
+if __name__ == '__main__':
+    main()
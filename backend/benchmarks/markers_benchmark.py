@@ -0,0 +1,93 @@
+"""
+Payload size and parse time of map markers against the listing JSON.
+
+Fills a temporary SQLite database with synthetic listings, fetches every
+listing once through GET /api/properties and once through
+GET /api/properties/markers (JSON and binary), and compares the bytes sent
+and the time a client needs to turn each body into marker positions, prices
+and types.
+
+Usage:
+    $ python benchmarks/markers_benchmark.py --listings 50000
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models.property import Property, db
+from routes.property_routes import property_bp
+from services.markers import decode_markers_binary
+from similarity_benchmark import synthetic_rows
+
+
+def parse_list(body):
+    listings = json.loads(body)['properties']
+    return [(p['id'], p['latitude'], p['longitude'], p['price'], p['property_type']) for p in listings]
+
+
+def parse_markers_json(body):
+    data = json.loads(body)
+    ids, latitudes, longitudes = [], [], []
+    id_, lat, lng = 0, 0, 0
+    for i in range(data['count']):
+        id_ += data['id'][i]
+        lat += data['lat'][i]
+        lng += data['lng'][i]
+        ids.append(id_)
+        latitudes.append(lat / data['coord_scale'])
+        longitudes.append(lng / data['coord_scale'])
+    return ids, latitudes, longitudes, [p * data['price_unit'] for p in data['price']], \
+        [data['types'][t] for t in data['type']]
+
+
+def best_of(func, body, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(body)
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--listings', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(root, "bench.db")}'
+        db.init_app(app)
+        app.register_blueprint(property_bp, url_prefix='/api')
+        with app.app_context():
+            db.create_all()
+            db.session.execute(Property.__table__.insert(), list(synthetic_rows(args.listings)))
+            db.session.commit()
+
+        client = app.test_client()
+        bodies = {
+            'list json': client.get(f'/api/properties?per_page={args.listings}').get_data(),
+            'markers json': client.get('/api/properties/markers').get_data(),
+            'markers binary': client.get('/api/properties/markers?format=binary').get_data(),
+        }
+
+    parsers = {'list json': parse_list, 'markers json': parse_markers_json,
+               'markers binary': decode_markers_binary}
+    parse_ms = {name: best_of(parsers[name], body, args.repeat) for name, body in bodies.items()}
+    print(f'listings: {args.listings}')
+    for name, body in bodies.items():
+        print(f'{name:>15}: {len(body) / 1024:9.1f} KiB '
+              f'({len(bodies["list json"]) / len(body):5.1f}x smaller), '
+              f'parse {parse_ms[name]:8.2f} ms ({parse_ms["list json"] / parse_ms[name]:6.1f}x faster)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Query latency benchmark for the similar-listings index.
+
+Fills a temporary SQLite database with synthetic listings spread over the
+continental US, builds the memory-mapped index and times k-NN queries for
+random listings.
+
+Usage:
+    $ python benchmarks/similarity_benchmark.py --listings 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models.property import Property, db
+from services.similarity import SimilarityIndex
+
+PROPERTY_TYPES = ('house', 'apartment', 'condo', 'townhouse', 'land')
+
+
+def synthetic_rows(count):
+    now = datetime.now(timezone.utc)
+    # A few dense metro areas plus a uniform background
+    metros = [(40.7, -74.0), (34.05, -118.24), (41.88, -87.63), (29.76, -95.37), (25.77, -80.19)]
+    for i in range(count):
+        if random.random() < 0.6:
+            lat, lng = random.choice(metros)
+            lat, lng = lat + random.gauss(0, 0.3), lng + random.gauss(0, 0.3)
+        else:
+            lat, lng = random.uniform(25, 49), random.uniform(-124, -67)
+        rent = random.random() < 0.3
+        yield {
+            'title': f'Listing {i}', 'description': '', 'address': f'{i} Main St',
+            'city': 'City', 'state': 'ST', 'zip_code': '00000',
+            'price': random.lognormvariate(7.8, 0.4) if rent else random.lognormvariate(12.9, 0.6),
+            'bedrooms': random.randint(0, 6), 'bathrooms': random.randint(1, 4),
+            'square_feet': random.uniform(400, 5000), 'latitude': lat, 'longitude': lng,
+            'property_type': random.choice(PROPERTY_TYPES),
+            'listing_type': 'rent' if rent else 'sale',
+            'created_at': now, 'updated_at': now,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--listings', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('-k', type=int, default=6)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(root, "bench.db")}'
+        db.init_app(app)
+        with app.app_context():
+            db.create_all()
+            started = time.perf_counter()
+            rows, batch = synthetic_rows(args.listings), []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == 50000:
+                    db.session.execute(Property.__table__.insert(), batch)
+                    batch = []
+            if batch:
+                db.session.execute(Property.__table__.insert(), batch)
+            db.session.commit()
+            print(f'inserted {args.listings} listings in {time.perf_counter() - started:.1f} s')
+
+            index = SimilarityIndex(os.path.join(root, 'index'))
+            started = time.perf_counter()
+            index.build()
+            print(f'built index in {time.perf_counter() - started:.1f} s')
+
+            sample = [db.session.get(Property, random.randint(1, args.listings))
+                      for _ in range(args.queries)]
+            timings = []
+            for property in sample:
+                started = time.perf_counter()
+                index.similar(property, args.k)
+                timings.append((time.perf_counter() - started) * 1000)
+
+    timings.sort()
+    print(f'queries: {len(timings)}, k={args.k}')
+    print(f'p50: {timings[len(timings) // 2]:.2f} ms, p95: {timings[int(len(timings) * 0.95)]:.2f} ms, '
+          f'p99: {timings[int(len(timings) * 0.99)]:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Throughput benchmark for virtual-tour asset serving.
+
+Writes a large asset to a temporary directory, serves it with the asset
+blueprint on a local threaded server and fetches it from many concurrent
+clients, either as random byte ranges (like a panorama viewer) or in full.
+
+Usage:
+    $ python benchmarks/tour_assets_benchmark.py --size-mb 100 --concurrency 64
+
+The built-in Werkzeug server has no ``wsgi.file_wrapper``, so this measures the
+memory-mapped path. Run the same app under gunicorn to measure ``sendfile``.
+"""
+
+import argparse
+import http.client
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from werkzeug.serving import make_server
+from routes.asset_routes import asset_bp
+
+
+def fetch(port, size, range_bytes, count):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    received = 0
+    for _ in range(count):
+        headers = {}
+        if range_bytes:
+            start = random.randrange(0, max(size - range_bytes, 1))
+            headers['Range'] = f'bytes={start}-{start + range_bytes - 1}'
+        connection.request('GET', '/api/properties/1/assets/tour.bin', headers=headers)
+        response = connection.getresponse()
+        while True:
+            chunk = response.read(1024 * 1024)
+            if not chunk:
+                break
+            received += len(chunk)
+    connection.close()
+    return received
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--size-mb', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=8, help='requests per client')
+    parser.add_argument('--range-mb', type=float, default=4, help='0 fetches the whole file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, '1'))
+        path = os.path.join(root, '1', 'tour.bin')
+        with open(path, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+        size = os.path.getsize(path)
+
+        app = Flask(__name__)
+        app.config['TOUR_ASSET_PATH'] = root
+        app.register_blueprint(asset_bp, url_prefix='/api')
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        range_bytes = int(args.range_mb * 1024 * 1024)
+        # Warm the integrity index so hashing is not part of the measurement
+        fetch(server.port, size, 1, 1)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [pool.submit(fetch, server.port, size, range_bytes, args.requests)
+                       for _ in range(args.concurrency)]
+            received = sum(f.result() for f in futures)
+        elapsed = time.perf_counter() - started
+        server.shutdown()
+
+    total_requests = args.concurrency * args.requests
+    print(f'file size:     {size / 2**20:.0f} MiB')
+    print(f'concurrency:   {args.concurrency}')
+    print(f'requests:      {total_requests} ({"full file" if not range_bytes else f"{args.range_mb} MiB ranges"})')
+    print(f'elapsed:       {elapsed:.2f} s')
+    print(f'throughput:    {received / 2**20 / elapsed:.1f} MiB/s, {total_requests / elapsed:.1f} req/s')
+
+
+if __name__ == '__main__':
+    main()
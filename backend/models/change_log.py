@@ -0,0 +1,11 @@
+from models.property import db
+
+class PropertyChangeLog(db.Model):
+    """One committed write to a listing, for readers that tail changes."""
+    # Assigned when the write is flushed: concurrent writers may commit out of seq order
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    property_id = db.Column(db.Integer, nullable=False)  # no foreign key: deletes are logged too
+    changed_at = db.Column(db.Float, nullable=False)      # epoch seconds
+
+    # Never reuse a sequence number, even after the newest entries are pruned
+    __table_args__ = {'sqlite_autoincrement': True}
@@ -0,0 +1,10 @@
+from models.property import db
+
+class IdempotencyRecord(db.Model):
+    """First response to a request sent with an Idempotency-Key."""
+    key = db.Column(db.String(400), primary_key=True)     # method, path and client key
+    fingerprint = db.Column(db.String(64), nullable=False)  # sha256 of the request
+    status = db.Column(db.Integer)                         # None while the request runs
+    mimetype = db.Column(db.String(100))
+    body = db.Column(db.LargeBinary)
+    expires_at = db.Column(db.Float, nullable=False, index=True)  # epoch seconds
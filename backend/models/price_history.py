@@ -0,0 +1,58 @@
+from array import array
+from models.property import db
+
+def encode_deltas(values, previous=0):
+    """Encode integers as zigzag varints of their differences."""
+    out = bytearray()
+    for value in values:
+        delta = value - previous
+        previous = value
+        n = delta * 2 if delta >= 0 else -delta * 2 - 1
+        while n >= 0x80:
+            out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        out.append(n)
+    return bytes(out)
+
+def decode_deltas(data):
+    """Decode the output of encode_deltas into an array of integers."""
+    values = array('q')
+    previous = n = shift = 0
+    for byte in data:
+        n |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        previous += n >> 1 if not n & 1 else -((n + 1) >> 1)
+        values.append(previous)
+        n = shift = 0
+    return values
+
+class PriceHistory(db.Model):
+    """Append-only price series of a listing.
+
+    Times (epoch seconds) and prices (cents) are stored as delta-encoded
+    varint columns. The last point is kept unencoded so an append only
+    encodes one difference.
+    """
+    property_id = db.Column(db.Integer, db.ForeignKey('property.id'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    times = db.Column(db.LargeBinary, nullable=False, default=b'')
+    prices = db.Column(db.LargeBinary, nullable=False, default=b'')
+    last_time = db.Column(db.Integer)
+    last_price = db.Column(db.Integer)
+    changed_at = db.Column(db.DateTime, index=True)  # of the latest point, for price-drop queries
+    property = db.relationship('Property', backref=db.backref(
+        'price_history', uselist=False, cascade='all, delete-orphan'))
+
+    def append(self, timestamp, cents, changed_at):
+        self.times = (self.times or b'') + encode_deltas([timestamp], self.last_time or 0)
+        self.prices = (self.prices or b'') + encode_deltas([cents], self.last_price or 0)
+        self.count = (self.count or 0) + 1
+        self.last_time = timestamp
+        self.last_price = cents
+        self.changed_at = changed_at
+
+    def series(self):
+        """Return the (times, prices) columns as arrays."""
+        return decode_deltas(self.times), decode_deltas(self.prices)
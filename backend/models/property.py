@@ -1,8 +1,14 @@
+from flask import has_request_context, url_for
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timezone
 
 db = SQLAlchemy()
 
+# Widths of the WebP variants generated for every uploaded image
+IMAGE_WIDTHS = (320, 640, 1280)
+# Variant listed in Property.images for the carousel
+DISPLAY_IMAGE_WIDTH = 1280
+
 class Property(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
@@ -15,10 +21,14 @@ class Property(db.Model):
     city = db.Column(db.String(100), nullable=False)
     state = db.Column(db.String(50), nullable=False)
     zip_code = db.Column(db.String(10), nullable=False)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
     property_type = db.Column(db.String(50))  # house, apartment, condo, etc.
     listing_type = db.Column(db.String(20))   # sale or rent
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    images = db.relationship('PropertyImage', order_by='PropertyImage.position', lazy='selectin',
+                             cascade='all, delete-orphan', back_populates='property')
 
     def to_dict(self):
         return {
@@ -33,8 +43,47 @@ class Property(db.Model):
             'city': self.city,
             'state': self.state,
             'zip_code': self.zip_code,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
             'property_type': self.property_type,
             'listing_type': self.listing_type,
+            'images': [image.url(DISPLAY_IMAGE_WIDTH) for image in self.images],
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
-        }
\ No newline at end of file
+        }
+
+class PropertyImage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    property_id = db.Column(db.Integer, db.ForeignKey('property.id'), nullable=False, index=True)
+    content_hash = db.Column(db.String(64), nullable=False, index=True)  # sha256 of the original
+    extension = db.Column(db.String(10), nullable=False)                 # of the stored original
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    property = db.relationship('Property', back_populates='images')
+
+    __table_args__ = (db.UniqueConstraint('property_id', 'content_hash'),)
+
+    def url(self, width=None):
+        """URL of the stored original, or of the WebP variant of the given width.
+
+        Absolute during a request, since the frontend is served from another origin.
+        """
+        filename = f'original.{self.extension}' if width is None else f'{width}.webp'
+        if has_request_context():
+            return url_for('image.serve_image', digest=self.content_hash, filename=filename, _external=True)
+        return f'/api/images/{self.content_hash}/{filename}'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'property_id': self.property_id,
+            'content_hash': self.content_hash,
+            'width': self.width,
+            'height': self.height,
+            'position': self.position,
+            'original': self.url(),
+            'variants': {str(width): self.url(width) for width in IMAGE_WIDTHS},
+            'created_at': self.created_at.isoformat()
+        }
@@ -0,0 +1,39 @@
+from datetime import datetime, timezone
+from models.property import db
+
+class SavedSearch(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(254), nullable=False, index=True)
+    name = db.Column(db.String(200))
+    criteria = db.Column(db.JSON, nullable=False)  # list filters, as parsed by parse_filters
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    alerts = db.relationship('SearchAlert', cascade='all, delete-orphan', back_populates='search',
+                             order_by='SearchAlert.id.desc()')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'email': self.email,
+            'name': self.name,
+            'criteria': self.criteria,
+            'created_at': self.created_at.isoformat()
+        }
+
+class SearchAlert(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    search_id = db.Column(db.Integer, db.ForeignKey('saved_search.id'), nullable=False, index=True)
+    # No foreign key: with PROPERTY_SHARDS the listing lives in a shard database
+    property_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    search = db.relationship('SavedSearch', back_populates='alerts')
+
+    __table_args__ = (db.UniqueConstraint('search_id', 'property_id'),)
+
+    def to_dict(self, property):
+        """Serialize the alert with its listing, as read by services.sharding.get_listings."""
+        return {
+            'id': self.id,
+            'search_id': self.search_id,
+            'property': property.to_dict(),
+            'created_at': self.created_at.isoformat()
+        }
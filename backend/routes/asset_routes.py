@@ -0,0 +1,70 @@
+import mimetypes
+import uuid
+from flask import Blueprint, Response, jsonify, request, current_app
+from services.tour_assets import (etag_for, file_body, get_asset_index, multipart_body,
+                                  repr_digest, resolve_ranges)
+
+asset_bp = Blueprint('asset', __name__)
+
+@asset_bp.route('/properties/<int:id>/assets/<name>', methods=['GET'])
+def get_property_asset(id, name):
+    """Serve a virtual-tour asset, honouring Range and conditional headers."""
+    entry = get_asset_index().lookup(id, name)
+
+    if entry is None:
+        return jsonify({'error': 'Resource not found'}), 404
+
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    size = entry.size
+
+    response = Response(status=200, mimetype=content_type)
+    response.set_etag(etag_for(entry))
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get('TOUR_ASSET_MAX_AGE', 3600)
+    response.last_modified = entry.mtime_ns // 1_000_000_000
+
+    modified = int(entry.mtime_ns // 1_000_000_000)
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(entry.sha256):
+            response.status_code = 304
+            return response
+    elif request.if_modified_since and modified <= request.if_modified_since.timestamp():
+        response.status_code = 304
+        return response
+
+    # A stale If-Range means the client's partial copy is outdated: send it all
+    if_range = request.if_range
+    ranges = None
+    if (not if_range.etag and not if_range.date) or if_range.etag == entry.sha256 \
+            or (if_range.date and modified <= if_range.date.timestamp()):
+        ranges = resolve_ranges(request.range, size,
+                                current_app.config.get('TOUR_ASSET_MAX_RANGES', 16))
+
+    if ranges == []:
+        response = jsonify({'error': 'Range not satisfiable'})
+        response.status_code = 416
+        response.headers['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if ranges is None:
+        response.response = file_body(request.environ, entry.path, 0, size)
+        response.headers['Repr-Digest'] = repr_digest(entry)
+        response.content_length = size
+    elif len(ranges) == 1:
+        start, stop = ranges[0]
+        response.status_code = 206
+        response.response = file_body(request.environ, entry.path, start, stop)
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        response.content_length = stop - start
+    else:
+        boundary = uuid.uuid4().hex
+        body, length = multipart_body(entry.path, ranges, size, content_type, boundary)
+        response.status_code = 206
+        response.response = body
+        response.mimetype = 'multipart/byteranges'
+        response.headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+        response.content_length = length
+
+    response.direct_passthrough = True
+    return response
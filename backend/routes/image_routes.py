@@ -0,0 +1,112 @@
+from flask import Blueprint, jsonify, request, current_app, send_from_directory
+from sqlalchemy import func
+from models.property import PropertyImage
+from services.images import InvalidImage, get_image_store
+from services.sharding import get_listing, scatter_all, session_for_id
+
+image_bp = Blueprint('image', __name__)
+
+# Variants and originals never change for a given content hash
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+@image_bp.route('/properties/<int:id>/images', methods=['GET'])
+def get_property_images(id):
+    """List the images of a property in display order."""
+    _, property = get_listing(id)
+
+    if not property:
+        return jsonify({'error': 'Resource not found'}), 404
+
+    return jsonify([image.to_dict() for image in property.images]), 200
+
+@image_bp.route('/properties/<int:id>/images', methods=['POST'])
+def upload_property_images(id):
+    """Upload one or more images (multipart field ``images``) for a property."""
+    session, property = get_listing(id)
+
+    if not property:
+        return jsonify({'error': 'Resource not found'}), 404
+
+    files = request.files.getlist('images')
+    if not files:
+        return jsonify({
+            'error': 'Missing required fields',
+            'missing_fields': ['images']
+        }), 400
+
+    store = get_image_store()
+    existing = {image.content_hash: image for image in property.images}
+    position = session.query(func.max(PropertyImage.position)).filter_by(property_id=id).scalar()
+    position = -1 if position is None else position
+
+    images = []
+    try:
+        for file in files:
+            try:
+                digest, extension, width, height = store.save(file.stream)
+            except InvalidImage as e:
+                session.rollback()
+                return jsonify({'error': str(e), 'filename': file.filename}), 400
+
+            # Uploading the same picture twice keeps a single entry
+            image = existing.get(digest)
+            if image is None:
+                position += 1
+                image = PropertyImage(property_id=id, content_hash=digest, extension=extension,
+                                      width=width, height=height, position=position)
+                session.add(image)
+                existing[digest] = image
+            images.append(image)
+
+        session.commit()
+        return jsonify([image.to_dict() for image in images]), 201
+    except Exception as e:
+        session.rollback()
+        current_app.logger.error(f"Error uploading images: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@image_bp.route('/properties/<int:id>/images/<int:image_id>', methods=['DELETE'])
+def delete_property_image(id, image_id):
+    """Remove an image from a property. Stored files may be shared and are kept."""
+    session = session_for_id(id)
+    image = session.get(PropertyImage, image_id) if session is not None else None
+
+    if not image or image.property_id != id:
+        return jsonify({'error': 'Resource not found'}), 404
+
+    try:
+        session.delete(image)
+        session.commit()
+        return '', 204
+    except Exception as e:
+        session.rollback()
+        current_app.logger.error(f"Error deleting image: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@image_bp.route('/images/<digest>/<filename>', methods=['GET'])
+def serve_image(digest, filename):
+    """Serve a stored original or WebP variant."""
+    store = get_image_store()
+    found = store.path_for(digest, filename)
+    if found is not None:
+        response = send_from_directory(*found, max_age=IMMUTABLE_MAX_AGE, conditional=True)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    # A variant that is still being generated: serve the original meanwhile,
+    # but uncached, since the resized file will replace it under this URL
+    if not filename.endswith('.webp'):
+        return jsonify({'error': 'Resource not found'}), 404
+    # Image rows live next to their listing, on any shard
+    extensions = scatter_all(lambda session: session.query(PropertyImage.extension).filter_by(
+        content_hash=digest).limit(1).scalar())
+    extension = next((extension for extension in extensions if extension is not None), None)
+    if extension is None:
+        return jsonify({'error': 'Resource not found'}), 404
+    found = store.path_for(digest, f'original.{extension}')
+    if found is None:
+        return jsonify({'error': 'Resource not found'}), 404
+    response = send_from_directory(*found, max_age=0)
+    response.cache_control.no_cache = True
+    return response
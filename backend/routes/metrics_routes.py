@@ -0,0 +1,9 @@
+from flask import Blueprint, jsonify, current_app
+from services.metrics import collect
+
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Report the metrics of this worker process."""
+    return jsonify(collect(current_app)), 200
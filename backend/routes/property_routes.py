@@ -1,5 +1,19 @@
+from functools import partial
 from flask import Blueprint, jsonify, request, current_app
 from models.property import Property, db
+from services.autocomplete import FIELDS, MAX_SUGGESTIONS, get_autocomplete
+from services.column_engine import get_column_engine
+from services.dedupe import MAX_CHECK_BATCH, get_dedupe_index
+from services.facets import compute_facets, get_facets, parse_facets
+from services.filters import SORT_FIELDS, apply_filters, apply_sort, filter_key, parse_filters, parse_sort
+from services.group_commit import get_group_commit_writer
+from services.idempotency import idempotent
+from services.markers import (BINARY_MIMETYPE, MARKER_COLUMNS, marker_rows, markers_binary,
+                              markers_json, merge_marker_rows)
+from services.price_history import price_drops, price_series
+from services.sharding import get_listing, get_listings, get_shard_router
+from services.similarity import get_similarity_index
+from services.single_flight import SingleFlightTimeout, coalesced_response
 
 property_bp = Blueprint('property', __name__)
 
@@ -8,35 +22,213 @@ def get_properties():
     # Get page and items per page from query parameters
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 12, type=int)
-    
-    # Get paginated properties
-    paginated_properties = Property.query.paginate(
-        page=page,
-        per_page=per_page,
-        error_out=False
-    )
-    
-    # Return paginated response
+    filters = parse_filters(request.args)
+
+    facet_names, unknown_facets = parse_facets(request.args.get('facets'))
+    if unknown_facets:
+        return jsonify({
+            'error': 'Unknown facets',
+            'unknown_facets': unknown_facets
+        }), 400
+
+    try:
+        sort = parse_sort(request.args)
+    except ValueError:
+        return jsonify({
+            'error': 'Invalid sort',
+            'sort_fields': sorted(SORT_FIELDS)
+        }), 400
+
+    # Pages served outside SQL pagination clamp page and per_page like paginate does
+    current = max(page, 1)
+    size = per_page if per_page > 0 else 20
+
+    def build():
+        router = get_shard_router()
+        if router is not None:
+            items, total = router.list_page(filters, current, size, sort)
+            return jsonify(page_response(items, total, router.facets))
+
+        engine = get_column_engine()
+        found = engine.search(filters, sort, current, size) if engine is not None else None
+        if found is not None:
+            ids, total = found
+            listings = {p.id: p for p in Property.query.filter(Property.id.in_(ids))} if ids else {}
+            return jsonify(page_response([listings[i].to_dict() for i in ids if i in listings], total))
+
+        # Get paginated properties
+        paginated_properties = apply_sort(apply_filters(Property.query, filters), sort).paginate(
+            page=page,
+            per_page=per_page,
+            error_out=False
+        )
+
+        # Return paginated response
+        response = {
+            'properties': [p.to_dict() for p in paginated_properties.items],
+            'total': paginated_properties.total,
+            'current_page': page,
+            'total_pages': paginated_properties.pages,
+            'has_next': paginated_properties.has_next,
+            'has_prev': paginated_properties.has_prev
+        }
+        if facet_names:
+            response['facets'] = get_facets(filters, facet_names)
+        return jsonify(response)
+
+    def page_response(items, total, compute_facets=compute_facets):
+        total_pages = -(-total // size)
+        response = {
+            'properties': items,
+            'total': total,
+            'current_page': page,
+            'total_pages': total_pages,
+            'has_next': current < total_pages,
+            'has_prev': current > 1
+        }
+        if facet_names:
+            response['facets'] = get_facets(filters, facet_names, compute_facets)
+        return response
+
+    key = (page, per_page, filter_key(filters), tuple(sorted(facet_names)), sort)
+    try:
+        return coalesced_response('list', key, build)
+    except SingleFlightTimeout:
+        return jsonify({'error': 'Service temporarily unavailable'}), 503
+
+@property_bp.route('/properties/markers', methods=['GET'])
+def get_markers():
+    """Retrieve map markers of the filtered listings as compact columns."""
+    filters = parse_filters(request.args)
+    format = request.args.get('format', 'json')
+    if format not in ('json', 'binary'):
+        return jsonify({'error': 'Unknown format'}), 400
+
+    def build():
+        router = get_shard_router()
+        if router is not None:
+            rows = merge_marker_rows(router.scatter(
+                filters, lambda session: marker_rows(session.query(*MARKER_COLUMNS), filters)))
+        else:
+            rows = marker_rows(db.session.query(*MARKER_COLUMNS), filters)
+
+        if format == 'binary':
+            return current_app.response_class(markers_binary(rows), mimetype=BINARY_MIMETYPE)
+        return jsonify(markers_json(rows))
+
+    try:
+        return coalesced_response('markers', (format, filter_key(filters)), build)
+    except SingleFlightTimeout:
+        return jsonify({'error': 'Service temporarily unavailable'}), 503
+
+@property_bp.route('/properties/duplicates', methods=['GET'])
+def get_duplicate_clusters():
+    """Group the catalog into clusters of likely duplicate listings, largest first."""
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 1000)
+    index = get_dedupe_index()
+    if not index.ensure_built(current_app._get_current_object()):
+        return jsonify({'error': 'Service temporarily unavailable'}), 503
+
+    clusters = index.clusters()
+    return jsonify({
+        'clusters': [{'ids': ids, 'size': len(ids)} for ids in clusters[:limit]],
+        'total_clusters': len(clusters),
+        'duplicate_listings': sum(len(ids) for ids in clusters)
+    }), 200
+
+@property_bp.route('/properties/duplicates/check', methods=['POST'])
+def check_duplicates():
+    """Find the likely duplicates of a batch of listings before ingesting them."""
+    data = request.get_json(silent=True) or {}
+    rows = data.get('properties')
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        return jsonify({'error': 'Expected a list of properties'}), 400
+    if len(rows) > MAX_CHECK_BATCH:
+        return jsonify({'error': f'At most {MAX_CHECK_BATCH} properties per request'}), 400
+
+    index = get_dedupe_index()
+    if not index.ensure_built(current_app._get_current_object()):
+        return jsonify({'error': 'Service temporarily unavailable'}), 503
+
     return jsonify({
-        'properties': [p.to_dict() for p in paginated_properties.items],
-        'total': paginated_properties.total,
-        'current_page': page,
-        'total_pages': paginated_properties.pages,
-        'has_next': paginated_properties.has_next,
-        'has_prev': paginated_properties.has_prev
-    })
+        'results': [{
+            'duplicates': duplicates,
+            'batch_duplicates': batch_duplicates
+        } for duplicates, batch_duplicates in index.find_many(rows)]
+    }), 200
+
+@property_bp.route('/autocomplete', methods=['GET'])
+def autocomplete():
+    """Suggest cities, zip codes and addresses starting with ``q``."""
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 8, type=int), 1), MAX_SUGGESTIONS)
+    fields = [f for f in request.args.get('fields', ','.join(FIELDS)).split(',') if f in FIELDS]
+
+    return jsonify({
+        'suggestions': get_autocomplete().suggest(query, limit, fields or FIELDS)
+    }), 200
 
 @property_bp.route('/properties/<int:id>', methods=['GET'])
 def get_property(id):
     """Retrieve a specific property by its ID."""
-    property = db.session.get(Property, id)
-    
+    def build():
+        _, property = get_listing(id)
+
+        if not property:
+            return jsonify({'error': 'Resource not found'}), 404
+
+        return jsonify(property.to_dict()), 200
+
+    try:
+        return coalesced_response('detail', id, build)
+    except SingleFlightTimeout:
+        return jsonify({'error': 'Service temporarily unavailable'}), 503
+
+@property_bp.route('/properties/<int:id>/similar', methods=['GET'])
+def get_similar_properties(id):
+    """Retrieve the listings most similar to a property, nearest first."""
+    _, property = get_listing(id)
+
+    if not property:
+        return jsonify({'error': 'Resource not found'}), 404
+
+    k = min(max(request.args.get('k', 6, type=int), 1), 50)
+    ids = get_similarity_index().similar(property, k)
+    found = get_listings(ids)
+
+    return jsonify({
+        'properties': [found[i].to_dict() for i in ids if i in found]
+    }), 200
+
+@property_bp.route('/properties/<int:id>/price-history', methods=['GET'])
+def get_price_history(id):
+    """Retrieve a property's price series, downsampled for charting."""
+    _, property = get_listing(id)
+
     if not property:
         return jsonify({'error': 'Resource not found'}), 404
-    
-    return jsonify(property.to_dict()), 200
+
+    points = min(max(request.args.get('points', 100, type=int), 2), 1000)
+    return jsonify(price_series(property, points)), 200
+
+@property_bp.route('/properties/price-drops', methods=['GET'])
+def get_price_drops():
+    """Retrieve listings whose price fell by at least ``min_drop`` percent recently."""
+    min_drop = request.args.get('min_drop', 5, type=float)
+    days = min(max(request.args.get('days', 7, type=int), 1), 365)
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+
+    return jsonify({
+        'price_drops': [{
+            'property': property.to_dict(),
+            'previous_price': previous,
+            'price': current,
+            'drop_percent': round(drop, 2)
+        } for property, previous, current, drop in price_drops(min_drop, days, limit)]
+    }), 200
 
 @property_bp.route('/properties', methods=['POST'])
+@idempotent
 def create_property():
     try:
         data = request.get_json()
@@ -51,10 +243,30 @@ def create_property():
                 'missing_fields': missing_fields
             }), 400
             
-        new_property = Property(**data)
-        db.session.add(new_property)
-        db.session.commit()
-        return jsonify(new_property.to_dict()), 201
+        duplicates = _find_duplicates(data)
+        if duplicates and current_app.config.get('DEDUPE_ON_CREATE', 'flag') == 'reject' \
+                and request.args.get('allow_duplicate') != 'true':
+            return jsonify({
+                'error': 'Possible duplicate listing',
+                'duplicates': duplicates
+            }), 409
+
+        writer = get_group_commit_writer()
+        if writer is not None:
+            created = writer.submit(partial(_insert_property, data), Property.to_dict)
+        else:
+            new_property = Property(**data)
+            router = get_shard_router()
+            if router is not None:
+                router.insert(new_property)
+            else:
+                db.session.add(new_property)
+                db.session.commit()
+            created = new_property.to_dict()
+
+        if duplicates:
+            created['possible_duplicates'] = duplicates
+        return jsonify(created), 201
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f"Error creating property: {str(e)}")
@@ -63,37 +275,78 @@ def create_property():
 @property_bp.route('/properties/<int:id>', methods=['PUT'])
 def update_property(id):
     """Update an existing property."""
-    property = db.session.get(Property, id)
+    session, property = get_listing(id)
     
     if not property:
         return jsonify({'error': 'Resource not found'}), 404
     
     data = request.get_json()
+
+    router = get_shard_router()
+    if router is not None and 'state' in data and router.shard_for_state(data['state']) != router.shard_for_id(id):
+        return jsonify({'error': 'Changing the state would move the listing to another shard'}), 400
     
+    writer = get_group_commit_writer()
+    if writer is not None:
+        # Give the connection of the existence check back to the pool while the batch is
+        # waited for, or concurrent updates hold every connection the writer needs
+        session.close()
+        try:
+            updated = writer.submit(partial(_update_property, id, data),
+                                    lambda property: property and property.to_dict())
+        except Exception as e:
+            current_app.logger.error(f"Error updating property: {str(e)}")
+            return jsonify({'error': 'Internal server error'}), 500
+        if updated is None:
+            return jsonify({'error': 'Resource not found'}), 404
+        return jsonify(updated), 200
+
     for key, value in data.items():
         setattr(property, key, value)
     
     try:
-        db.session.commit()
+        session.commit()
         return jsonify(property.to_dict()), 200
     except Exception as e:
-        db.session.rollback()
+        session.rollback()
         current_app.logger.error(f"Error updating property: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+def _find_duplicates(data):
+    """Return the likely duplicates of a new listing, or None if not checked."""
+    if current_app.config.get('DEDUPE_ON_CREATE', 'flag') == 'off':
+        return None
+    index = get_dedupe_index()
+    # A cold index is built in the background; listings created meanwhile are not checked
+    if not index.ensure_built(current_app._get_current_object(), wait=False):
+        return None
+    return index.find(data)
+
+def _insert_property(data, session):
+    property = Property(**data)
+    session.add(property)
+    return property
+
+def _update_property(id, data, session):
+    property = session.get(Property, id)
+    if property is not None:
+        for key, value in data.items():
+            setattr(property, key, value)
+    return property
+
 @property_bp.route('/properties/<int:id>', methods=['DELETE'])
 def delete_property(id):
     """Delete a property."""
-    property = db.session.get(Property, id)
+    session, property = get_listing(id)
     
     if not property:
         return jsonify({'error': 'Resource not found'}), 404
     
     try:
-        db.session.delete(property)
-        db.session.commit()
+        session.delete(property)
+        session.commit()
         return '', 204
     except Exception as e:
-        db.session.rollback()
+        session.rollback()
         current_app.logger.error(f"Error deleting property: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
\ No newline at end of file
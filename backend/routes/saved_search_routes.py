@@ -0,0 +1,98 @@
+from flask import Blueprint, jsonify, request, current_app
+from werkzeug.datastructures import MultiDict
+from models.property import db
+from models.saved_search import SavedSearch, SearchAlert
+from services.filters import FILTER_FIELDS, parse_filters
+from services.idempotency import idempotent
+from services.saved_searches import get_search_alerts
+from services.sharding import get_listings
+
+saved_search_bp = Blueprint('saved_search', __name__)
+
+@saved_search_bp.route('/saved-searches', methods=['GET'])
+def get_saved_searches():
+    """List the saved searches of the user with the given ``email``."""
+    email = request.args.get('email')
+    if not email:
+        return jsonify({
+            'error': 'Missing required fields',
+            'missing_fields': ['email']
+        }), 400
+
+    searches = SavedSearch.query.filter_by(email=email).order_by(SavedSearch.id)
+    return jsonify([search.to_dict() for search in searches]), 200
+
+@saved_search_bp.route('/saved-searches', methods=['POST'])
+@idempotent
+def create_saved_search():
+    """Save list filters to be alerted about new matching listings."""
+    data = request.get_json() or {}
+
+    missing_fields = [field for field in ('email', 'criteria') if not data.get(field)]
+    if missing_fields:
+        return jsonify({
+            'error': 'Missing required fields',
+            'missing_fields': missing_fields
+        }), 400
+
+    criteria = data['criteria']
+    if not isinstance(criteria, dict):
+        return jsonify({'error': 'Invalid criteria'}), 400
+    unknown_criteria = sorted(name for name in criteria if name not in FILTER_FIELDS)
+    if unknown_criteria:
+        return jsonify({
+            'error': 'Unknown criteria',
+            'unknown_criteria': unknown_criteria
+        }), 400
+    filters = parse_filters(MultiDict(criteria))
+    invalid_criteria = sorted(name for name in criteria if name not in filters)
+    if invalid_criteria:
+        return jsonify({
+            'error': 'Invalid criteria',
+            'invalid_criteria': invalid_criteria
+        }), 400
+
+    try:
+        search = SavedSearch(email=data['email'], name=data.get('name'), criteria=filters)
+        db.session.add(search)
+        db.session.commit()
+        get_search_alerts().add(search)
+        return jsonify(search.to_dict()), 201
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error creating saved search: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@saved_search_bp.route('/saved-searches/<int:id>', methods=['DELETE'])
+def delete_saved_search(id):
+    """Delete a saved search and its alerts."""
+    search = db.session.get(SavedSearch, id)
+
+    if not search:
+        return jsonify({'error': 'Resource not found'}), 404
+
+    try:
+        db.session.delete(search)
+        db.session.commit()
+        get_search_alerts().remove(id)
+        return '', 204
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error deleting saved search: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@saved_search_bp.route('/saved-searches/<int:id>/alerts', methods=['GET'])
+def get_saved_search_alerts(id):
+    """List the listings that matched a saved search, newest first."""
+    search = db.session.get(SavedSearch, id)
+
+    if not search:
+        return jsonify({'error': 'Resource not found'}), 404
+
+    alerts = SearchAlert.query.filter_by(search_id=id).order_by(SearchAlert.id.desc()).all()
+    # Listings may live on shards rather than next to the alerts
+    listings = get_listings([alert.property_id for alert in alerts])
+    return jsonify({
+        'alerts': [alert.to_dict(listings[alert.property_id])
+                   for alert in alerts if alert.property_id in listings]
+    }), 200
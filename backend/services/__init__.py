@@ -0,0 +1 @@
+# Initialize services package
\ No newline at end of file
@@ -0,0 +1,215 @@
+"""
+Adaptive admission control.
+
+Every request except health checks and metrics takes a slot under a
+concurrency limit before it reaches a view. Requests that find no free slot
+wait in line, and the time spent waiting (the queueing delay) is the overload
+signal: its moving average is compared with ADMISSION_TARGET_DELAY_MS. The
+average decays with time as well, so it falls back once requests stop
+waiting even if only shed requests arrive in the meantime.
+
+* While the average is over target, low-priority routes (searches, listing
+  pages) are shed immediately with ``503`` and ``Retry-After``. Detail reads
+  and writes keep queueing, up to ADMISSION_MAX_WAIT_MS, instead of every
+  request waiting for the database pool timeout.
+* Low-priority routes may only fill part of the limit (ADMISSION_LOW_SHARE),
+  so detail reads always find headroom.
+* The limit adapts with AIMD: it grows by one slot per limit's worth of
+  completions while it is being used, and is multiplied by
+  ADMISSION_BACKOFF at most every DECREASE_INTERVAL while over target.
+
+State is per worker process. Limit, queueing delay and per-class admitted,
+queued and shed counts are reported under ``admission`` in
+``GET /api/metrics``.
+"""
+
+import math
+import threading
+import time
+from flask import current_app, g, jsonify, request
+from services.metrics import metric_source
+
+# Endpoint -> route class; other endpoints are 'detail' for reads and 'write' otherwise
+ROUTE_CLASSES = {
+    'health_check': 'critical',
+    'metrics.get_metrics': 'critical',
+    'property.get_properties': 'search',
+    'property.autocomplete': 'search',
+    'property.get_similar_properties': 'search',
+    'property.get_price_drops': 'search',
+    'property.get_markers': 'search',
+    'property.get_duplicate_clusters': 'search',
+    'property.check_duplicates': 'search',
+    'saved_search.get_saved_search_alerts': 'search',
+}
+
+# Classes shed first under overload
+LOW_PRIORITY = frozenset({'search'})
+
+READ_METHODS = frozenset({'GET', 'HEAD'})
+
+# Smoothing of the queueing delay average
+DELAY_ALPHA = 0.1
+
+# Seconds for the queueing delay average to fall by a factor e without new samples
+DELAY_DECAY = 1.0
+
+# Minimum seconds between two multiplicative decreases of the limit
+DECREASE_INTERVAL = 0.1
+
+
+def route_class(endpoint, method):
+    if method == 'OPTIONS':
+        return 'critical'
+    if endpoint in ROUTE_CLASSES:
+        return ROUTE_CLASSES[endpoint]
+    return 'detail' if method in READ_METHODS else 'write'
+
+
+class Shed(Exception):
+    """The request was not admitted."""
+
+
+class AdmissionController:
+    """Concurrency limit with priority classes, adapted with AIMD on queueing delay."""
+
+    def __init__(self, initial_limit=20, min_limit=2, max_limit=200, target_delay=0.05,
+                 max_wait=2.0, low_share=0.5, backoff=0.9):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_delay = target_delay
+        self.max_wait = max_wait
+        self.low_share = low_share
+        self.backoff = backoff
+        self.inflight = 0
+        self.delay = 0.0
+        self._delay_at = time.monotonic()
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._counts = {}
+
+    @property
+    def overloaded(self):
+        return self._current_delay() > self.target_delay
+
+    def _current_delay(self, now=None):
+        elapsed = (now or time.monotonic()) - self._delay_at
+        return self.delay * math.exp(-max(elapsed, 0.0) / DELAY_DECAY)
+
+    def _count(self, route_class, key):
+        counts = self._counts.setdefault(route_class, {'admitted': 0, 'queued': 0, 'shed': 0})
+        counts[key] += 1
+
+    def _record_delay(self, seconds):
+        now = time.monotonic()
+        delay = self._current_delay(now)
+        self.delay = delay + DELAY_ALPHA * (seconds - delay)
+        self._delay_at = now
+
+    def _capacity(self, route_class):
+        limit = max(int(self.limit), self.min_limit)
+        if route_class in LOW_PRIORITY:
+            return max(int(limit * self.low_share), 1)
+        return limit
+
+    def acquire(self, route_class):
+        """Take a slot for a request of route_class, waiting if needed; raise Shed if refused."""
+        low = route_class in LOW_PRIORITY
+        started = time.monotonic()
+        # Low-priority work only waits about as long as the delay the limit aims for
+        deadline = started + (self.target_delay if low else self.max_wait)
+        with self._cond:
+            if low and self.overloaded:
+                self._count(route_class, 'shed')
+                raise Shed()
+            queued = False
+            while self.inflight >= self._capacity(route_class):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (low and self.overloaded):
+                    self._record_delay(time.monotonic() - started)
+                    self._count(route_class, 'shed')
+                    raise Shed()
+                if not queued:
+                    queued = True
+                    self._count(route_class, 'queued')
+                self._cond.wait(remaining)
+            self.inflight += 1
+            self._record_delay(time.monotonic() - started)
+            self._count(route_class, 'admitted')
+
+    def release(self):
+        """Free a slot and adapt the limit."""
+        with self._cond:
+            busy = self.inflight >= self.limit / 2
+            self.inflight -= 1
+            now = time.monotonic()
+            if self.overloaded:
+                if now - self._last_decrease >= DECREASE_INTERVAL:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self._last_decrease = now
+            elif busy:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def retry_after(self):
+        """Seconds a shed client should wait before retrying."""
+        return max(1, math.ceil(self._current_delay() / self.target_delay)) if self.target_delay else 1
+
+    def metrics(self):
+        with self._cond:
+            return {
+                'limit': round(self.limit, 2),
+                'inflight': self.inflight,
+                'queue_delay_ms': self._current_delay() * 1000,
+                'target_delay_ms': self.target_delay * 1000,
+                'overloaded': self.overloaded,
+                'classes': {name: dict(counts) for name, counts in self._counts.items()},
+            }
+
+
+def get_admission_controller(app=None):
+    """Return the admission controller of the given (or current) application."""
+    app = app or current_app
+    controller = app.extensions.get('admission')
+    if controller is None:
+        controller = app.extensions.setdefault('admission', AdmissionController(
+            initial_limit=app.config.get('ADMISSION_INITIAL_LIMIT', 20),
+            min_limit=app.config.get('ADMISSION_MIN_LIMIT', 2),
+            max_limit=app.config.get('ADMISSION_MAX_LIMIT', 200),
+            target_delay=app.config.get('ADMISSION_TARGET_DELAY_MS', 50) / 1000,
+            max_wait=app.config.get('ADMISSION_MAX_WAIT_MS', 2000) / 1000,
+            low_share=app.config.get('ADMISSION_LOW_SHARE', 0.5),
+            backoff=app.config.get('ADMISSION_BACKOFF', 0.9),
+        ))
+    return controller
+
+
+def init_admission(app):
+    """Put every request of app through the admission controller."""
+
+    @app.before_request
+    def _admit():
+        if request.endpoint is None:
+            return None
+        if route_class(request.endpoint, request.method) == 'critical':
+            return None
+        controller = get_admission_controller()
+        try:
+            controller.acquire(route_class(request.endpoint, request.method))
+        except Shed:
+            response = jsonify({'error': 'Service temporarily unavailable'})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(controller.retry_after())
+            return response
+        g.admitted = True
+
+    @app.teardown_request
+    def _release(exception=None):
+        if g.pop('admitted', False):
+            get_admission_controller(app).release()
+
+
+@metric_source('admission')
+def _admission_metrics(app):
+    return get_admission_controller(app).metrics()
@@ -0,0 +1,326 @@
+"""
+Typeahead suggestions for the search box.
+
+Each suggestion field (city, zip code, address) is a sorted array of
+normalized keys with a listing count per key. A prefix lookup is two bisects;
+ranking by count scans the matching range when it is short and otherwise
+reads the top suggestions from a per-prefix cache. The cache is warmed for
+short prefixes when the index is built, and writes update the cached rankings
+of the prefixes of the keys they touch instead of discarding them.
+
+The index is built from grouped queries on first use and then kept up to date
+from committed property changes. Those are only the changes of this process,
+so with several workers an index older than AUTOCOMPLETE_MAX_AGE seconds is
+rebuilt in the background to pick up the others'. Memory is bounded by
+AUTOCOMPLETE_MAX_ENTRIES keys per field: a build keeps the most listed keys,
+and new keys are not added once a field is full.
+"""
+
+import bisect
+import heapq
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, has_app_context
+from sqlalchemy import func
+from models.property import Property
+from services.events import property_changed
+from services.metrics import metric_source
+from services.sharding import scatter_all
+from services.snapshots import BackgroundBuild
+
+FIELDS = ('city', 'zip_code', 'address')
+
+# Suggestions kept per cached prefix; requests may ask for at most this many
+MAX_SUGGESTIONS = 20
+
+# Ranges longer than this are ranked once and cached
+SCAN_LIMIT = 256
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize(text):
+    return _WHITESPACE.sub(' ', (text or '').strip().lower())
+
+
+def display_values(data):
+    """Return {field: display string} for a listing's columns."""
+    values = {}
+    if data.get('city') and data.get('state'):
+        values['city'] = f"{data['city']}, {data['state']}"
+    if data.get('zip_code'):
+        values['zip_code'] = data['zip_code']
+    if data.get('address') and data.get('city') and data.get('state'):
+        values['address'] = f"{data['address']}, {data['city']}, {data['state']}"
+    return values
+
+
+class PrefixIndex:
+    """Sorted-array prefix index of keys ranked by count."""
+
+    def __init__(self, max_entries, cache_size=4096):
+        self.max_entries = max_entries
+        self.cache_size = cache_size
+        self.rejected = 0
+        self._keys = []
+        self._entries = {}           # key -> [count, display]
+        self._cache = OrderedDict()  # prefix -> ranked [(key, display, count)]
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    @staticmethod
+    def _entry_bytes(key, display):
+        # Key and display strings, the dict slot and the list slot
+        return sys.getsizeof(key) + sys.getsizeof(display) + 120
+
+    def nbytes(self):
+        return self._bytes
+
+    def _rank(self, prefix):
+        start = bisect.bisect_left(self._keys, prefix)
+        stop = bisect.bisect_left(self._keys, prefix + '\uffff', lo=start)
+        ranked = heapq.nsmallest(MAX_SUGGESTIONS, self._keys[start:stop],
+                                 key=lambda key: (-self._entries[key][0], key))
+        return [(key, *reversed(self._entries[key])) for key in ranked], stop - start
+
+    def _update_cached(self, key, removed):
+        """Keep the cached rankings of every prefix of key current."""
+        entry = self._entries.get(key)
+        for end in range(1, len(key) + 1):
+            ranked = self._cache.get(key[:end])
+            if ranked is None:
+                continue
+            position = next((i for i, item in enumerate(ranked) if item[0] == key), None)
+            if removed:
+                # A ranked key lost listings: whatever follows it is unknown here
+                if position is not None:
+                    del self._cache[key[:end]]
+                continue
+            item = (key, entry[1], entry[0])
+            if position is not None:
+                ranked[position] = item
+            elif len(ranked) < MAX_SUGGESTIONS or (-item[2], key) < (-ranked[-1][2], ranked[-1][0]):
+                ranked.append(item)
+            else:
+                continue
+            ranked.sort(key=lambda i: (-i[2], i[0]))
+            del ranked[MAX_SUGGESTIONS:]
+
+    def add(self, display, count=1):
+        key = normalize(display)
+        if not key:
+            return
+        entry = self._entries.get(key)
+        if entry is None:
+            if len(self._keys) >= self.max_entries:
+                self.rejected += 1
+                return
+            bisect.insort(self._keys, key)
+            self._entries[key] = [count, display]
+            self._bytes += self._entry_bytes(key, display)
+        else:
+            entry[0] += count
+            entry[1] = display
+        self._update_cached(key, removed=False)
+
+    def remove(self, display, count=1):
+        key = normalize(display)
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        entry[0] -= count
+        if entry[0] <= 0:
+            del self._entries[key]
+            del self._keys[bisect.bisect_left(self._keys, key)]
+            self._bytes -= self._entry_bytes(key, entry[1])
+        self._update_cached(key, removed=True)
+
+    def warm(self, max_length=3):
+        """Rank and cache the short prefixes, which match the most keys."""
+        prefixes = {key[:end] for key in self._keys for end in range(1, min(len(key), max_length) + 1)}
+        for prefix in sorted(prefixes, key=len):
+            ranked, matched = self._rank(prefix)
+            if matched > SCAN_LIMIT:
+                self._cache[prefix] = ranked
+
+    def search(self, prefix, limit):
+        """Return up to limit (display, count) pairs for keys starting with prefix."""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        ranked = self._cache.get(prefix)
+        if ranked is None:
+            ranked, matched = self._rank(prefix)
+            if matched > SCAN_LIMIT:
+                self._cache[prefix] = ranked
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(prefix)
+        return [(display, count) for _, display, count in ranked[:limit]]
+
+
+class Autocomplete:
+    """Prefix indexes for every suggestion field, built lazily from the database."""
+
+    def __init__(self, max_entries, max_age=3600):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._indexes = None
+        self._built_at = None
+        self._changes_seen = 0
+        self._lock = threading.Lock()
+        self._builder = BackgroundBuild('autocomplete index')
+        self.lookups = 0
+        self.lookup_seconds = 0.0
+        self.max_lookup_seconds = 0.0
+
+    def _build(self):
+        indexes = {field: PrefixIndex(self.max_entries) for field in FIELDS}
+        groups = {
+            'city': (Property.city, Property.state),
+            'zip_code': (Property.zip_code,),
+            'address': (Property.address, Property.city, Property.state),
+        }
+        for field, columns in groups.items():
+            def top(session, columns=columns):
+                count = func.count(Property.id)
+                return [tuple(row) for row in session.query(*columns, count).group_by(*columns)
+                        .order_by(count.desc()).limit(self.max_entries)]
+
+            # Shards each return their most listed keys; the counts of a key are summed
+            counts = {}
+            for rows in scatter_all(top):
+                for row in rows:
+                    counts[row[:-1]] = counts.get(row[:-1], 0) + row[-1]
+            for values, total in heapq.nlargest(self.max_entries, counts.items(), key=lambda item: item[1]):
+                data = dict(zip([c.key for c in columns], values))
+                display = display_values(data).get(field)
+                if display:
+                    indexes[field].add(display, total)
+            indexes[field].warm()
+        return indexes
+
+    def _build_and_swap(self, replace):
+        """Build the indexes and install them, over the current ones only if replace."""
+        for attempt in range(3):
+            if not replace and self._indexes is not None:
+                return
+            changes_seen = self._changes_seen
+            indexes = self._build()
+            with self._lock:
+                if not replace and self._indexes is not None:
+                    return
+                # Changes committed while building may be missing from it; use it after three tries anyway
+                if changes_seen == self._changes_seen or attempt == 2:
+                    self._indexes = indexes
+                    self._built_at = time.time()
+                    return
+
+    def _ensure_built(self):
+        self._build_and_swap(replace=False)
+        if self.max_age and time.time() - self._built_at > self.max_age:
+            self.rebuild_in_background(current_app._get_current_object())
+
+    def rebuild_in_background(self, app):
+        self._builder.start(app, lambda: self._build_and_swap(replace=True))
+
+    def wait(self, timeout=None):
+        """Block until a rebuild in progress has finished."""
+        self._builder.wait(timeout)
+
+    def suggest(self, prefix, limit, fields=FIELDS):
+        """Return the best suggestions for prefix across fields, by listing count."""
+        started = time.perf_counter()
+        suggestions = None
+        while suggestions is None:
+            self._ensure_built()
+            with self._lock:
+                # A write may have dropped the indexes since they were built
+                if self._indexes is None:
+                    continue
+                suggestions = []
+                for field in fields:
+                    for value, count in self._indexes[field].search(prefix, limit):
+                        suggestions.append({'type': field, 'value': value, 'count': count})
+        suggestions.sort(key=lambda s: -s['count'])
+        elapsed = time.perf_counter() - started
+        self.lookups += 1
+        self.lookup_seconds += elapsed
+        self.max_lookup_seconds = max(self.max_lookup_seconds, elapsed)
+        return suggestions[:limit]
+
+    def apply(self, change):
+        """Record a committed property change."""
+        with self._lock:
+            self._changes_seen += 1
+            if self._indexes is None:
+                return
+            if change.action == 'created':
+                for field, display in display_values(change.data).items():
+                    self._indexes[field].add(display)
+            elif change.action == 'deleted':
+                for field, display in display_values(change.data).items():
+                    self._indexes[field].remove(display)
+            elif any(field in change.fields for field in ('city', 'state', 'zip_code', 'address')):
+                old = dict(change.data)
+                for field, (previous, _) in change.fields.items():
+                    old[field] = previous
+                # The previous values were never loaded; start over on next use
+                if any(old.get(f) is None for f in ('city', 'state', 'zip_code', 'address')):
+                    self._indexes = None
+                    return
+                for field, display in display_values(old).items():
+                    self._indexes[field].remove(display)
+                for field, display in display_values(change.data).items():
+                    self._indexes[field].add(display)
+
+    def metrics(self):
+        with self._lock:
+            indexes = self._indexes or {}
+            fields = {field: {
+                'entries': len(index),
+                'bytes': index.nbytes(),
+                'rejected': index.rejected,
+            } for field, index in indexes.items()}
+        return {
+            'built': bool(indexes),
+            'index_age_seconds': time.time() - self._built_at if self._built_at is not None else None,
+            'max_entries_per_field': self.max_entries,
+            'fields': fields,
+            'bytes': sum(field['bytes'] for field in fields.values()),
+            'lookups': self.lookups,
+            'avg_lookup_ms': self.lookup_seconds / self.lookups * 1000 if self.lookups else 0.0,
+            'max_lookup_ms': self.max_lookup_seconds * 1000,
+        }
+
+
+def get_autocomplete(app=None):
+    """Return the autocomplete index of the given (or current) application."""
+    app = app or current_app
+    autocomplete = app.extensions.get('autocomplete')
+    if autocomplete is None:
+        autocomplete = app.extensions.setdefault('autocomplete', Autocomplete(
+            max_entries=app.config.get('AUTOCOMPLETE_MAX_ENTRIES', 200000),
+            max_age=app.config.get('AUTOCOMPLETE_MAX_AGE', 3600),
+        ))
+    return autocomplete
+
+
+@property_changed.connect
+def _update_on_write(sender, changes):
+    if not has_app_context():
+        return
+    autocomplete = get_autocomplete()
+    for change in changes:
+        autocomplete.apply(change)
+
+
+@metric_source('autocomplete')
+def _autocomplete_metrics(app):
+    return get_autocomplete(app).metrics()
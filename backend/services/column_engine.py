@@ -0,0 +1,403 @@
+"""
+In-memory columnar engine for listing searches.
+
+With COLUMN_ENGINE enabled, GET /api/properties filters and sorts listings with
+NumPy instead of SQL, and SQL only loads the rows of the requested page. The
+columns filters and sorts use are held as arrays with one entry per listing,
+in id order:
+
+* numeric columns (price, bedrooms, bathrooms, square feet and created_at as
+  epoch seconds) as float64, with NaN for NULL,
+* categorical columns (property type, listing type, city, state, zip code)
+  dictionary-encoded as int32 codes into a sorted list of values, -1 for NULL.
+
+Filters are evaluated as vectorized boolean masks. A sorted page selects the
+first ``page * per_page`` keys with argpartition and only orders those; ties
+are broken by id and NULLs sort last, as in SQL.
+
+The arrays are written as a snapshot of ``.npy`` files and opened with
+``mmap_mode='r'``, so every worker process shares one copy through the page
+cache. Writes reach every worker through the ``property_change_log`` table: a
+session hook logs the id of each listing written in the same transaction as the
+write. Before each search a worker reads the entries after the last one it has
+seen and reloads those listings into a small overlay that hides their snapshot
+rows. Once the overlay grows past COLUMN_ENGINE_MAX_CHANGES rows the snapshot
+is rebuilt in the background, and log entries older than the previous snapshot
+are pruned.
+
+Log sequence numbers are assigned when a write is flushed, not when it
+commits, so with concurrent writers a lower number can become visible after a
+higher one has been read (SQLite serializes writers, but not every database
+does). Numbers skipped over are kept as gaps, and later reads of the log look
+back to the oldest gap, for CHANGE_LOG_GAP_SECONDS; a gap still empty by then
+belongs to a transaction that rolled back. A snapshot records the gaps below
+its last entry the same way.
+
+Until a snapshot exists (the engine is cold) searches fall back to SQL while
+one is built in the background. The engine reads the main database only, so it
+is not used when listings are sharded.
+"""
+
+import os
+import threading
+import time
+from datetime import timezone
+import numpy as np
+from flask import current_app, has_app_context
+from sqlalchemy import delete, event, func, insert, select
+from sqlalchemy.orm import Session
+from models.change_log import PropertyChangeLog
+from models.property import Property, db
+from services.filters import FILTER_FIELDS, matches_filters
+from services.metrics import metric_source
+from services.sharding import get_shard_router
+from services.snapshots import META_NAME, BackgroundBuild, publish_snapshot, read_meta, snapshot_version
+
+NUMERIC_COLUMNS = ('price', 'bedrooms', 'bathrooms', 'square_feet', 'created_at')
+CATEGORICAL_COLUMNS = ('property_type', 'listing_type', 'city', 'state', 'zip_code')
+ENGINE_COLUMNS = ('id',) + NUMERIC_COLUMNS + CATEGORICAL_COLUMNS
+
+# Seconds a skipped change log entry is waited for before its write counts as rolled back
+CHANGE_LOG_GAP_SECONDS = 60
+
+
+def _epoch(value):
+    """Return a datetime as epoch seconds; SQLite returns them without a timezone."""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _select_columns():
+    table = Property.__table__
+    return select(*[table.c[name] for name in ENGINE_COLUMNS]).order_by(table.c.id)
+
+
+def _load_rows(connection, ids):
+    """Return {id: column values} for the listings among ids that still exist."""
+    rows = {}
+    for row in connection.execute(_select_columns().where(Property.__table__.c.id.in_(ids))):
+        data = dict(zip(ENGINE_COLUMNS, row))
+        data['created_at'] = _epoch(data['created_at'])
+        rows[data['id']] = data
+    return rows
+
+
+def _sort_keys(values, descending):
+    """Float sort keys for values: negated when descending, +inf for NULL (NaN)."""
+    keys = -values if descending else np.array(values, dtype=np.float64)
+    keys[np.isnan(keys)] = np.inf
+    return keys
+
+
+class ColumnEngine:
+    """Memory-mapped column snapshot of listings kept in sync through the change log."""
+
+    def __init__(self, path, max_changes=1000):
+        self.path = path
+        self.max_changes = max_changes
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._builder = BackgroundBuild('column engine snapshot')
+        self._snapshot = None
+        self._meta_mtime = None
+        self._seq = 0          # last change log entry applied
+        self._gaps = {}        # seq below self._seq not seen yet -> epoch time it was skipped
+        self._catch_up_lock = threading.Lock()
+        self._overlay = {}     # id -> (seq, column values, or None once deleted)
+        self._hidden = None    # snapshot rows superseded by the overlay
+        self.queries = 0
+        self.fallbacks = 0
+        self.query_seconds = 0.0
+
+    # Snapshot files
+
+    def _meta_path(self):
+        return os.path.join(self.path, META_NAME)
+
+    @staticmethod
+    def _log_gaps(connection, seq, now):
+        """Return the sequence numbers up to seq missing from the log that may still commit."""
+        table = PropertyChangeLog.__table__
+        low = connection.execute(select(func.max(table.c.seq)).where(
+            table.c.seq <= seq, table.c.changed_at < now - CHANGE_LOG_GAP_SECONDS)).scalar()
+        if low is None:
+            low = (connection.execute(select(func.min(table.c.seq))).scalar() or seq + 1) - 1
+        logged = set(connection.execute(select(table.c.seq).where(
+            table.c.seq > low, table.c.seq <= seq)).scalars())
+        return [number for number in range(low + 1, seq + 1) if number not in logged]
+
+    def build(self):
+        """Read all listings, write a new snapshot and switch to it."""
+        built_at = time.time()
+        previous = read_meta(self.path)
+        columns = {name: [] for name in ENGINE_COLUMNS}
+        with db.engine.connect() as connection:
+            # Changes logged after this point are replayed from the log on top of the snapshot
+            seq = connection.execute(select(func.max(PropertyChangeLog.seq))).scalar() or 0
+            gaps = self._log_gaps(connection, seq, built_at)
+            result = connection.execution_options(yield_per=10000).execute(_select_columns())
+            for row in result:
+                for name, value in zip(ENGINE_COLUMNS, row):
+                    columns[name].append(value)
+
+        arrays = {'id': np.array(columns['id'], dtype=np.int64)}
+        for name in NUMERIC_COLUMNS:
+            values = columns[name]
+            if name == 'created_at':
+                values = [_epoch(value) for value in values]
+            arrays[name] = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        dictionaries = {}
+        for name in CATEGORICAL_COLUMNS:
+            dictionaries[name] = sorted({value for value in columns[name] if value is not None})
+            codes = {value: code for code, value in enumerate(dictionaries[name])}
+            arrays[name] = np.fromiter((codes.get(value, -1) for value in columns[name]),
+                                       dtype=np.int32, count=len(columns[name]))
+
+        version = snapshot_version(built_at)
+        os.makedirs(self.path, exist_ok=True)
+        for name, values in arrays.items():
+            np.save(os.path.join(self.path, f'{name}-{version}.npy'), values)
+        meta = {'version': version, 'built_at': built_at, 'seq': seq, 'gaps': gaps,
+                'dictionaries': dictionaries}
+        published = publish_snapshot(self.path, meta)
+        self._refresh(force=published)
+
+        # Workers still on the previous snapshot may need the entries after it
+        if published and previous is not None:
+            with db.engine.begin() as connection:
+                connection.execute(delete(PropertyChangeLog.__table__).where(
+                    PropertyChangeLog.__table__.c.seq <= previous['seq']))
+
+    def _refresh(self, force=False):
+        """Map the current snapshot if it changed since it was last opened."""
+        try:
+            mtime = os.stat(self._meta_path()).st_mtime_ns
+        except OSError:
+            return False
+        if not force and mtime == self._meta_mtime:
+            return True
+        meta = read_meta(self.path)
+        if meta is None:
+            return False
+        version = meta['version']
+        snapshot = {
+            'columns': {name: np.load(os.path.join(self.path, f'{name}-{version}.npy'), mmap_mode='r')
+                        for name in ENGINE_COLUMNS},
+            'codes': {name: {value: code for code, value in enumerate(values)}
+                      for name, values in meta['dictionaries'].items()},
+            'seq': meta['seq'],
+            'built_at': meta['built_at'],
+        }
+        with self._lock:
+            self._snapshot = snapshot
+            self._meta_mtime = mtime
+            # Entries up to the snapshot's last log entry are in it
+            self._overlay = {id: entry for id, entry in self._overlay.items() if entry[0] > meta['seq']}
+            self._seq = max(self._seq, meta['seq'])
+            # Gaps below the snapshot are the ones it recorded; later ones are still ours
+            gaps = {number: self._gaps.get(number, meta['built_at']) for number in meta.get('gaps', ())}
+            gaps.update((number, since) for number, since in self._gaps.items() if number > meta['seq'])
+            self._gaps = gaps
+            self._hidden = np.zeros(len(snapshot['columns']['id']), dtype=bool)
+            self._hide(list(self._overlay))
+        return True
+
+    def _hide(self, ids):
+        """Mark the snapshot rows of ids as superseded; call with the lock held."""
+        snapshot_ids = self._snapshot['columns']['id']
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.searchsorted(snapshot_ids, ids)
+        found = positions < len(snapshot_ids)
+        positions = positions[found]
+        positions = positions[snapshot_ids[positions] == ids[found]]
+        if len(positions):
+            # Searches in progress keep the mask they started with
+            hidden = self._hidden.copy()
+            hidden[positions] = True
+            self._hidden = hidden
+
+    def ensure_loaded(self, app):
+        """Map the snapshot; if there is none, build one in the background and return False."""
+        if self._refresh():
+            return True
+        self.rebuild_in_background(app)
+        return False
+
+    def rebuild_in_background(self, app):
+        def _build():
+            with self._build_lock:
+                self.build()
+
+        self._builder.start(app, _build)
+
+    def wait(self, timeout=None):
+        """Block until a snapshot build in progress has finished."""
+        self._builder.wait(timeout)
+
+    # Writes
+
+    def catch_up(self):
+        """Apply the change log entries written since the last call; return True if a rebuild is due.
+
+        Catch-ups run one at a time, so the rows each one loads are newer than
+        those of the one before.
+        """
+        table = PropertyChangeLog.__table__
+        with self._catch_up_lock:
+            now = time.time()
+            with self._lock:
+                self._gaps = {number: since for number, since in self._gaps.items()
+                              if since > now - CHANGE_LOG_GAP_SECONDS}
+                after = self._seq
+                gaps = set(self._gaps)
+            with db.engine.connect() as connection:
+                entries = connection.execute(select(table.c.seq, table.c.property_id).where(
+                    table.c.seq > min(gaps, default=after + 1) - 1).order_by(table.c.seq)).all()
+                entries = [(seq, property_id) for seq, property_id in entries if seq > after or seq in gaps]
+                if not entries:
+                    return False
+                rows = _load_rows(connection, {property_id for _, property_id in entries})
+
+            with self._lock:
+                latest, last = {}, after
+                for seq, property_id in entries:
+                    latest[property_id] = max(seq, latest.get(property_id, 0))
+                    if seq > after:
+                        self._gaps.update(dict.fromkeys(range(last + 1, seq), now))
+                        last = seq
+                    else:
+                        self._gaps.pop(seq, None)
+                for property_id, seq in latest.items():
+                    seq = max(seq, self._overlay.get(property_id, (0, None))[0])
+                    self._overlay[property_id] = (seq, rows.get(property_id))
+                self._hide(list(latest))
+                self._seq = max(self._seq, last)
+                return len(self._overlay) > self.max_changes and not self._builder.running
+
+    # Queries
+
+    @staticmethod
+    def _mask(snapshot, filters):
+        columns = snapshot['columns']
+        mask = np.ones(len(columns['id']), dtype=bool)
+        for name, value in filters.items():
+            _, column, op = FILTER_FIELDS[name]
+            if column in CATEGORICAL_COLUMNS:
+                code = snapshot['codes'][column].get(value)
+                if code is None:
+                    mask[:] = False
+                    break
+                mask &= columns[column] == code
+            elif op == 'eq':
+                mask &= columns[column] == value
+            elif op == 'ge':
+                mask &= columns[column] >= value
+            else:
+                mask &= columns[column] <= value
+        return mask
+
+    def search(self, filters, sort, page, per_page):
+        """Return (ids of the page, total) for the filtered listings, or None while cold.
+
+        sort is None for id order or a (column, descending) pair from parse_sort.
+        """
+        app = current_app._get_current_object()
+        if not self.ensure_loaded(app):
+            self.fallbacks += 1
+            return None
+        if self.catch_up():
+            self.rebuild_in_background(app)
+        started = time.perf_counter()
+        with self._lock:
+            snapshot = self._snapshot
+            hidden = self._hidden
+            overlay = [row for _, row in self._overlay.values() if row is not None]
+
+        columns = snapshot['columns']
+        positions = np.flatnonzero(self._mask(snapshot, filters) & ~hidden)
+        overlay = [row for row in overlay if matches_filters(filters, row)]
+        total = len(positions) + len(overlay)
+        limit = page * per_page
+
+        # Narrow the snapshot matches to the first `limit` keys, keeping every tie of the last one
+        if sort is None:
+            positions = positions[:limit]
+            keys = np.zeros(len(positions))
+        else:
+            column, descending = sort
+            keys = _sort_keys(columns[column][positions], descending)
+            if len(keys) > limit:
+                kth = keys[np.argpartition(keys, limit - 1)[limit - 1]]
+                keep = keys <= kth
+                positions, keys = positions[keep], keys[keep]
+        ids = np.asarray(columns['id'][positions])
+
+        if overlay:
+            overlay_ids = np.array([row['id'] for row in overlay], dtype=np.int64)
+            if sort is None:
+                overlay_keys = np.zeros(len(overlay))
+            else:
+                overlay_keys = _sort_keys(np.array([np.nan if row[column] is None else row[column]
+                                                    for row in overlay], dtype=np.float64), descending)
+            ids = np.concatenate([ids, overlay_ids])
+            keys = np.concatenate([keys, overlay_keys])
+
+        order = np.lexsort((ids, keys))[limit - per_page:limit]
+        with self._lock:
+            self.queries += 1
+            self.query_seconds += time.perf_counter() - started
+        return ids[order].tolist(), total
+
+    def metrics(self):
+        with self._lock:
+            snapshot = self._snapshot
+            return {
+                'enabled': True,
+                'ready': snapshot is not None,
+                'rows': len(snapshot['columns']['id']) if snapshot is not None else 0,
+                'overlay': len(self._overlay),
+                'seq': self._seq,
+                'gaps': len(self._gaps),
+                'snapshot_age_seconds': time.time() - snapshot['built_at'] if snapshot is not None else None,
+                'queries': self.queries,
+                'fallbacks': self.fallbacks,
+                'avg_query_ms': self.query_seconds / self.queries * 1000 if self.queries else 0.0,
+            }
+
+
+def get_column_engine(app=None):
+    """Return the column engine of the given (or current) application, or None if disabled."""
+    app = app or current_app
+    if not app.config.get('COLUMN_ENGINE', False) or get_shard_router(app) is not None:
+        return None
+    engine = app.extensions.get('column_engine')
+    if engine is None:
+        engine = app.extensions.setdefault('column_engine', ColumnEngine(
+            path=os.path.abspath(app.config.get('COLUMN_ENGINE_PATH', 'media/columns')),
+            max_changes=app.config.get('COLUMN_ENGINE_MAX_CHANGES', 1000),
+        ))
+    return engine
+
+
+@event.listens_for(Session, 'after_flush')
+def _log_changes(session, flush_context):
+    if not has_app_context() or get_column_engine() is None:
+        return
+    ids = [obj.id for obj in session.new if isinstance(obj, Property)]
+    # Collection changes such as a new image leave the row itself untouched
+    ids += [obj.id for obj in session.dirty
+            if isinstance(obj, Property) and session.is_modified(obj, include_collections=False)]
+    ids += [obj.id for obj in session.deleted if isinstance(obj, Property)]
+    if ids:
+        now = time.time()
+        session.connection().execute(insert(PropertyChangeLog.__table__),
+                                     [{'property_id': id, 'changed_at': now} for id in ids])
+
+
+@metric_source('column_engine')
+def _column_engine_metrics(app):
+    engine = get_column_engine(app)
+    return engine.metrics() if engine is not None else {'enabled': False}
@@ -0,0 +1,198 @@
+"""
+Database engine profiles and connection-pool statistics.
+
+``engine_options`` returns the engine options for a database URL. It has to
+run before ``db.init_app(app)``, which is where Flask-SQLAlchemy creates the
+engines. Every pooled backend gets the sizing from DB_POOL_SIZE,
+DB_POOL_TIMEOUT and DB_POOL_RECYCLE, plus DB_MAX_OVERFLOW overflow
+connections. Server databases also get LIFO reuse and pre-ping. SQLite
+additionally gets per-connection pragmas (WAL, synchronous=NORMAL, mmap, page
+cache, busy timeout), which ``init_engine_profiles`` installs as connect
+listeners once the engines exist.
+
+``upgrade_schema`` adds the nullable columns that newer models have to the
+tables of an existing database, which ``create_all`` leaves alone.
+
+Pooled engines use InstrumentedQueuePool, which records how long checkouts
+wait and how many time out. These numbers are reported with the live pool
+state under ``database`` in ``GET /api/metrics``.
+"""
+
+import os
+import threading
+import time
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from services.metrics import metric_source
+
+
+class PoolStats:
+    """Counters for connection checkouts of one pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, waited, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+                self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'avg_wait_ms': self.wait_seconds / self.checkouts * 1000 if self.checkouts else 0.0,
+                'max_wait_ms': self.max_wait_seconds * 1000,
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records checkout wait times and timeouts."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.stats.record(time.perf_counter() - started, timed_out=True)
+            raise
+        self.stats.record(time.perf_counter() - started)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def _is_memory_sqlite(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(uri, env=os.environ):
+    """Return SQLALCHEMY_ENGINE_OPTIONS tuned for the database at uri."""
+    url = make_url(uri)
+    # In-memory SQLite lives in a single connection; Flask-SQLAlchemy sets up its pool
+    if _is_memory_sqlite(url):
+        return {}
+
+    options = {
+        'pool_size': int(env.get('DB_POOL_SIZE', '5')),
+        'pool_timeout': int(env.get('DB_POOL_TIMEOUT', '30')),
+        'pool_recycle': int(env.get('DB_POOL_RECYCLE', '1800')),
+        # Under WAL, SQLite readers run concurrently with the writer, and the
+        # idempotency store and group-commit writer take a connection of their
+        # own next to the request's, so SQLite keeps the overflow as well
+        'max_overflow': int(env.get('DB_MAX_OVERFLOW', '10')),
+        'poolclass': InstrumentedQueuePool,
+    }
+    if url.get_backend_name() != 'sqlite':
+        options['pool_pre_ping'] = True
+        # Reusing the most recent connection lets surplus idle ones be recycled
+        options['pool_use_lifo'] = True
+    return options
+
+
+def sqlite_pragmas(env=os.environ):
+    """Return the PRAGMA settings applied to every SQLite connection, in order."""
+    return [
+        ('journal_mode', env.get('SQLITE_JOURNAL_MODE', 'WAL')),
+        ('synchronous', env.get('SQLITE_SYNCHRONOUS', 'NORMAL')),
+        ('mmap_size', int(env.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))),
+        # Negative values are KiB rather than pages
+        ('cache_size', -int(env.get('SQLITE_CACHE_SIZE_KB', str(64 * 1024)))),
+        ('busy_timeout', int(env.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))),
+    ]
+
+
+def _pragma_listener(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas:
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
+    return set_pragmas
+
+
+def init_engine_profiles(app, db, env=os.environ):
+    """Install the per-connection settings on the engines of the app."""
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite' and not _is_memory_sqlite(engine.url):
+                event.listen(engine, 'connect', _pragma_listener(sqlite_pragmas(env)))
+
+
+def create_profiled_engine(uri, env=os.environ):
+    """Create an engine for uri with the same profile init_app engines get."""
+    engine = create_engine(uri, **engine_options(uri, env))
+    if engine.dialect.name == 'sqlite' and not _is_memory_sqlite(engine.url):
+        event.listen(engine, 'connect', _pragma_listener(sqlite_pragmas(env)))
+    return engine
+
+
+def upgrade_schema(engine, metadata):
+    """Add columns missing from existing tables; return them as "table.column".
+
+    Only nullable columns without a server default can be added in place.
+    Raises RuntimeError for any other missing column.
+    """
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    added = []
+    with engine.begin() as connection:
+        for table in metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            present = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in present:
+                    continue
+                if not column.nullable or column.server_default is not None:
+                    raise RuntimeError(f'Cannot add column {table.name}.{column.name} in place')
+                type_ = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {type_}'))
+                added.append(f'{table.name}.{column.name}')
+    return added
+
+
+def pool_metrics(engine):
+    """Return the live state and checkout statistics of an engine's pool."""
+    pool = engine.pool
+    metrics = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        metrics.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+            'max_overflow': pool._max_overflow,
+            'timeout_s': pool.timeout(),
+        })
+    stats = getattr(pool, 'stats', None)
+    if stats is not None:
+        metrics.update(stats.snapshot())
+    return metrics
+
+
+@metric_source('database')
+def _database_metrics(app):
+    db = app.extensions['sqlalchemy']
+    with app.app_context():
+        return {str(key or 'default'): pool_metrics(engine) for key, engine in db.engines.items()}
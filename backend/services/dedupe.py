@@ -0,0 +1,462 @@
+"""
+Near-duplicate listing detection.
+
+The same home is often listed several times by different brokers, with the
+title, description and address written slightly differently. Two things are
+compared instead of the raw columns:
+
+* the normalized address: lower case without punctuation, street suffixes,
+  directions and unit designators abbreviated ("Avenue" -> "ave", "Apartment
+  #4" -> "unit 4"), state names as USPS codes and the zip code cut to five
+  digits;
+* a MinHash signature of the description: the minimums of DEDUPE_NUM_PERM
+  universal hash functions over its word 3-grams. The share of positions two
+  signatures agree on estimates the Jaccard similarity of the descriptions.
+
+Signatures are cut into DEDUPE_BANDS bands and every band is hashed, together
+with the zip code and listing type, into a bucket key (locality-sensitive
+hashing). Listings with similar descriptions in the same zip code share a
+bucket in at least one band with high probability, so a lookup only compares
+a listing with the few listings in its buckets. A candidate is a duplicate when
+it has the same normalized address and listing type, or when the estimated
+similarity of the descriptions reaches DEDUPE_THRESHOLD.
+
+Bucket and address keys are kept in sorted NumPy arrays, one per band, so a
+lookup is a binary search per band. The arrays are built in the background on
+first use, from every shard when listings are sharded, and later writes go to a
+small overlay until it holds DEDUPE_MAX_OVERLAY listings and the arrays are
+rebuilt.
+
+The index is per worker process and only sees the writes made through that
+process; listings written through other workers are picked up when it is next
+rebuilt, at the latest DEDUPE_MAX_AGE seconds after the last build. Detection
+on create is therefore best-effort with several workers: two copies of a
+listing created close together through different workers are not flagged,
+but both show up in GET /api/properties/duplicates after the next rebuild.
+"""
+
+import hashlib
+import re
+import threading
+import time
+import zlib
+import numpy as np
+from flask import current_app, has_app_context
+from models.property import Property
+from services.events import property_changed
+from services.metrics import metric_source
+from services.sharding import scatter_all
+from services.snapshots import BackgroundBuild, WriteOverlay
+
+SHINGLE_WORDS = 3
+
+# Universal hashing (a * x + b) mod p; p < 2**31 keeps a * x within 64 bits
+_PRIME = (1 << 31) - 1
+# Fixed so that every process computes the same signatures
+_SEED = 1729
+
+# Descriptions hashed per vectorized step while building
+BUILD_CHUNK = 2000
+
+# Listings per POST /api/properties/duplicates/check request
+MAX_CHECK_BATCH = 1000
+
+DEDUPE_COLUMNS = ('id', 'description', 'address', 'city', 'state', 'zip_code', 'listing_type')
+
+STREET_SUFFIXES = {
+    'alley': 'aly', 'avenue': 'ave', 'av': 'ave', 'boulevard': 'blvd', 'circle': 'cir',
+    'court': 'ct', 'crescent': 'cres', 'drive': 'dr', 'expressway': 'expy', 'freeway': 'fwy',
+    'highway': 'hwy', 'lane': 'ln', 'parkway': 'pkwy', 'place': 'pl', 'plaza': 'plz',
+    'road': 'rd', 'square': 'sq', 'street': 'st', 'terrace': 'ter', 'trail': 'trl',
+}
+
+DIRECTIONS = {
+    'north': 'n', 'south': 's', 'east': 'e', 'west': 'w',
+    'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw',
+}
+
+UNIT_DESIGNATORS = {'apartment', 'apt', 'unit', 'suite', 'ste'}
+
+CITY_WORDS = {'saint': 'st', 'mount': 'mt', 'fort': 'ft'}
+
+STATES = {
+    'alabama': 'al', 'alaska': 'ak', 'arizona': 'az', 'arkansas': 'ar', 'california': 'ca',
+    'colorado': 'co', 'connecticut': 'ct', 'delaware': 'de', 'district of columbia': 'dc',
+    'florida': 'fl', 'georgia': 'ga', 'hawaii': 'hi', 'idaho': 'id', 'illinois': 'il',
+    'indiana': 'in', 'iowa': 'ia', 'kansas': 'ks', 'kentucky': 'ky', 'louisiana': 'la',
+    'maine': 'me', 'maryland': 'md', 'massachusetts': 'ma', 'michigan': 'mi', 'minnesota': 'mn',
+    'mississippi': 'ms', 'missouri': 'mo', 'montana': 'mt', 'nebraska': 'ne', 'nevada': 'nv',
+    'new hampshire': 'nh', 'new jersey': 'nj', 'new mexico': 'nm', 'new york': 'ny',
+    'north carolina': 'nc', 'north dakota': 'nd', 'ohio': 'oh', 'oklahoma': 'ok', 'oregon': 'or',
+    'pennsylvania': 'pa', 'rhode island': 'ri', 'south carolina': 'sc', 'south dakota': 'sd',
+    'tennessee': 'tn', 'texas': 'tx', 'utah': 'ut', 'vermont': 'vt', 'virginia': 'va',
+    'washington': 'wa', 'west virginia': 'wv', 'wisconsin': 'wi', 'wyoming': 'wy',
+}
+
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+def _words(text):
+    return _WORD.findall((text or '').lower())
+
+
+def _zip5(data):
+    return ''.join(c for c in str(data.get('zip_code') or '') if c.isdigit())[:5]
+
+
+def normalize_address(data):
+    """Return the normalized ``address|city|state|zip`` of a listing's columns."""
+    words = []
+    for word in _words((data.get('address') or '').replace('#', ' unit ')):
+        word = STREET_SUFFIXES.get(word) or DIRECTIONS.get(word) or word
+        if word in UNIT_DESIGNATORS:
+            word = 'unit'
+        # "Apt #4" names the unit twice
+        if not (word == 'unit' and words and words[-1] == 'unit'):
+            words.append(word)
+    city = ' '.join(CITY_WORDS.get(word, word) for word in _words(data.get('city')))
+    state = ' '.join(_words(data.get('state')))
+    return '|'.join((' '.join(words), city, STATES.get(state, state), _zip5(data)))
+
+
+def shingles(text):
+    """Return the set of word 3-grams of text (one shingle for shorter texts)."""
+    words = _words(text)
+    if len(words) <= SHINGLE_WORDS:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def _stable_hash(text):
+    """Return a 64-bit hash of text that is the same in every process."""
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'little')
+
+
+class MinHasher:
+    """Computes MinHash signatures of descriptions and their LSH bucket keys."""
+
+    def __init__(self, num_perm=64, bands=16, seed=_SEED):
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+        self.num_perm = num_perm
+        self.bands = bands
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, _PRIME, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, _PRIME, size=num_perm).astype(np.uint64)
+        # Odd multipliers that combine the rows of a band into one key
+        self._mix = rng.randint(1, 1 << 62, size=num_perm // bands + 1).astype(np.uint64) | np.uint64(1)
+
+    def signatures(self, texts):
+        """Return the (len(texts), num_perm) uint32 signatures of texts."""
+        if not texts:
+            return np.empty((0, self.num_perm), dtype=np.uint32)
+        hashes, starts = [], []
+        for text in texts:
+            starts.append(len(hashes))
+            hashes.extend(zlib.crc32(shingle.encode()) for shingle in shingles(text))
+        values = np.array(hashes, dtype=np.uint64) % np.uint64(_PRIME)
+        permuted = (values[:, None] * self._a + self._b) % np.uint64(_PRIME)
+        # Every text has at least one shingle, so the starts are increasing
+        return np.minimum.reduceat(permuted, starts, axis=0).astype(np.uint32)
+
+    def band_keys(self, signatures, blocks):
+        """Return the (n, bands) uint64 bucket keys of signatures within their blocks."""
+        rows = signatures.reshape(len(signatures), self.bands, -1).astype(np.uint64)
+        keys = np.asarray(blocks, dtype=np.uint64)[:, None] * self._mix[-1]
+        for row in range(rows.shape[2]):
+            # Wrapping uint64 arithmetic; a rare collision only adds a candidate
+            keys = keys ^ (rows[:, :, row] * self._mix[row])
+            keys = keys * self._mix[-1]
+        return keys
+
+
+class DedupeIndex:
+    """LSH index of listing descriptions and addresses with an in-process write overlay."""
+
+    def __init__(self, num_perm=64, bands=16, threshold=0.7, max_overlay=1000, max_age=3600):
+        self.hasher = MinHasher(num_perm, bands)
+        self.threshold = threshold
+        self.max_overlay = max_overlay
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._builder = BackgroundBuild('dedupe index')
+        self._overlay = WriteOverlay()   # values are (signature, band keys, address key)
+        self._buckets = {}               # (band or 'address', key) -> ids in the overlay
+        self.lookups = 0
+        self.lookup_seconds = 0.0
+        self.build_seconds = 0.0
+
+    def _keys(self, rows):
+        """Return (signatures, band keys, address keys) of a list of listing dicts."""
+        signatures = self.hasher.signatures([row.get('description') for row in rows])
+        blocks = [_stable_hash(f"{_zip5(row)}|{row.get('listing_type') or ''}") for row in rows]
+        addresses = np.array([_stable_hash(f"{normalize_address(row)}|{row.get('listing_type') or ''}")
+                              for row in rows], dtype=np.uint64)
+        return signatures, self.hasher.band_keys(signatures, blocks), addresses
+
+    # Building
+
+    def _load_rows(self):
+        def load(session):
+            query = session.query(*[getattr(Property, c) for c in DEDUPE_COLUMNS])
+            return [dict(zip(DEDUPE_COLUMNS, row)) for row in query.yield_per(10000)]
+
+        return [row for rows in scatter_all(load) for row in rows]
+
+    def build(self):
+        """Read all listings and replace the snapshot arrays."""
+        started = time.perf_counter()
+        built_at = time.time()
+        rows = self._load_rows()
+        parts = [self._keys(rows[i:i + BUILD_CHUNK]) for i in range(0, len(rows), BUILD_CHUNK)]
+        if parts:
+            signatures, keys, addresses = (np.concatenate(part) for part in zip(*parts))
+        else:
+            signatures = np.empty((0, self.hasher.num_perm), dtype=np.uint32)
+            keys = np.empty((0, self.hasher.bands), dtype=np.uint64)
+            addresses = np.empty(0, dtype=np.uint64)
+
+        columns = np.column_stack([keys, addresses]).T
+        order = np.argsort(columns, axis=1, kind='stable')
+        snapshot = {
+            'ids': np.array([row['id'] for row in rows], dtype=np.int64),
+            'signatures': signatures,
+            'addresses': addresses,
+            # One sorted key array per band, the last one for addresses
+            'keys': np.take_along_axis(columns, order, axis=1),
+            'rows': order,
+            'built_at': built_at,
+        }
+        with self._lock:
+            self._snapshot = snapshot
+            for id_, entry in self._overlay.prune(built_at):
+                self._unbucket(id_, entry)
+            self.build_seconds = time.perf_counter() - started
+
+    def ensure_built(self, app, wait=True):
+        """Build the snapshot in the background if there is none; return whether one exists.
+
+        A snapshot older than max_age is rebuilt in the background as well, to
+        pick up the writes of other worker processes.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            self.rebuild_in_background(app)
+            if wait:
+                self.wait()
+        elif self.max_age and time.time() - snapshot['built_at'] > self.max_age:
+            self.rebuild_in_background(app)
+        return self._snapshot is not None
+
+    def rebuild_in_background(self, app):
+        self._builder.start(app, self.build)
+
+    def wait(self, timeout=None):
+        """Block until a build in progress has finished."""
+        self._builder.wait(timeout)
+
+    # Writes
+
+    def _unbucket(self, id_, entry):
+        """Drop an overlay entry of id_ from the buckets; call with the lock held."""
+        for bucket in self._bucket_names(entry[1], entry[2]):
+            ids = self._buckets.get(bucket)
+            if ids is not None:
+                ids.discard(id_)
+                if not ids:
+                    del self._buckets[bucket]
+
+    @staticmethod
+    def _bucket_names(keys, address):
+        return [(band, int(key)) for band, key in enumerate(keys)] + [('address', int(address))]
+
+    def apply(self, change):
+        """Record a committed property change; return True if the snapshot should be rebuilt."""
+        # The first lookup builds from the database, which already has this change
+        if self._snapshot is None and not self._builder.running:
+            return False
+        now = time.time()
+        entry = None
+        if change.action != 'deleted':
+            signatures, keys, addresses = self._keys([change.data])
+            entry = (signatures[0], keys[0], addresses[0])
+        with self._lock:
+            previous = self._overlay.put(change.id, entry, now)
+            if previous is not None:
+                self._unbucket(change.id, previous)
+            if entry is not None:
+                for bucket in self._bucket_names(entry[1], entry[2]):
+                    self._buckets.setdefault(bucket, set()).add(change.id)
+            return len(self._overlay) > self.max_overlay and not self._builder.running
+
+    # Lookups
+
+    def _candidates(self, snapshot, overlay, hidden, buckets, signature, keys, address):
+        """Return {id: (similarity, same address)} of the duplicates of one listing."""
+        found = {}
+        if snapshot is not None and len(snapshot['ids']):
+            positions = []
+            for band, key in enumerate(list(keys) + [address]):
+                sorted_keys = snapshot['keys'][band]
+                start = np.searchsorted(sorted_keys, key, 'left')
+                stop = np.searchsorted(sorted_keys, key, 'right')
+                positions.append(snapshot['rows'][band][start:stop])
+            positions = np.unique(np.concatenate(positions))
+            similarities = (snapshot['signatures'][positions] == signature).mean(axis=1)
+            same_address = snapshot['addresses'][positions] == address
+            for id_, similarity, same in zip(snapshot['ids'][positions].tolist(),
+                                             similarities.tolist(), same_address.tolist()):
+                if id_ not in hidden:
+                    found[id_] = (similarity, same)
+
+        ids = set()
+        for bucket in self._bucket_names(keys, address):
+            ids.update(buckets.get(bucket, ()))
+        for id_ in ids:
+            other_signature, _, other_address = overlay[id_]
+            found[id_] = (float((other_signature == signature).mean()), bool(other_address == address))
+
+        return {id_: value for id_, value in found.items() if value[1] or value[0] >= self.threshold}
+
+    @staticmethod
+    def _ranked(found):
+        return [{'id': id_, 'similarity': round(similarity, 3), 'same_address': same}
+                for id_, (similarity, same) in sorted(found.items(), key=lambda item: (
+                    not item[1][1], -item[1][0], item[0]))]
+
+    def find_many(self, rows, exclude_ids=None):
+        """Return, for each listing dict, its duplicates in the catalog and among the rows before it.
+
+        Each result is ``(duplicates, batch_duplicates)``: dicts with the id,
+        estimated description similarity and whether the address matches, most
+        likely first, and the indexes of earlier rows it duplicates. Returns
+        None while the index is still being built.
+        """
+        if self._snapshot is None:
+            return None
+        started = time.perf_counter()
+        signatures, keys, addresses = self._keys(rows)
+        with self._lock:
+            snapshot = self._snapshot
+            overlay, hidden = self._overlay.copy()
+            buckets = {bucket: set(ids) for bucket, ids in self._buckets.items()}
+
+        results, batch_buckets = [], {}
+        exclude_ids = exclude_ids or [None] * len(rows)
+        for i in range(len(rows)):
+            found = self._candidates(snapshot, overlay, hidden, buckets, signatures[i], keys[i], addresses[i])
+            found.pop(exclude_ids[i], None)
+
+            earlier = set()
+            for bucket in self._bucket_names(keys[i], addresses[i]):
+                earlier.update(batch_buckets.get(bucket, ()))
+                batch_buckets.setdefault(bucket, []).append(i)
+            batch = sorted(j for j in earlier
+                           if addresses[j] == addresses[i]
+                           or (signatures[j] == signatures[i]).mean() >= self.threshold)
+            results.append((self._ranked(found), batch))
+
+        with self._lock:
+            self.lookups += len(rows)
+            self.lookup_seconds += time.perf_counter() - started
+        return results
+
+    def find(self, data, exclude_id=None):
+        """Return the likely duplicates of one listing, or None while the index is being built."""
+        results = self.find_many([data], [exclude_id])
+        return results[0][0] if results is not None else None
+
+    def clusters(self):
+        """Group the whole catalog into clusters of duplicate listings, largest first."""
+        with self._lock:
+            snapshot = self._snapshot
+            overlay, hidden = self._overlay.copy()
+        hidden = np.array(sorted(hidden), dtype=np.int64)
+
+        keep = ~np.isin(snapshot['ids'], hidden)
+        bands = self.hasher.bands
+        # Unsort the per-band keys back into one row of keys per listing
+        columns = np.empty_like(snapshot['keys'])
+        np.put_along_axis(columns, snapshot['rows'], snapshot['keys'], axis=1)
+        overlay_ids = list(overlay)
+        ids = np.concatenate([snapshot['ids'][keep], np.array(overlay_ids, dtype=np.int64)])
+        signatures = np.concatenate([snapshot['signatures'][keep]]
+                                    + [overlay[id_][0][None] for id_ in overlay_ids])
+        columns = np.concatenate([columns[:, keep]]
+                                 + [np.append(overlay[id_][1], overlay[id_][2])[:, None] for id_ in overlay_ids],
+                                 axis=1)
+
+        parent = list(range(len(ids)))
+
+        def root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for band in range(bands + 1):
+            # Link each listing to the next one in its bucket; chains join whole buckets
+            order = np.argsort(columns[band], kind='stable')
+            same = columns[band][order[1:]] == columns[band][order[:-1]]
+            left, right = order[:-1][same], order[1:][same]
+            if band < bands:
+                similar = (signatures[left] == signatures[right]).mean(axis=1) >= self.threshold
+                left, right = left[similar], right[similar]
+            for a, b in zip(left.tolist(), right.tolist()):
+                a, b = root(a), root(b)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+
+        groups = {}
+        for i, id_ in enumerate(ids.tolist()):
+            groups.setdefault(root(i), []).append(id_)
+        return sorted((sorted(group) for group in groups.values() if len(group) > 1),
+                      key=lambda group: (-len(group), group[0]))
+
+    def metrics(self):
+        with self._lock:
+            snapshot = self._snapshot
+            arrays = ('signatures', 'addresses', 'keys', 'rows')
+            return {
+                'ready': snapshot is not None,
+                'listings': len(snapshot['ids']) if snapshot is not None else 0,
+                'overlay': len(self._overlay),
+                'bytes': sum(snapshot[name].nbytes for name in arrays) if snapshot is not None else 0,
+                'lookups': self.lookups,
+                'avg_lookup_ms': self.lookup_seconds / self.lookups * 1000 if self.lookups else 0.0,
+                'build_seconds': self.build_seconds,
+                'snapshot_age_seconds': time.time() - snapshot['built_at'] if snapshot is not None else None,
+            }
+
+
+def get_dedupe_index(app=None):
+    """Return the dedupe index of the given (or current) application."""
+    app = app or current_app
+    index = app.extensions.get('dedupe_index')
+    if index is None:
+        index = app.extensions.setdefault('dedupe_index', DedupeIndex(
+            num_perm=app.config.get('DEDUPE_NUM_PERM', 64),
+            bands=app.config.get('DEDUPE_BANDS', 16),
+            threshold=app.config.get('DEDUPE_THRESHOLD', 0.7),
+            max_overlay=app.config.get('DEDUPE_MAX_OVERLAY', 1000),
+            max_age=app.config.get('DEDUPE_MAX_AGE', 3600),
+        ))
+    return index
+
+
+@property_changed.connect
+def _update_on_write(sender, changes):
+    if not has_app_context():
+        return
+    index = get_dedupe_index()
+    rebuild = False
+    for change in changes:
+        rebuild = index.apply(change) or rebuild
+    if rebuild:
+        index.rebuild_in_background(current_app._get_current_object())
+
+
+@metric_source('dedupe')
+def _dedupe_metrics(app):
+    return get_dedupe_index(app).metrics()
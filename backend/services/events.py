@@ -0,0 +1,90 @@
+"""
+Property change notifications.
+
+Every write to the ``property`` table goes through a SQLAlchemy session, so the
+hooks in this module watch each flush for Property rows and, once the
+surrounding transaction commits, publish them on the ``property_changed``
+signal. Changes from rolled back transactions are discarded.
+
+In-process caches and indexes subscribe to the signal to stay in sync with the
+database without every write handler having to know about them:
+
+    @property_changed.connect
+    def on_property_changed(sender, changes):
+        for change in changes:
+            ...
+"""
+
+from collections import namedtuple
+from blinker import Namespace
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from models.property import Property
+
+_signals = Namespace()
+
+# Sent once per committed transaction with ``changes``: a list of PropertyChange
+property_changed = _signals.signal('property-changed')
+
+# action is 'created', 'updated' or 'deleted'; data maps every column of the row
+# to its value; fields maps each updated column to its (old, new) values
+PropertyChange = namedtuple('PropertyChange', ['action', 'id', 'data', 'fields'])
+
+_PENDING_KEY = 'pending_property_changes'
+
+
+def _snapshot(obj):
+    """Return the column values of obj without touching its relationships."""
+    return {column.key: getattr(obj, column.key) for column in Property.__table__.columns}
+
+
+def _changed_fields(obj):
+    """Return {column: (old, new)} for the attributes modified on obj."""
+    fields = {}
+    for attr in inspect(obj).attrs:
+        if attr.key not in Property.__table__.columns:
+            continue
+        history = attr.history
+        if history.has_changes():
+            old = history.deleted[0] if history.deleted else None
+            new = history.added[0] if history.added else None
+            fields[attr.key] = (old, new)
+    return fields
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    pending = session.info.setdefault(_PENDING_KEY, [])
+    for obj in session.new:
+        if isinstance(obj, Property):
+            pending.append(PropertyChange('created', obj.id, _snapshot(obj), {}))
+    for obj in session.dirty:
+        if isinstance(obj, Property):
+            fields = _changed_fields(obj)
+            # Collection changes such as a new image leave the row itself untouched
+            if fields:
+                pending.append(PropertyChange('updated', obj.id, _snapshot(obj), fields))
+    for obj in session.deleted:
+        if isinstance(obj, Property):
+            pending.append(PropertyChange('deleted', obj.id, _snapshot(obj), {}))
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_changes(session):
+    changes = session.info.pop(_PENDING_KEY, None)
+    if not changes:
+        return
+    # The commit has already happened; a failing subscriber must not turn a
+    # successful write into an error response
+    for receiver in property_changed.receivers_for(session):
+        try:
+            receiver(session, changes=changes)
+        except Exception as e:
+            if has_app_context():
+                current_app.logger.error(f"Error handling property change: {str(e)}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop(_PENDING_KEY, None)
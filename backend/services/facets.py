@@ -0,0 +1,150 @@
+"""
+Facet counts for the search UI.
+
+All requested facets are computed with a single grouped query: the filtered
+rows are grouped by every requested facet expression at once, and the per
+facet counts are then summed from that (small) result in one pass. Results are
+cached per normalized filter and the cache is cleared whenever a Property is
+written, with a TTL as a backstop for writes made by other processes.
+"""
+
+import threading
+import time
+from collections import Counter, OrderedDict
+from flask import current_app, has_app_context
+from sqlalchemy import case, func, literal
+from models.property import Property, db
+from services.events import property_changed
+from services.filters import apply_filters, filter_key
+
+# Upper bounds of the price bands; the last band is open-ended
+PRICE_BANDS = (1000, 2500, 5000, 250000, 500000, 1000000)
+
+# Listings with this many bedrooms or more share one bucket
+MAX_BEDROOM_BUCKET = 4
+
+
+def _price_band_labels():
+    labels, lower = [], 0
+    for upper in PRICE_BANDS:
+        labels.append(f'{lower}-{upper}')
+        lower = upper
+    labels.append(f'{lower}+')
+    return labels
+
+
+PRICE_BAND_LABELS = _price_band_labels()
+
+
+def _price_band_expr():
+    whens = [(Property.price < upper, literal(label))
+             for upper, label in zip(PRICE_BANDS, PRICE_BAND_LABELS)]
+    return case(*whens, else_=literal(PRICE_BAND_LABELS[-1]))
+
+
+def _bedroom_label(bedrooms):
+    if bedrooms is None:
+        return None
+    if bedrooms >= MAX_BEDROOM_BUCKET:
+        return f'{MAX_BEDROOM_BUCKET}+'
+    return str(bedrooms)
+
+
+# Facet name -> (SQL expression factory, label for a grouped value)
+FACETS = {
+    'property_type': (lambda: Property.property_type, lambda value: value),
+    'listing_type': (lambda: Property.listing_type, lambda value: value),
+    'bedrooms': (lambda: Property.bedrooms, _bedroom_label),
+    'price': (_price_band_expr, lambda value: value),
+}
+
+
+def parse_facets(value):
+    """Split a ``facets=`` parameter into (known, unknown) facet names."""
+    names = [name.strip() for name in (value or '').split(',') if name.strip()]
+    known = [name for name in dict.fromkeys(names) if name in FACETS]
+    unknown = [name for name in names if name not in FACETS]
+    return known, unknown
+
+
+def compute_facets(filters, names, session=None):
+    """Count listings per value of each named facet with one query."""
+    expressions = [FACETS[name][0]() for name in names]
+    query = (session or db.session).query(*expressions, func.count(Property.id))
+    query = apply_filters(query, filters).group_by(*expressions)
+
+    counts = {name: Counter() for name in names}
+    for row in query:
+        total = row[-1]
+        for name, value in zip(names, row[:-1]):
+            label = FACETS[name][1](value)
+            if label is not None:
+                counts[name][label] += total
+    return {name: dict(counter) for name, counter in counts.items()}
+
+
+class FacetCache:
+    """Thread-safe LRU cache of facet counts, cleared on every write."""
+
+    def __init__(self, ttl=60, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, self._generation
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None, self._generation
+            self._entries.move_to_end(key)
+            return value, self._generation
+
+    def set(self, key, value, generation):
+        with self._lock:
+            # A write landed while the counts were computed; they may be stale
+            if generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+def get_facet_cache(app=None):
+    """Return the facet cache of the given (or current) application."""
+    app = app or current_app
+    cache = app.extensions.get('facet_cache')
+    if cache is None:
+        cache = app.extensions.setdefault('facet_cache', FacetCache(
+            ttl=app.config.get('FACET_CACHE_TTL', 60),
+            max_entries=app.config.get('FACET_CACHE_SIZE', 1024),
+        ))
+    return cache
+
+
+def get_facets(filters, names, compute=compute_facets):
+    """Return facet counts for the filters, served from cache when possible."""
+    cache = get_facet_cache()
+    key = (filter_key(filters), tuple(sorted(names)))
+    facets, generation = cache.get(key)
+    if facets is None:
+        facets = compute(filters, sorted(names))
+        cache.set(key, facets, generation)
+    return {name: facets[name] for name in names}
+
+
+@property_changed.connect
+def _invalidate_on_write(sender, changes):
+    if has_app_context():
+        get_facet_cache().invalidate()
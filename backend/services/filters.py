@@ -0,0 +1,135 @@
+"""
+Listing filters shared by the list endpoint and the services built on it.
+
+Filters are parsed from query parameters into a plain dict that only holds the
+parameters actually supplied. Like ``page`` and ``per_page``, values that fail
+to convert are ignored rather than rejected.
+
+The ``sort`` and ``order`` parameters are parsed separately, and unlike filters
+an unknown value is an error. Sorted results always break ties by id, so pages
+are stable.
+"""
+
+from datetime import datetime
+from models.property import Property
+
+# Query parameter -> (type, column, comparison)
+FILTER_FIELDS = {
+    'property_type': (str, 'property_type', 'eq'),
+    'listing_type': (str, 'listing_type', 'eq'),
+    'city': (str, 'city', 'eq'),
+    'state': (str, 'state', 'eq'),
+    'zip_code': (str, 'zip_code', 'eq'),
+    'min_price': (float, 'price', 'ge'),
+    'max_price': (float, 'price', 'le'),
+    'min_bedrooms': (int, 'bedrooms', 'ge'),
+    'min_bathrooms': (float, 'bathrooms', 'ge'),
+    'min_square_feet': (float, 'square_feet', 'ge'),
+    'max_square_feet': (float, 'square_feet', 'le'),
+}
+
+# Older query parameter names -> the filter they stand for
+FILTER_ALIASES = {
+    'type': 'property_type',
+}
+
+
+def parse_filters(args):
+    """Extract the supported filters from request args."""
+    filters = {}
+    for name, (type_, _, _) in FILTER_FIELDS.items():
+        value = args.get(name, type=type_)
+        if value is not None and value != '':
+            filters[name] = value
+    for alias, name in FILTER_ALIASES.items():
+        value = args.get(alias, type=FILTER_FIELDS[name][0])
+        if name not in filters and value is not None and value != '':
+            filters[name] = value
+    return filters
+
+
+def filter_key(filters):
+    """Return a hashable key that is identical for equivalent filters."""
+    return tuple(sorted(filters.items()))
+
+
+def apply_filters(query, filters):
+    """Narrow a Property query by the given filters."""
+    for name, value in filters.items():
+        _, column, op = FILTER_FIELDS[name]
+        column = getattr(Property, column)
+        if op == 'eq':
+            query = query.filter(column == value)
+        elif op == 'ge':
+            query = query.filter(column >= value)
+        else:
+            query = query.filter(column <= value)
+    return query
+
+
+def matches_filters(filters, data):
+    """Return True if a listing's column values satisfy the filters.
+
+    Evaluates the filters in Python exactly as apply_filters does in SQL;
+    a missing (NULL) value never satisfies a filter.
+    """
+    for name, value in filters.items():
+        _, column, op = FILTER_FIELDS[name]
+        actual = data.get(column)
+        if actual is None:
+            return False
+        if op == 'eq':
+            if actual != value:
+                return False
+        elif op == 'ge':
+            if actual < value:
+                return False
+        elif actual > value:
+            return False
+    return True
+
+
+# Query parameter ``sort`` -> column
+SORT_FIELDS = {
+    'price': 'price',
+    'date_listed': 'created_at',
+    'bedrooms': 'bedrooms',
+    'bathrooms': 'bathrooms',
+    'square_feet': 'square_feet',
+}
+
+
+def parse_sort(args):
+    """Return (column, descending) for the ``sort`` and ``order`` args, or None if unsorted.
+
+    Raises ValueError for an unknown sort field or order.
+    """
+    field = args.get('sort')
+    order = args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise ValueError(order)
+    if not field:
+        return None
+    if field not in SORT_FIELDS:
+        raise ValueError(field)
+    return SORT_FIELDS[field], order == 'desc'
+
+
+def apply_sort(query, sort):
+    """Order a Property query by sort, with NULLs last and ties broken by id."""
+    if sort is not None:
+        column, descending = sort
+        column = getattr(Property, column)
+        query = query.order_by(column.is_(None), column.desc() if descending else column.asc())
+    return query.order_by(Property.id)
+
+
+def sort_key(sort, id, value):
+    """Return the key ordering a listing as apply_sort does, given its sort column value."""
+    if sort is None:
+        return (False, 0, id)
+    if value is None:
+        return (True, 0, id)
+    if sort[1]:
+        value = -value.timestamp() if isinstance(value, datetime) else -value
+    return (False, value, id)
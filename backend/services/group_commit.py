@@ -0,0 +1,231 @@
+"""
+Group commit for listing writes.
+
+Without it every create and update commits on its own, and on SQLite (one
+writer at a time) or an fsync-bound disk concurrent writes queue up behind one
+commit each. With GROUP_COMMIT enabled, those requests hand their write to a
+single writer thread instead. The thread gathers the writes that arrive within
+GROUP_COMMIT_WINDOW_MS, or until GROUP_COMMIT_MAX_BATCH are queued, and commits
+them in one transaction. It only waits for as many writes as arrived together
+last time or are waiting now, so a lone writer is not delayed.
+
+A write is a function that makes its changes on the session it is given and
+returns a value, e.g. the listing it created. After the commit that value is
+passed to the write's ``result`` function in the writer thread, while the
+objects are still usable, and the request gets back what that returns. The
+function runs in a copy of the submitting request's context, so it can build
+URLs as the request would.
+
+A failure only fails the write that caused it. The batch is flushed once; if
+that flush fails, the transaction is rolled back and the batch replayed with a
+flush after every write, so the error is attributed to the write whose changes
+raised it. That write's caller gets the exception and the rest of the batch is
+replayed again without it, which is why writes must only act through the
+session they are given. A commit that fails as a whole is retried one write
+per transaction.
+
+Batch sizes, replays and commit times are reported under ``group_commit`` in
+``GET /api/metrics``. Writes to sharded listings keep committing directly.
+"""
+
+import queue
+import threading
+import time
+from flask import copy_current_request_context, current_app, has_request_context
+from sqlalchemy.orm import Session
+from models.property import db
+from services.metrics import metric_source
+from services.sharding import get_shard_router
+
+
+class _Write:
+    def __init__(self, apply, result):
+        self.apply = apply
+        self.result = result
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def finish(self, value):
+        try:
+            self.value = self.result(value) if self.result is not None else value
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+    def fail(self, error):
+        self.error = error
+        self.done.set()
+
+
+class GroupCommitWriter:
+    """Commits the writes of concurrent requests together from one thread."""
+
+    def __init__(self, app, window=0.002, max_batch=64):
+        self.app = app
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._active = 0        # callers waiting in submit
+        self._last_batch = 1
+        self.writes = 0
+        self.batches = 0
+        self.max_batch_seen = 0
+        self.failed = 0
+        self.replays = 0
+        self.commit_seconds = 0.0
+
+    def submit(self, apply, result=None):
+        """Run apply(session) in the next group commit; return result(value) or raise its error."""
+        if result is not None and has_request_context():
+            result = copy_current_request_context(result)
+        write = _Write(apply, result)
+        with self._lock:
+            self._active += 1
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='group-commit', daemon=True)
+                self._worker.start()
+        self._queue.put(write)
+        try:
+            write.done.wait()
+        finally:
+            with self._lock:
+                self._active -= 1
+        if write.error is not None:
+            raise write.error
+        return write.value
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        # Wait, up to the window, for as many writes as came together last time or are in flight now
+        expected = min(max(self._last_batch, self._active), self.max_batch)
+        deadline = time.monotonic() + self.window
+        while len(batch) < expected:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self._last_batch = len(batch)
+            try:
+                with self.app.app_context():
+                    self._commit(batch)
+            except Exception as e:
+                self.app.logger.error(f"Error in group commit: {str(e)}")
+                for write in batch:
+                    if not write.done.is_set():
+                        write.fail(e)
+            with self._lock:
+                self.writes += len(batch)
+                self.batches += 1
+                self.max_batch_seen = max(self.max_batch_seen, len(batch))
+
+    def _commit(self, batch):
+        pending = list(batch)
+        # Flush after every write only once a batch flush has failed, to find the culprit
+        isolate = len(pending) == 1
+        while pending:
+            started = time.perf_counter()
+            with Session(db.engine, expire_on_commit=False) as session:
+                applied, failure = [], None
+                for write in pending:
+                    try:
+                        value = write.apply(session)
+                        if isolate:
+                            session.flush()
+                    except Exception as e:
+                        failure = (write, e)
+                        break
+                    applied.append((write, value))
+
+                if failure is None and not isolate:
+                    try:
+                        session.flush()
+                    except Exception:
+                        session.rollback()
+                        isolate = True
+                        with self._lock:
+                            self.replays += 1
+                        continue
+
+                if failure is not None:
+                    # Fail only the write that raised and replay the others without it
+                    session.rollback()
+                    write, error = failure
+                    write.fail(error)
+                    pending.remove(write)
+                    with self._lock:
+                        self.failed += 1
+                        self.replays += 1 if pending else 0
+                    continue
+
+                try:
+                    session.commit()
+                except Exception as e:
+                    session.rollback()
+                    if len(pending) == 1:
+                        pending[0].fail(e)
+                        with self._lock:
+                            self.failed += 1
+                        return
+                    # Not attributable to one write: give each its own transaction
+                    with self._lock:
+                        self.replays += len(pending)
+                    for write in pending:
+                        self._commit([write])
+                    return
+
+                with self._lock:
+                    self.commit_seconds += time.perf_counter() - started
+                for write, value in applied:
+                    write.finish(value)
+            return
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'enabled': True,
+                'writes': self.writes,
+                'batches': self.batches,
+                'avg_batch_size': self.writes / self.batches if self.batches else 0.0,
+                'max_batch_size': self.max_batch_seen,
+                'failed': self.failed,
+                'replays': self.replays,
+                'avg_commit_ms': self.commit_seconds / self.batches * 1000 if self.batches else 0.0,
+                'queue_depth': self._queue.qsize(),
+            }
+
+
+def get_group_commit_writer(app=None):
+    """Return the group-commit writer of the given (or current) application, or None if disabled."""
+    app = app or current_app._get_current_object()
+    if not app.config.get('GROUP_COMMIT', False) or get_shard_router(app) is not None:
+        return None
+    writer = app.extensions.get('group_commit')
+    if writer is None:
+        writer = app.extensions.setdefault('group_commit', GroupCommitWriter(
+            app,
+            window=app.config.get('GROUP_COMMIT_WINDOW_MS', 2) / 1000,
+            max_batch=app.config.get('GROUP_COMMIT_MAX_BATCH', 64),
+        ))
+    return writer
+
+
+@metric_source('group_commit')
+def _group_commit_metrics(app):
+    writer = get_group_commit_writer(app)
+    return writer.metrics() if writer is not None else {'enabled': False}
@@ -0,0 +1,221 @@
+"""
+Idempotency-Key support for create endpoints.
+
+A client that retries a POST sends the same ``Idempotency-Key`` header with
+every attempt. The first request with a key claims it and runs. Its response
+is then stored under the key together with a fingerprint of the request, for
+IDEMPOTENCY_TTL seconds:
+
+* a retry with the same fingerprint replays the stored response, with an
+  ``Idempotent-Replayed: true`` header, without running the view,
+* a request reusing the key for a different body gets ``422``,
+* a duplicate arriving while the first one still runs waits up to
+  IDEMPOTENCY_WAIT_MS for its response, then gets ``409``.
+
+Server errors (5xx) are not stored, so the key is released and the client can
+retry. A claim whose request never finishes expires after
+IDEMPOTENCY_LOCK_SECONDS.
+
+Records live in the ``idempotency_record`` table by default. With
+IDEMPOTENCY_STORE=redis they live in Redis (REDIS_URL) and expire there;
+that store needs the optional ``redis`` package.
+"""
+
+import base64
+import functools
+import hashlib
+import json
+import time
+from collections import namedtuple
+from flask import current_app, jsonify, request
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from models.idempotency import IdempotencyRecord
+from models.property import db
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+# status is None while the first request is still running
+StoredResponse = namedtuple('StoredResponse', ['fingerprint', 'status', 'mimetype', 'body'])
+
+# Seconds between checks while waiting for a concurrent duplicate
+POLL_INTERVAL = 0.05
+
+# Seconds between purges of expired records from the database
+PURGE_INTERVAL = 60
+
+
+class DatabaseIdempotencyStore:
+    """Idempotency records in the application database."""
+
+    def __init__(self):
+        self._table = IdempotencyRecord.__table__
+        self._next_purge = 0.0
+
+    def _purge(self, now):
+        if now < self._next_purge:
+            return
+        self._next_purge = now + PURGE_INTERVAL
+        with db.engine.begin() as connection:
+            connection.execute(delete(self._table).where(self._table.c.expires_at < now))
+
+    def claim(self, key, fingerprint, lock_seconds):
+        """Claim key for a new request; return None, or the record holding it."""
+        table = self._table
+        while True:
+            now = time.time()
+            self._purge(now)
+            # Records are written in their own transactions so other requests see them at once
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(delete(table).where(table.c.key == key, table.c.expires_at < now))
+                    connection.execute(insert(table).values(
+                        key=key, fingerprint=fingerprint, expires_at=now + lock_seconds))
+                return None
+            except IntegrityError:
+                pass
+            with db.engine.connect() as connection:
+                row = connection.execute(select(table).where(table.c.key == key)).first()
+            if row is not None:
+                return StoredResponse(row.fingerprint, row.status, row.mimetype, row.body)
+
+    def get(self, key):
+        with db.engine.connect() as connection:
+            row = connection.execute(select(self._table).where(
+                self._table.c.key == key, self._table.c.expires_at >= time.time())).first()
+        return StoredResponse(row.fingerprint, row.status, row.mimetype, row.body) if row else None
+
+    def save(self, key, response, ttl):
+        with db.engine.begin() as connection:
+            connection.execute(update(self._table).where(self._table.c.key == key).values(
+                status=response.status, mimetype=response.mimetype, body=response.body,
+                expires_at=time.time() + ttl))
+
+    def release(self, key):
+        with db.engine.begin() as connection:
+            connection.execute(delete(self._table).where(self._table.c.key == key))
+
+
+class RedisIdempotencyStore:
+    """Idempotency records in Redis, expired by Redis itself."""
+
+    def __init__(self, url, prefix='idempotency:'):
+        import redis  # Optional dependency, only needed for this store
+        self._redis = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    @staticmethod
+    def _encode(response):
+        return json.dumps({
+            'fingerprint': response.fingerprint,
+            'status': response.status,
+            'mimetype': response.mimetype,
+            'body': base64.b64encode(response.body).decode() if response.body is not None else None,
+        })
+
+    @staticmethod
+    def _decode(raw):
+        data = json.loads(raw)
+        body = base64.b64decode(data['body']) if data['body'] is not None else None
+        return StoredResponse(data['fingerprint'], data['status'], data['mimetype'], body)
+
+    def claim(self, key, fingerprint, lock_seconds):
+        name = self._prefix + key
+        claimed = StoredResponse(fingerprint, None, None, None)
+        while True:
+            if self._redis.set(name, self._encode(claimed), nx=True, ex=max(int(lock_seconds), 1)):
+                return None
+            raw = self._redis.get(name)
+            # The holder may have expired between SET and GET; try again
+            if raw is not None:
+                return self._decode(raw)
+
+    def get(self, key):
+        raw = self._redis.get(self._prefix + key)
+        return self._decode(raw) if raw is not None else None
+
+    def save(self, key, response, ttl):
+        self._redis.set(self._prefix + key, self._encode(response), ex=max(int(ttl), 1))
+
+    def release(self, key):
+        self._redis.delete(self._prefix + key)
+
+
+def get_idempotency_store(app=None):
+    """Return the idempotency store of the given (or current) application."""
+    app = app or current_app
+    store = app.extensions.get('idempotency_store')
+    if store is None:
+        if app.config.get('IDEMPOTENCY_STORE', 'database') == 'redis':
+            store = RedisIdempotencyStore(app.config.get('IDEMPOTENCY_REDIS_URL', 'redis://localhost:6379/0'))
+        else:
+            store = DatabaseIdempotencyStore()
+        store = app.extensions.setdefault('idempotency_store', store)
+    return store
+
+
+def request_fingerprint():
+    """Hash of the method, path and body; JSON bodies are compared by content."""
+    body = request.get_data()
+    if request.is_json:
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode()
+        except ValueError:
+            pass
+    digest = hashlib.sha256(f'{request.method} {request.path}\n'.encode())
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def _replay(stored):
+    response = current_app.response_class(stored.body, status=stored.status, mimetype=stored.mimetype)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """Make a view safe to retry with an Idempotency-Key header."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get(HEADER)
+        if client_key is None:
+            return view(*args, **kwargs)
+        if not client_key or len(client_key) > MAX_KEY_LENGTH:
+            return jsonify({'error': f'{HEADER} must be 1 to {MAX_KEY_LENGTH} characters'}), 400
+
+        config = current_app.config
+        store = get_idempotency_store()
+        key = f'{request.method} {request.path} {client_key}'
+        fingerprint = request_fingerprint()
+
+        stored = store.claim(key, fingerprint, config.get('IDEMPOTENCY_LOCK_SECONDS', 60))
+        deadline = time.monotonic() + config.get('IDEMPOTENCY_WAIT_MS', 5000) / 1000
+        while stored is not None:
+            if stored.fingerprint != fingerprint:
+                return jsonify({'error': f'{HEADER} was already used for a different request'}), 422
+            if stored.status is not None:
+                return _replay(stored)
+            # A duplicate is running: wait for its response rather than run twice
+            if time.monotonic() >= deadline:
+                return jsonify({'error': f'A request with this {HEADER} is in progress'}), 409
+            time.sleep(POLL_INTERVAL)
+            stored = store.get(key)
+            if stored is None:
+                # The first attempt failed and released the key; this one takes over
+                stored = store.claim(key, fingerprint, config.get('IDEMPOTENCY_LOCK_SECONDS', 60))
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except BaseException:
+            store.release(key)
+            raise
+        if response.status_code >= 500:
+            store.release(key)
+        else:
+            store.save(key, StoredResponse(fingerprint, response.status_code, response.mimetype,
+                                           response.get_data()), config.get('IDEMPOTENCY_TTL', 86400))
+        return response
+
+    return wrapper
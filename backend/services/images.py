@@ -0,0 +1,191 @@
+"""
+Image storage and thumbnailing.
+
+Uploaded images are stored content-addressed: the sha256 of the original bytes
+names the directory holding the original and its resized WebP variants, so the
+same photo uploaded for several listings (or several times) is stored and
+processed once.
+
+    <IMAGE_STORAGE_PATH>/ab/abcdef.../original.jpg
+    <IMAGE_STORAGE_PATH>/ab/abcdef.../640.webp
+
+Resizing and WebP encoding are CPU bound, so they run in a process pool and
+never on the request thread. Files are written under a temporary name and
+renamed into place, so a variant is either complete or absent.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from PIL import Image, ImageOps
+from models.property import IMAGE_WIDTHS
+
+# Pillow format -> extension of the stored original
+ALLOWED_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class InvalidImage(ValueError):
+    """Raised when an upload is not an accepted image."""
+
+
+def image_directory(root, digest):
+    return os.path.join(root, digest[:2], digest)
+
+
+def render_variants(directory, source_name, widths, quality):
+    """Write a WebP variant of the source for each width that is missing.
+
+    Runs in a worker process, so it only takes and returns plain values.
+    """
+    written = []
+    with Image.open(os.path.join(directory, source_name)) as source:
+        image = ImageOps.exif_transpose(source)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        for width in widths:
+            target = os.path.join(directory, f'{width}.webp')
+            if os.path.exists(target):
+                continue
+            # Never upscale: small originals get variants at their own size
+            if image.width > width:
+                height = max(1, round(image.height * width / image.width))
+                variant = image.resize((width, height), Image.LANCZOS)
+            else:
+                variant = image
+            fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                variant.save(f, 'WEBP', quality=quality, method=4)
+            os.replace(temp_path, target)
+            written.append(width)
+    return written
+
+
+class ImageStore:
+    """Content-addressed image storage with off-thread variant generation."""
+
+    def __init__(self, root, max_bytes, workers, quality=80):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.quality = quality
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def save(self, stream):
+        """Store an uploaded image and schedule its variants.
+
+        Returns (digest, extension, width, height). Raises InvalidImage when
+        the upload is too large or not a JPEG, PNG or WebP image.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.root, suffix='.upload')
+        try:
+            digest, size = hashlib.sha256(), 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: stream.read(_CHUNK_SIZE), b''):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise InvalidImage('Image too large')
+                    digest.update(chunk)
+                    f.write(chunk)
+            digest = digest.hexdigest()
+
+            # Only the header is read here; decoding happens in the pool
+            try:
+                with Image.open(temp_path) as image:
+                    image_format, (width, height) = image.format, image.size
+            except Exception:
+                raise InvalidImage('Unsupported image')
+            if image_format not in ALLOWED_FORMATS:
+                raise InvalidImage('Unsupported image')
+            extension = ALLOWED_FORMATS[image_format]
+
+            directory = image_directory(self.root, digest)
+            source_name = f'original.{extension}'
+            os.makedirs(directory, exist_ok=True)
+            if os.path.exists(os.path.join(directory, source_name)):
+                os.remove(temp_path)
+            else:
+                os.replace(temp_path, os.path.join(directory, source_name))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        self.schedule_variants(digest, source_name)
+        return digest, extension, width, height
+
+    def schedule_variants(self, digest, source_name):
+        """Generate any missing variants in the process pool."""
+        directory = image_directory(self.root, digest)
+        missing = [w for w in IMAGE_WIDTHS if not os.path.exists(os.path.join(directory, f'{w}.webp'))]
+        if not missing:
+            return None
+        with self._lock:
+            future = self._pending.get(digest)
+            if future is not None:
+                return future
+        future = self._get_executor().submit(render_variants, directory, source_name, missing, self.quality)
+        with self._lock:
+            self._pending[digest] = future
+        logger = current_app.logger
+
+        def _done(f):
+            with self._lock:
+                self._pending.pop(digest, None)
+            if not f.cancelled() and f.exception() is not None:
+                logger.error(f"Error resizing image {digest}: {str(f.exception())}")
+
+        future.add_done_callback(_done)
+        return future
+
+    def wait(self, digest, timeout=None):
+        """Block until the variants of digest are written (used by tests and scripts)."""
+        with self._lock:
+            future = self._pending.get(digest)
+        if future is not None:
+            future.result(timeout=timeout)
+
+    def path_for(self, digest, filename):
+        """Return (directory, filename) of a stored file, or None if it does not exist."""
+        if not DIGEST_PATTERN.match(digest):
+            return None
+        directory = image_directory(self.root, digest)
+        if not os.path.isfile(os.path.join(directory, filename)):
+            return None
+        return directory, filename
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+def get_image_store(app=None):
+    """Return the image store of the given (or current) application."""
+    app = app or current_app
+    store = app.extensions.get('image_store')
+    if store is None:
+        store = app.extensions.setdefault('image_store', ImageStore(
+            root=os.path.abspath(app.config.get('IMAGE_STORAGE_PATH', 'media/images')),
+            max_bytes=app.config.get('IMAGE_MAX_BYTES', 15 * 1024 * 1024),
+            workers=app.config.get('IMAGE_WORKERS', 2),
+            quality=app.config.get('IMAGE_WEBP_QUALITY', 80),
+        ))
+    return store
@@ -0,0 +1,151 @@
+"""
+Compact columnar encoding of listing map markers.
+
+The map only needs the id, position, price and type of each listing, and an
+array of full listing objects repeats every key name per row. Markers are sent
+as parallel columns instead, in id order:
+
+* ``id``, ``lat`` and ``lng`` are delta-encoded: each value is the difference
+  from the previous row (the first from zero). Coordinates are integers in
+  units of 1/COORD_SCALE degree (about 1.1 m).
+* ``price`` is quantized to whole multiples of PRICE_UNIT dollars.
+* ``type`` indexes into the ``types`` list, which may contain null.
+
+Clients restore ids and coordinates with a running sum. Listings without
+coordinates are left out.
+
+The binary variant carries the same columns, packed little-endian so a browser
+can view them with typed arrays without parsing:
+
+    header   '<4sIIII': b'MRK1', count, coord_scale, price_unit, types_length
+    types    UTF-8 names joined by newlines (null is empty), zero-padded to 4 bytes
+    id       count x uint32
+    lat      count x int32
+    lng      count x int32
+    price    count x uint32
+    type     count x uint16
+"""
+
+import heapq
+import struct
+import numpy as np
+from models.property import Property
+from services.filters import apply_filters
+
+# Coordinates are sent as integers in units of 1/COORD_SCALE degree
+COORD_SCALE = 100000
+
+# Prices are sent as whole multiples of this many dollars
+PRICE_UNIT = 100
+
+BINARY_MAGIC = b'MRK1'
+BINARY_HEADER = struct.Struct('<4sIIII')
+BINARY_MIMETYPE = 'application/octet-stream'
+
+MARKER_COLUMNS = (Property.id, Property.latitude, Property.longitude, Property.price,
+                  Property.property_type)
+
+
+def marker_rows(query, filters):
+    """Return (id, latitude, longitude, price, property_type) rows with coordinates, in id order.
+
+    query is a query over MARKER_COLUMNS, e.g. ``session.query(*MARKER_COLUMNS)``.
+    """
+    query = apply_filters(query, filters).filter(
+        Property.latitude.isnot(None), Property.longitude.isnot(None))
+    return [tuple(row) for row in query.order_by(Property.id)]
+
+
+def merge_marker_rows(row_lists):
+    """Merge marker rows of several shards, each in id order, into one list in id order."""
+    return list(heapq.merge(*row_lists, key=lambda row: row[0]))
+
+
+def _delta(values):
+    return np.diff(values, prepend=0)
+
+
+def encode_markers(rows):
+    """Quantize and delta-encode marker rows; return (columns as numpy arrays, types)."""
+    count = len(rows)
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=count)
+    latitudes = np.fromiter((row[1] for row in rows), dtype=np.float64, count=count)
+    longitudes = np.fromiter((row[2] for row in rows), dtype=np.float64, count=count)
+    prices = np.fromiter((row[3] or 0 for row in rows), dtype=np.float64, count=count)
+
+    types, type_index = [], {}
+    type_ids = np.empty(count, dtype=np.uint16)
+    for i, row in enumerate(rows):
+        if row[4] not in type_index:
+            type_index[row[4]] = len(types)
+            types.append(row[4])
+        type_ids[i] = type_index[row[4]]
+    if len(types) > np.iinfo(np.uint16).max + 1:
+        raise ValueError('Too many property types for a marker payload')
+
+    columns = {
+        'id': _delta(ids),
+        'lat': _delta(np.rint(latitudes * COORD_SCALE).astype(np.int64)),
+        'lng': _delta(np.rint(longitudes * COORD_SCALE).astype(np.int64)),
+        'price': np.clip(np.rint(prices / PRICE_UNIT), 0, np.iinfo(np.uint32).max).astype(np.int64),
+        'type': type_ids,
+    }
+    return columns, types
+
+
+def markers_json(rows):
+    """Return the JSON-serializable columnar payload for marker rows."""
+    columns, types = encode_markers(rows)
+    return {
+        'count': len(rows),
+        'coord_scale': COORD_SCALE,
+        'price_unit': PRICE_UNIT,
+        'types': types,
+        **{name: values.tolist() for name, values in columns.items()},
+    }
+
+
+def markers_binary(rows):
+    """Return the packed little-endian payload for marker rows."""
+    columns, types = encode_markers(rows)
+    names = '\n'.join(name or '' for name in types).encode('utf-8')
+    names += b'\0' * (-len(names) % 4)
+    return b''.join([
+        BINARY_HEADER.pack(BINARY_MAGIC, len(rows), COORD_SCALE, PRICE_UNIT, len(names)),
+        names,
+        columns['id'].astype('<u4').tobytes(),
+        columns['lat'].astype('<i4').tobytes(),
+        columns['lng'].astype('<i4').tobytes(),
+        columns['price'].astype('<u4').tobytes(),
+        columns['type'].astype('<u2').tobytes(),
+    ])
+
+
+def decode_markers_binary(data):
+    """Decode a binary payload back into absolute columns (for tests and benchmarks)."""
+    magic, count, coord_scale, price_unit, names_length = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC:
+        raise ValueError('Not a marker payload')
+    offset = BINARY_HEADER.size
+    names = data[offset:offset + names_length].rstrip(b'\0').decode('utf-8')
+    offset += names_length
+    types = [name or None for name in names.split('\n')] if count else []
+
+    def column(dtype):
+        nonlocal offset
+        values = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += values.nbytes
+        return values
+
+    ids = np.cumsum(column('<u4'), dtype=np.int64)
+    latitudes = np.cumsum(column('<i4'), dtype=np.int64) / coord_scale
+    longitudes = np.cumsum(column('<i4'), dtype=np.int64) / coord_scale
+    prices = column('<u4').astype(np.int64) * price_unit
+    type_ids = column('<u2')
+    return {
+        'id': ids,
+        'latitude': latitudes,
+        'longitude': longitudes,
+        'price': prices,
+        'property_type': [types[i] for i in type_ids],
+    }
@@ -0,0 +1,32 @@
+"""
+In-process metrics.
+
+Subsystems register a named source: a function that takes the application and
+returns a dict of plain values. ``GET /api/metrics`` collects every source for
+the current application, so numbers are per worker process.
+
+    @metric_source('autocomplete')
+    def autocomplete_metrics(app):
+        return {'entries': ...}
+"""
+
+_sources = {}
+
+
+def metric_source(name):
+    """Register the decorated function as the metrics source called name."""
+    def decorator(func):
+        _sources[name] = func
+        return func
+    return decorator
+
+
+def collect(app):
+    """Return {source name: metrics} for every registered source."""
+    metrics = {}
+    for name, source in sorted(_sources.items()):
+        try:
+            metrics[name] = source(app)
+        except Exception as e:
+            app.logger.error(f"Error collecting {name} metrics: {str(e)}")
+    return metrics
@@ -0,0 +1,153 @@
+"""
+Price history of listings.
+
+A session hook appends a point to the listing's PriceHistory whenever a
+Property is created or its price changes. This happens in the same flush as
+the write, so history and listing commit or roll back together.
+
+Charts get the series downsampled with largest-triangle-three-buckets, which
+keeps the first and last points and the visually significant ones between.
+Price-drop queries only read the histories whose latest point falls within the
+window, found through the index on ``changed_at``, instead of every listing.
+"""
+
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from models.price_history import PriceHistory
+from models.property import Property
+from services.sharding import get_listings, scatter_all
+
+
+def _to_cents(price):
+    """Return price in cents, or None if it is not a number (the database decides on those)."""
+    try:
+        return int(round(float(price) * 100))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _append(session, obj, price, when):
+    cents = _to_cents(price)
+    if cents is None:
+        return
+    history = obj.price_history
+    if history is None:
+        history = PriceHistory(property=obj)
+        session.add(history)
+    history.append(int(when.timestamp()), cents, when)
+
+
+@event.listens_for(Session, 'before_flush')
+def _record_price_changes(session, flush_context, instances):
+    now = datetime.now(timezone.utc)
+    with session.no_autoflush:
+        for obj in session.new:
+            if isinstance(obj, Property) and obj.price is not None:
+                _append(session, obj, obj.price, now)
+        for obj in session.dirty:
+            if not isinstance(obj, Property):
+                continue
+            history = inspect(obj).attrs.price.history
+            if not history.added or history.added[0] is None:
+                continue
+            old = history.deleted[0] if history.deleted else None
+            if old == history.added[0]:
+                continue
+            if old is not None and obj.price_history is None:
+                # Listed before history was recorded: start from the price it was listed at
+                created = obj.created_at or now
+                if created.tzinfo is None:
+                    created = created.replace(tzinfo=timezone.utc)
+                _append(session, obj, old, created)
+            _append(session, obj, obj.price, now)
+
+
+def lttb(times, values, points):
+    """Downsample a series to at most points with largest-triangle-three-buckets."""
+    n = len(times)
+    if n <= points:
+        return list(times), list(values)
+    if points <= 2:
+        return [times[0], times[-1]], [values[0], values[-1]]
+
+    keep = [0]
+    bucket = (n - 2) / (points - 2)
+    a = 0
+    for i in range(points - 2):
+        start, stop = int(i * bucket) + 1, int((i + 1) * bucket) + 1
+        # The average of the next bucket stands in for the point not chosen yet
+        next_start, next_stop = stop, min(int((i + 2) * bucket) + 1, n)
+        span = next_stop - next_start
+        avg_t = sum(times[next_start:next_stop]) / span
+        avg_v = sum(values[next_start:next_stop]) / span
+        best, best_area = start, -1.0
+        for j in range(start, stop):
+            area = abs((times[a] - avg_t) * (values[j] - values[a])
+                       - (times[a] - times[j]) * (avg_v - values[a]))
+            if area > best_area:
+                best, best_area = j, area
+        keep.append(best)
+        a = best
+    keep.append(n - 1)
+    return [times[i] for i in keep], [values[i] for i in keep]
+
+
+def price_series(property, points):
+    """Return the listing's price series as chart columns, downsampled to points."""
+    history = property.price_history
+    if history is None:
+        created = property.created_at.replace(tzinfo=property.created_at.tzinfo or timezone.utc)
+        times, cents = [int(created.timestamp())], [_to_cents(property.price)]
+    else:
+        times, cents = history.series()
+    count = len(times)
+    times, cents = lttb(times, cents, points)
+    return {
+        'property_id': property.id,
+        'count': count,
+        'timestamps': times,
+        'prices': [c / 100 for c in cents],
+    }
+
+
+def price_at(times, cents, timestamp):
+    """Return the price in effect at timestamp, or the first one if it is earlier."""
+    price = cents[0]
+    for time_, value in zip(times, cents):
+        if time_ > timestamp:
+            break
+        price = value
+    return price
+
+
+def _find_drops(session, since, min_drop):
+    """Return (property id, previous cents, current cents, drop percent) of one database."""
+    drops = []
+    for history in session.query(PriceHistory).filter(PriceHistory.changed_at >= since, PriceHistory.count > 1):
+        times, cents = history.series()
+        previous = price_at(times, cents, int(since.timestamp()))
+        if previous <= 0 or history.last_price >= previous:
+            continue
+        drop = (previous - history.last_price) / previous * 100
+        if drop >= min_drop:
+            drops.append((history.property_id, previous, history.last_price, drop))
+    return drops
+
+
+def price_drops(min_drop, days, limit):
+    """Return listings whose price fell by at least min_drop percent in the last days.
+
+    Each result is (property, previous price, current price, drop percent),
+    largest drop first. The previous price is the one in effect when the
+    window started.
+    """
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    drops = [drop for part in scatter_all(lambda session: _find_drops(session, since, min_drop))
+             for drop in part]
+    drops.sort(key=lambda d: -d[3])
+    drops = drops[:limit]
+
+    found = get_listings([d[0] for d in drops])
+    return [(found[pid], previous / 100, current / 100, drop)
+            for pid, previous, current, drop in drops if pid in found]
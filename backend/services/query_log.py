@@ -0,0 +1,154 @@
+"""
+Per-request query recording, slow-query log and N+1 detection.
+
+SQLAlchemy cursor events time every statement executed on any engine and hand
+it to the recorders active on the current thread. ``init_query_log(app)``
+opens a recorder for each request, which
+
+* logs statements slower than SLOW_QUERY_MS together with their EXPLAIN plan,
+* warns at the end of the request about statement shapes executed
+  N_PLUS_ONE_THRESHOLD times or more, the signature of an N+1 query.
+
+Tests can bound the queries an endpoint issues:
+
+    with assert_max_queries(3):
+        client.get('/api/properties')
+"""
+
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from flask import current_app, g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+_WHITESPACE = re.compile(r'\s+')
+_PLACEHOLDER = r'(?:\?|%s|%\(\w+\)s|:\w+)'
+_IN_LIST = re.compile(rf'IN \({_PLACEHOLDER}(?:, *{_PLACEHOLDER})*\)', re.IGNORECASE)
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+EXPLAIN_PREFIX = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+
+def statement_shape(statement):
+    """Reduce a statement to its shape: literals and IN lists collapsed."""
+    shape = _WHITESPACE.sub(' ', statement).strip()
+    shape = _IN_LIST.sub('IN (?)', shape)
+    return _LITERALS.sub('?', shape)
+
+
+class QueryRecorder:
+    """Statements executed while the recorder is active, with their durations."""
+
+    def __init__(self):
+        self.queries = []   # (statement, parameters, seconds)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def add(self, statement, parameters, seconds):
+        self.queries.append((statement, parameters, seconds))
+
+    def repeated_shapes(self, threshold):
+        """Return {shape: count} for shapes executed at least threshold times."""
+        counts = Counter(statement_shape(statement) for statement, _, _ in self.queries)
+        return {shape: count for shape, count in counts.items() if count >= threshold}
+
+
+def _active_recorders():
+    if not hasattr(_local, 'recorders'):
+        _local.recorders = []
+    return _local.recorders
+
+
+@contextmanager
+def record_queries():
+    """Record the statements executed on this thread inside the block."""
+    recorder = QueryRecorder()
+    recorders = _active_recorders()
+    recorders.append(recorder)
+    try:
+        yield recorder
+    finally:
+        recorders.remove(recorder)
+
+
+@contextmanager
+def assert_max_queries(limit):
+    """Fail if the block executes more than limit statements."""
+    with record_queries() as recorder:
+        yield recorder
+    if len(recorder) > limit:
+        statements = '\n'.join(f'  {statement}' for statement, _, _ in recorder.queries)
+        raise AssertionError(f'{len(recorder)} queries executed, expected at most {limit}:\n{statements}')
+
+
+def _explain(connection, statement, parameters):
+    prefix = EXPLAIN_PREFIX.get(connection.dialect.name)
+    if prefix is None or not statement.lstrip().upper().startswith('SELECT'):
+        return None
+    # A raw DBAPI cursor, so the EXPLAIN itself is not recorded or timed
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return [' '.join(str(value) for value in row) for row in cursor.fetchall()]
+    except Exception as e:
+        return [f'EXPLAIN failed: {e}']
+    finally:
+        cursor.close()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if _active_recorders():
+        context._query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    recorders = _active_recorders()
+    started = getattr(context, '_query_started', None)
+    if not recorders or started is None:
+        return
+    seconds = time.perf_counter() - started
+    for recorder in recorders:
+        recorder.add(statement, parameters, seconds)
+
+    if not has_app_context():
+        return
+    threshold = current_app.config.get('SLOW_QUERY_MS', 200)
+    if threshold is not None and seconds * 1000 >= threshold:
+        plan = None if executemany else _explain(connection, statement, parameters)
+        current_app.logger.warning(
+            f"Slow query ({seconds * 1000:.1f} ms): {statement} params={parameters!r} plan={plan}"
+        )
+
+
+def init_query_log(app):
+    """Record the queries of every request of app."""
+
+    @app.before_request
+    def _start_query_recording():
+        recorder = QueryRecorder()
+        _active_recorders().append(recorder)
+        g.query_recorder = recorder
+
+    @app.teardown_request
+    def _finish_query_recording(exception=None):
+        recorder = g.pop('query_recorder', None)
+        if recorder is None:
+            return
+        recorders = _active_recorders()
+        if recorder in recorders:
+            recorders.remove(recorder)
+        threshold = app.config.get('N_PLUS_ONE_THRESHOLD', 5)
+        for shape, count in recorder.repeated_shapes(threshold).items():
+            app.logger.warning(f"Possible N+1: {count} executions of {shape}")
@@ -0,0 +1,367 @@
+"""
+Saved-search alerts for new and changed listings.
+
+A saved search stores list filters (see services/filters.py). Each committed
+listing write is matched against the saved searches of this process without
+scanning them all. Every search is indexed under one of the columns it
+constrains, the most selective one in ANCHOR_COLUMNS:
+
+* equality criteria (city, state, zip code, property and listing type) go in
+  hash buckets keyed by value,
+* range criteria (price, square feet, bedrooms, bathrooms) go in interval
+  trees, where a stabbing query returns every range containing a value.
+
+A listing looks up its value in each bucket and tree. That gives the
+candidates in O(log n + k), and each candidate is then checked against its
+full criteria.
+
+Matching runs in the request that committed the write. Recording the alerts
+is queued to a background thread. The matcher is built from the database on
+first use and follows searches created and deleted through this process. It
+is rebuilt every SAVED_SEARCH_REFRESH_SECONDS to pick up changes made by
+other processes.
+"""
+
+import math
+import queue
+import threading
+import time
+from flask import current_app, has_app_context
+from sqlalchemy import select
+from models.property import db
+from models.saved_search import SavedSearch, SearchAlert
+from services.events import property_changed
+from services.filters import FILTER_FIELDS, matches_filters
+from services.metrics import metric_source
+
+# Columns a search is indexed under, most selective first
+ANCHOR_COLUMNS = ('zip_code', 'city', 'price', 'square_feet', 'state',
+                  'property_type', 'bedrooms', 'bathrooms', 'listing_type')
+
+EQUALITY_COLUMNS = tuple(sorted({column for _, column, op in FILTER_FIELDS.values() if op == 'eq'}))
+RANGE_COLUMNS = tuple(sorted({column for _, column, op in FILTER_FIELDS.values() if op != 'eq'}))
+
+CRITERIA_COLUMNS = frozenset(EQUALITY_COLUMNS + RANGE_COLUMNS)
+
+
+def criteria_bounds(criteria, column):
+    """Return the (low, high) range criteria places on a column, or None."""
+    low, high, constrained = -math.inf, math.inf, False
+    for name, value in criteria.items():
+        _, field_column, op = FILTER_FIELDS[name]
+        if field_column != column or op == 'eq':
+            continue
+        constrained = True
+        if op == 'ge':
+            low = max(low, value)
+        else:
+            high = min(high, value)
+    return (low, high) if constrained else None
+
+
+class IntervalTree:
+    """Static centered interval tree over closed intervals (low, high, value)."""
+
+    def __init__(self, intervals):
+        # Empty intervals (low > high) contain nothing and would never be placed
+        intervals = [interval for interval in intervals if interval[0] <= interval[1]]
+        self.size = len(intervals)
+        self._root = self._build(intervals)
+
+    @classmethod
+    def _build(cls, intervals):
+        if not intervals:
+            return None
+        endpoints = sorted(x for low, high, _ in intervals for x in (low, high))
+        # An endpoint belongs to its own interval, so every node holds at least one
+        center = endpoints[len(endpoints) // 2]
+        left, right, here = [], [], []
+        for interval in intervals:
+            if interval[1] < center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        by_low = sorted(((low, value) for low, _, value in here), key=lambda i: i[0])
+        by_high = sorted(((high, value) for _, high, value in here), key=lambda i: -i[0])
+        return (center, by_low, by_high, cls._build(left), cls._build(right))
+
+    def stab(self, x):
+        """Yield the value of every interval containing x."""
+        node = self._root
+        while node is not None:
+            center, by_low, by_high, left, right = node
+            if x < center:
+                for low, value in by_low:
+                    if low > x:
+                        break
+                    yield value
+                node = left
+            elif x > center:
+                for high, value in by_high:
+                    if high < x:
+                        break
+                    yield value
+                node = right
+            else:
+                for _, value in by_low:
+                    yield value
+                return
+
+
+class IntervalIndex:
+    """Interval tree with cheap updates: changes are kept aside until a rebuild."""
+
+    def __init__(self):
+        self._intervals = {}
+        self._tree = IntervalTree([])
+        self._pending = {}   # added since the last rebuild
+        self._stale = set()  # in the tree but removed or replaced since
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def add(self, key, low, high):
+        self.remove(key)
+        self._intervals[key] = self._pending[key] = (low, high)
+        self._maybe_rebuild()
+
+    def remove(self, key):
+        if self._intervals.pop(key, None) is None:
+            return
+        if self._pending.pop(key, None) is None:
+            self._stale.add(key)
+        self._maybe_rebuild()
+
+    def _maybe_rebuild(self):
+        if len(self._pending) + len(self._stale) > 32 + len(self._intervals) // 8:
+            self._tree = IntervalTree((low, high, key) for key, (low, high) in self._intervals.items())
+            self._pending.clear()
+            self._stale.clear()
+
+    def stab(self, x):
+        for key in self._tree.stab(x):
+            if key not in self._stale:
+                yield key
+        for key, (low, high) in self._pending.items():
+            if low <= x <= high:
+                yield key
+
+
+class SearchMatcher:
+    """Index of saved-search criteria answering 'which searches match this listing'."""
+
+    def __init__(self):
+        self._criteria = {}
+        self._anchors = {}
+        self._buckets = {column: {} for column in EQUALITY_COLUMNS}
+        self._ranges = {column: IntervalIndex() for column in RANGE_COLUMNS}
+        self._unanchored = set()
+
+    def __len__(self):
+        return len(self._criteria)
+
+    @staticmethod
+    def _anchor(criteria):
+        columns = {FILTER_FIELDS[name][1]: value for name, value in criteria.items()
+                   if FILTER_FIELDS[name][2] == 'eq'}
+        for column in ANCHOR_COLUMNS:
+            if column in columns:
+                return column, columns[column]
+            bounds = criteria_bounds(criteria, column)
+            if bounds is not None:
+                return column, bounds
+        return None
+
+    def add(self, search_id, criteria):
+        self.remove(search_id)
+        anchor = self._anchor(criteria)
+        self._criteria[search_id] = criteria
+        self._anchors[search_id] = anchor
+        if anchor is None:
+            self._unanchored.add(search_id)
+        elif anchor[0] in self._buckets:
+            self._buckets[anchor[0]].setdefault(anchor[1], set()).add(search_id)
+        else:
+            self._ranges[anchor[0]].add(search_id, *anchor[1])
+
+    def remove(self, search_id):
+        if self._criteria.pop(search_id, None) is None:
+            return
+        anchor = self._anchors.pop(search_id)
+        if anchor is None:
+            self._unanchored.discard(search_id)
+        elif anchor[0] in self._buckets:
+            bucket = self._buckets[anchor[0]]
+            bucket[anchor[1]].discard(search_id)
+            if not bucket[anchor[1]]:
+                del bucket[anchor[1]]
+        else:
+            self._ranges[anchor[0]].remove(search_id)
+
+    def match(self, data):
+        """Return the sorted ids of the searches a listing's columns satisfy."""
+        candidates = set(self._unanchored)
+        for column, bucket in self._buckets.items():
+            value = data.get(column)
+            if value is not None and value in bucket:
+                candidates.update(bucket[value])
+        for column, index in self._ranges.items():
+            value = data.get(column)
+            if value is not None:
+                candidates.update(index.stab(value))
+        return sorted(i for i in candidates if matches_filters(self._criteria[i], data))
+
+
+class SearchAlerts:
+    """Matches committed listing writes to saved searches and records the alerts."""
+
+    def __init__(self, app, refresh_seconds, queue_size):
+        self.app = app
+        self.refresh_seconds = refresh_seconds
+        self._matcher = None
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._worker = None
+        self.matches = 0
+        self.match_seconds = 0.0
+        self.max_match_seconds = 0.0
+        self.queued = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def _ensure_built(self):
+        if self._matcher is not None and time.monotonic() - self._built_at < self.refresh_seconds:
+            return
+        matcher = SearchMatcher()
+        # Runs after a commit, when the session cannot be used
+        with db.engine.connect() as connection:
+            for search_id, criteria in connection.execute(select(SavedSearch.id, SavedSearch.criteria)):
+                matcher.add(search_id, criteria)
+        self._matcher = matcher
+        self._built_at = time.monotonic()
+
+    def add(self, search):
+        with self._lock:
+            if self._matcher is not None:
+                self._matcher.add(search.id, search.criteria)
+
+    def remove(self, search_id):
+        with self._lock:
+            if self._matcher is not None:
+                self._matcher.remove(search_id)
+
+    def match(self, data):
+        with self._lock:
+            self._ensure_built()
+            started = time.perf_counter()
+            search_ids = self._matcher.match(data)
+            elapsed = time.perf_counter() - started
+            self.matches += 1
+            self.match_seconds += elapsed
+            self.max_match_seconds = max(self.max_match_seconds, elapsed)
+        return search_ids
+
+    def apply(self, change):
+        """Queue alerts for the searches a committed change newly matches."""
+        if change.action == 'created':
+            search_ids = self.match(change.data)
+        elif change.action == 'updated' and CRITERIA_COLUMNS.intersection(change.fields):
+            old = dict(change.data)
+            for field, (previous, _) in change.fields.items():
+                old[field] = previous
+            # Only searches the listing did not match before its change
+            search_ids = sorted(set(self.match(change.data)) - set(self.match(old)))
+        else:
+            return
+        if search_ids:
+            self._enqueue(change.id, search_ids)
+
+    def _enqueue(self, property_id, search_ids):
+        try:
+            self._queue.put_nowait((property_id, search_ids))
+        except queue.Full:
+            with self._lock:
+                self.dropped += len(search_ids)
+            self.app.logger.error(f"Alert queue full, dropped alerts for property {property_id}")
+            return
+        with self._lock:
+            self.queued += len(search_ids)
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='search-alerts', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            property_id, search_ids = self._queue.get()
+            try:
+                with self.app.app_context():
+                    self._deliver(property_id, search_ids)
+            except Exception as e:
+                self.failed += len(search_ids)
+                self.app.logger.error(f"Error recording alerts for property {property_id}: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, property_id, search_ids):
+        # Searches may have been deleted or alerted since they were matched
+        live = set(db.session.scalars(select(SavedSearch.id).where(SavedSearch.id.in_(search_ids))))
+        sent = set(db.session.scalars(select(SearchAlert.search_id).where(
+            SearchAlert.property_id == property_id, SearchAlert.search_id.in_(search_ids))))
+        new = [search_id for search_id in search_ids if search_id in live and search_id not in sent]
+        if not new:
+            return
+        db.session.add_all(SearchAlert(search_id=search_id, property_id=property_id) for search_id in new)
+        db.session.commit()
+        self.delivered += len(new)
+        for search_id in new:
+            self.app.logger.info(f"Saved search {search_id} matched property {property_id}")
+
+    def wait(self):
+        """Block until every queued alert has been recorded."""
+        self._queue.join()
+
+    def metrics(self):
+        with self._lock:
+            searches = len(self._matcher) if self._matcher is not None else None
+        return {
+            'searches': searches,
+            'matches': self.matches,
+            'avg_match_ms': self.match_seconds / self.matches * 1000 if self.matches else 0.0,
+            'max_match_ms': self.max_match_seconds * 1000,
+            'queued': self.queued,
+            'queue_depth': self._queue.qsize(),
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+
+def get_search_alerts(app=None):
+    """Return the saved-search alerts of the given (or current) application."""
+    app = app or current_app._get_current_object()
+    alerts = app.extensions.get('search_alerts')
+    if alerts is None:
+        alerts = app.extensions.setdefault('search_alerts', SearchAlerts(
+            app,
+            refresh_seconds=app.config.get('SAVED_SEARCH_REFRESH_SECONDS', 60),
+            queue_size=app.config.get('SAVED_SEARCH_QUEUE_SIZE', 10000),
+        ))
+    return alerts
+
+
+@property_changed.connect
+def _match_on_write(sender, changes):
+    if not has_app_context():
+        return
+    alerts = get_search_alerts()
+    for change in changes:
+        alerts.apply(change)
+
+
+@metric_source('saved_searches')
+def _saved_search_metrics(app):
+    return get_search_alerts(app).metrics()
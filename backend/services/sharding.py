@@ -0,0 +1,277 @@
+"""
+Horizontal sharding of listings by state.
+
+PROPERTY_SHARDS names the shard databases in order and PROPERTY_SHARD_STATES
+assigns states to them; states not listed belong to the first shard:
+
+    PROPERTY_SHARDS=west=sqlite:///shard_west.db;east=sqlite:///shard_east.db
+    PROPERTY_SHARD_STATES=west=CA,OR,WA;east=NY,NJ,FL
+
+With shards configured, the property endpoints go through the ShardRouter:
+
+* a listing id encodes its shard (``id % SHARD_ID_STRIDE`` is the shard's
+  position), so detail reads, updates and deletes go straight to one shard,
+* creates go to the shard owning the listing's state,
+* list queries run on every shard concurrently, or only on the owning shard
+  when filtered by state. Each shard returns its first ``page * per_page``
+  rows in page order and the sorted results are merged, which keeps pages
+  exactly the same as with a single database.
+
+Indexes built over all listings (similar homes, autocomplete, duplicates) load
+them with ``scatter_all``, and features that keep listing ids elsewhere (price
+drops, saved-search alerts) read the listings back with ``get_listings``.
+
+A shard's position in PROPERTY_SHARDS is part of every id created on it, so
+shards may be appended but never reordered. Every shard holds the full schema;
+a listing's images and price history live on its shard. Without
+PROPERTY_SHARDS, listings stay in the main database.
+"""
+
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from flask import current_app, g
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from models.property import Property, db
+from services.database import create_profiled_engine, pool_metrics, upgrade_schema
+from services.facets import compute_facets
+from services.filters import apply_filters, apply_sort, sort_key
+from services.metrics import metric_source
+
+# Upper bound on the number of shards; ids step by this much within a shard
+SHARD_ID_STRIDE = 64
+
+# Attempts at inserting with a fresh id when a concurrent create took it
+INSERT_ATTEMPTS = 3
+
+# Default scatter threads per shard. The pool is shared by every request, so it
+# must cover concurrent fan-outs, not one request's shards; this matches one
+# shard engine's default pool (DB_POOL_SIZE 5 plus DB_MAX_OVERFLOW 10) plus one
+WORKERS_PER_SHARD = 16
+
+
+def parse_shards(value):
+    """Parse 'name=url;name=url' into an ordered list of (name, url)."""
+    shards = []
+    for item in (value or '').split(';'):
+        if item.strip():
+            name, url = item.split('=', 1)
+            shards.append((name.strip(), url.strip()))
+    return shards
+
+
+def parse_shard_states(value):
+    """Parse 'name=ST,ST;name=ST' into {state: shard name}."""
+    states = {}
+    for item in (value or '').split(';'):
+        if item.strip():
+            name, codes = item.split('=', 1)
+            for code in codes.split(','):
+                if code.strip():
+                    states[code.strip().upper()] = name.strip()
+    return states
+
+
+class ShardRouter:
+    """Routes listing reads and writes to the shard databases."""
+
+    def __init__(self, shards, states, max_workers=None):
+        if not shards or len(shards) > SHARD_ID_STRIDE:
+            raise ValueError(f'Between 1 and {SHARD_ID_STRIDE} shards are supported')
+        self.names = [name for name, _ in shards]
+        self.engines = dict(shards)
+        unknown = set(states.values()) - set(self.names)
+        if unknown:
+            raise ValueError(f'States assigned to unknown shards: {sorted(unknown)}')
+        self._states = states
+        self._sessionmakers = {name: sessionmaker(bind=engine) for name, engine in shards}
+        self.max_workers = max_workers or WORKERS_PER_SHARD * len(shards)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='shard')
+        self._lock = threading.Lock()
+        self.queries = {name: 0 for name in self.names}
+        self.scatters = 0
+        self.pruned = 0
+        self.scatter_seconds = 0.0
+
+    def create_all(self):
+        """Create the schema on every shard and add columns missing from older ones."""
+        for engine in self.engines.values():
+            db.metadata.create_all(engine)
+            upgrade_schema(engine, db.metadata)
+
+    def shard_for_state(self, state):
+        return self._states.get((state or '').upper(), self.names[0])
+
+    def shard_for_id(self, id):
+        """Return the shard a listing id belongs to, or None for ids of no shard."""
+        index = id % SHARD_ID_STRIDE
+        return self.names[index] if index < len(self.names) else None
+
+    def session(self, name):
+        """Return this request's session on a shard."""
+        sessions = g.setdefault('shard_sessions', {})
+        if name not in sessions:
+            sessions[name] = self._sessionmakers[name]()
+        return sessions[name]
+
+    def close_sessions(self, exception=None):
+        for session in g.pop('shard_sessions', {}).values():
+            session.close()
+
+    def insert(self, property):
+        """Add a new listing to the shard of its state with an id encoding that shard."""
+        name = self.shard_for_state(property.state)
+        index = self.names.index(name)
+        session = self.session(name)
+        for attempt in range(INSERT_ATTEMPTS):
+            highest = session.query(func.max(Property.id)).scalar() or 0
+            property.id = (highest // SHARD_ID_STRIDE + 1) * SHARD_ID_STRIDE + index
+            session.add(property)
+            try:
+                session.commit()
+                return property
+            except IntegrityError:
+                # Another create took the id; the rollback expunges the listing
+                session.rollback()
+                if attempt == INSERT_ATTEMPTS - 1:
+                    raise
+
+    def _run(self, name, func):
+        with self._sessionmakers[name]() as session:
+            return func(session)
+
+    def scatter(self, filters, func):
+        """Run func(session) on the shards filters can match, concurrently.
+
+        Returns the results in shard order.
+        """
+        names = [self.shard_for_state(filters['state'])] if 'state' in filters else self.names
+        started = time.perf_counter()
+        futures = [self._executor.submit(self._run, name, func) for name in names]
+        results = [future.result() for future in futures]
+        with self._lock:
+            self.scatters += 1
+            self.pruned += len(self.names) - len(names)
+            self.scatter_seconds += time.perf_counter() - started
+            for name in names:
+                self.queries[name] += 1
+        return results
+
+    def list_page(self, filters, page, per_page, sort=None):
+        """Return (listings as dicts, total) for a page of the filtered listings.
+
+        Listings are in id order, or in the order apply_sort gives for sort.
+        """
+        limit = page * per_page
+
+        def fetch(session):
+            query = apply_filters(session.query(Property), filters)
+            total = query.count()
+            rows = apply_sort(query, sort).limit(limit).all()
+            return total, [(sort_key(sort, p.id, getattr(p, sort[0]) if sort else None), p.to_dict())
+                           for p in rows]
+
+        results = self.scatter(filters, fetch)
+        total = sum(count for count, _ in results)
+        merged = heapq.merge(*(rows for _, rows in results), key=lambda row: row[0])
+        return [data for _, data in islice(merged, limit - per_page, limit)], total
+
+    def facets(self, filters, names):
+        """Facet counts summed over the shards."""
+        facets = {name: {} for name in names}
+        for shard_facets in self.scatter(filters, lambda session: compute_facets(filters, names, session)):
+            for name, counts in shard_facets.items():
+                for label, count in counts.items():
+                    facets[name][label] = facets[name].get(label, 0) + count
+        return facets
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'enabled': True,
+                'workers': self.max_workers,
+                'scatters': self.scatters,
+                'pruned_shards': self.pruned,
+                'avg_scatter_ms': self.scatter_seconds / self.scatters * 1000 if self.scatters else 0.0,
+                'shards': {name: {
+                    'queries': self.queries[name],
+                    **pool_metrics(self.engines[name]),
+                } for name in self.names},
+            }
+
+
+def get_shard_router(app=None):
+    """Return the shard router of the given (or current) application, or None."""
+    app = app or current_app
+    router = app.extensions.get('shard_router')
+    if router is None:
+        shards = parse_shards(app.config.get('PROPERTY_SHARDS'))
+        if not shards:
+            return None
+        router = app.extensions.setdefault('shard_router', ShardRouter(
+            [(name, create_profiled_engine(url)) for name, url in shards],
+            parse_shard_states(app.config.get('PROPERTY_SHARD_STATES')),
+            max_workers=app.config.get('PROPERTY_SHARD_WORKERS') or None,
+        ))
+    return router
+
+
+def session_for_id(id):
+    """Return the session holding listing id, or None if no shard can hold it."""
+    router = get_shard_router()
+    if router is None:
+        return db.session
+    name = router.shard_for_id(id)
+    return router.session(name) if name is not None else None
+
+
+def get_listing(id):
+    """Return (session, listing) for a listing id; the listing is None if not found."""
+    session = session_for_id(id)
+    return session, (session.get(Property, id) if session is not None else None)
+
+
+def get_listings(ids):
+    """Return {id: listing} for the listings of ids that exist, each read from its shard."""
+    if not ids:
+        return {}
+    router = get_shard_router()
+    if router is None:
+        return {p.id: p for p in Property.query.filter(Property.id.in_(ids))}
+    by_shard = {}
+    for id in ids:
+        name = router.shard_for_id(id)
+        if name is not None:
+            by_shard.setdefault(name, []).append(id)
+    found = {}
+    for name, shard_ids in by_shard.items():
+        found.update((p.id, p) for p in router.session(name).query(Property).filter(Property.id.in_(shard_ids)))
+    return found
+
+
+def scatter_all(func):
+    """Run func(session) on every database holding listings; return the results in order."""
+    router = get_shard_router()
+    if router is None:
+        return [func(db.session)]
+    return router.scatter({}, func)
+
+
+def init_sharding(app):
+    """Close the shard sessions a request opened when it ends."""
+
+    @app.teardown_appcontext
+    def _close_shard_sessions(exception=None):
+        router = app.extensions.get('shard_router')
+        if router is not None:
+            router.close_sessions(exception)
+
+
+@metric_source('shards')
+def _shard_metrics(app):
+    router = get_shard_router(app)
+    return router.metrics() if router is not None else {'enabled': False}
@@ -0,0 +1,360 @@
+"""
+"Similar homes" recommendations.
+
+Listings are embedded as rows of a float32 feature matrix: standardized log
+price, bedrooms, bathrooms and log square footage, latitude/longitude scaled
+so that LOCATION_SCALE_KM counts as one unit, and a one-hot property type.
+Nearest neighbours are found with one matrix-vector product per query
+(``|x - q|^2 = |x|^2 - 2 x.q + |q|^2`` with the row norms precomputed) and
+``argpartition``. Rows are sorted by listing type and then by a grid cell of
+SIMILARITY_CELL_DEGREES, so a query only scans contiguous slices: the 3x3
+block of cells around the listing, widened ring by ring until enough
+candidates are found. Listings without coordinates are compared against their
+whole listing type.
+
+The matrix is written as a snapshot of ``.npy`` files and opened with
+``mmap_mode='r'``, so every worker process shares one copy through the page
+cache. Writes after the snapshot are kept in a small per-process overlay:
+changed rows are hidden in the snapshot and searched in the overlay instead.
+Once the overlay grows past SIMILARITY_MAX_OVERLAY rows the snapshot is rebuilt
+in the background, and other workers pick the new one up on their next query.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+import numpy as np
+from flask import current_app, has_app_context
+from models.property import Property
+from services.events import property_changed
+from services.sharding import scatter_all
+from services.snapshots import META_NAME, BackgroundBuild, WriteOverlay, publish_snapshot, snapshot_version
+
+# Kilometres that weigh as much as one standard deviation of the other features
+LOCATION_SCALE_KM = 25.0
+KM_PER_DEGREE = 111.2
+
+# column -> (log transform, weight)
+NUMERIC_FEATURES = {
+    'price': (True, 2.0),
+    'bedrooms': (False, 1.0),
+    'bathrooms': (False, 1.0),
+    'square_feet': (True, 1.0),
+}
+
+FEATURE_COLUMNS = ('id', 'price', 'bedrooms', 'bathrooms', 'square_feet',
+                   'latitude', 'longitude', 'property_type', 'listing_type')
+
+
+def _as_float(values):
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+class FeatureEncoder:
+    """Maps listing columns to feature vectors with fixed scaling statistics."""
+
+    def __init__(self, stats, property_types):
+        self.stats = stats                      # column -> (mean, std) after transform
+        self.property_types = property_types    # one-hot vocabulary
+        self._type_index = {t: i for i, t in enumerate(property_types)}
+        self.dimensions = len(NUMERIC_FEATURES) + 2 + len(property_types)
+
+    @classmethod
+    def fit(cls, columns):
+        stats = {}
+        for name, (log, _) in NUMERIC_FEATURES.items():
+            values = _as_float(columns[name])
+            if log:
+                values = np.log1p(np.maximum(values, 0))
+            finite = values[np.isfinite(values)]
+            mean = float(finite.mean()) if finite.size else 0.0
+            std = float(finite.std()) if finite.size else 1.0
+            stats[name] = (mean, std or 1.0)
+        for name in ('latitude', 'longitude'):
+            finite = _as_float(columns[name])
+            finite = finite[np.isfinite(finite)]
+            stats[name] = (float(finite.mean()) if finite.size else 0.0, None)
+        property_types = sorted({t for t in columns['property_type'] if t})
+        return cls(stats, property_types)
+
+    def encode(self, columns):
+        """Encode a dict of equal-length column lists into an (n, d) float32 matrix."""
+        n = len(columns['id'])
+        matrix = np.zeros((n, self.dimensions), dtype=np.float32)
+        for i, (name, (log, weight)) in enumerate(NUMERIC_FEATURES.items()):
+            values = _as_float(columns[name])
+            if log:
+                values = np.log1p(np.maximum(values, 0))
+            mean, std = self.stats[name]
+            values = (values - mean) / std * weight
+            # Unknown values sit at the mean and neither attract nor repel
+            matrix[:, i] = np.nan_to_num(values, nan=0.0)
+
+        latitude = _as_float(columns['latitude'])
+        longitude = _as_float(columns['longitude'])
+        latitude = np.where(np.isfinite(latitude), latitude, self.stats['latitude'][0])
+        longitude = np.where(np.isfinite(longitude), longitude, self.stats['longitude'][0])
+        scale = LOCATION_SCALE_KM / KM_PER_DEGREE
+        column = len(NUMERIC_FEATURES)
+        matrix[:, column] = (latitude - self.stats['latitude'][0]) / scale
+        matrix[:, column + 1] = ((longitude - self.stats['longitude'][0])
+                                 * np.cos(np.radians(latitude)) / scale)
+
+        offset = column + 2
+        for row, property_type in enumerate(columns['property_type']):
+            index = self._type_index.get(property_type)
+            if index is not None:
+                matrix[row, offset + index] = 1.0
+        return matrix
+
+    def to_json(self):
+        return {'stats': self.stats, 'property_types': self.property_types}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls({k: tuple(v) for k, v in data['stats'].items()}, data['property_types'])
+
+
+def _load_columns(query):
+    columns = {name: [] for name in FEATURE_COLUMNS}
+    for row in query.yield_per(10000):
+        for name, value in zip(FEATURE_COLUMNS, row):
+            columns[name].append(value)
+    return columns
+
+
+def _row_columns(data):
+    return {name: [data.get(name)] for name in FEATURE_COLUMNS}
+
+
+def _nearest(matrix, norms, ids, query, query_norm, count):
+    """Return (ids, squared distances) of the count rows closest to query."""
+    if len(ids) == 0 or count <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    distances = norms - 2.0 * (matrix @ query) + query_norm
+    count = min(count, len(ids))
+    if count < len(ids):
+        candidates = np.argpartition(distances, count - 1)[:count]
+    else:
+        candidates = np.arange(len(ids))
+    return np.asarray(ids[candidates]), distances[candidates]
+
+
+class SimilarityIndex:
+    """Memory-mapped k-NN index over listings with an in-process write overlay."""
+
+    def __init__(self, path, max_overlay=1000, cell_degrees=0.25):
+        self.path = path
+        self.max_overlay = max_overlay
+        self.cell_degrees = cell_degrees
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._builder = BackgroundBuild('similarity index')
+        self._snapshot = None
+        self._meta_mtime = None
+        self._overlay = WriteOverlay()   # values are (listing_type, vector)
+
+    def _cell(self, latitude, longitude):
+        if latitude is None or longitude is None:
+            return None
+        return math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees)
+
+    # Snapshot files
+
+    def _meta_path(self):
+        return os.path.join(self.path, META_NAME)
+
+    def build(self):
+        """Read all listings, write a new snapshot and switch to it."""
+        built_at = time.time()
+        parts = scatter_all(lambda session: _load_columns(
+            session.query(*[getattr(Property, c) for c in FEATURE_COLUMNS])))
+        columns = {name: [value for part in parts for value in part[name]] for name in FEATURE_COLUMNS}
+        encoder = FeatureEncoder.fit(columns)
+
+        # Sort rows by listing type, then grid cell, so each cell is a contiguous slice
+        groups = [t or '' for t in columns['listing_type']]
+        cells = [self._cell(lat, lng) for lat, lng in zip(columns['latitude'], columns['longitude'])]
+        order = sorted(range(len(groups)), key=lambda i: (groups[i], cells[i] is None, cells[i] or (0, 0)))
+        matrix = encoder.encode(columns)[order]
+        ids = np.array(columns['id'], dtype=np.int64)[order]
+        slices = {}
+        for position, i in enumerate(order):
+            group = slices.setdefault(groups[i], {})
+            key = 'none' if cells[i] is None else f'{cells[i][0]},{cells[i][1]}'
+            if key not in group:
+                group[key] = [position, position]
+            group[key][1] = position + 1
+
+        version = snapshot_version(built_at)
+        os.makedirs(self.path, exist_ok=True)
+        np.save(os.path.join(self.path, f'features-{version}.npy'), matrix)
+        np.save(os.path.join(self.path, f'norms-{version}.npy'), (matrix * matrix).sum(axis=1))
+        np.save(os.path.join(self.path, f'ids-{version}.npy'), ids)
+        meta = {'version': version, 'built_at': built_at, 'groups': slices, 'encoder': encoder.to_json()}
+        # A newer snapshot from another worker wins; it is picked up instead
+        self._refresh(force=publish_snapshot(self.path, meta))
+
+    def _refresh(self, force=False):
+        """Map the current snapshot if it changed since it was last opened."""
+        try:
+            mtime = os.stat(self._meta_path()).st_mtime_ns
+        except OSError:
+            return False
+        if not force and mtime == self._meta_mtime:
+            return True
+        with open(self._meta_path()) as f:
+            meta = json.load(f)
+        version = meta['version']
+        snapshot = {
+            'matrix': np.load(os.path.join(self.path, f'features-{version}.npy'), mmap_mode='r'),
+            'norms': np.load(os.path.join(self.path, f'norms-{version}.npy'), mmap_mode='r'),
+            'ids': np.load(os.path.join(self.path, f'ids-{version}.npy'), mmap_mode='r'),
+            'groups': {group: self._parse_cells(cells) for group, cells in meta['groups'].items()},
+            'encoder': FeatureEncoder.from_json(meta['encoder']),
+            'built_at': meta['built_at'],
+        }
+        with self._lock:
+            self._snapshot = snapshot
+            self._meta_mtime = mtime
+            self._overlay.prune(snapshot['built_at'])
+        return True
+
+    @staticmethod
+    def _parse_cells(cells):
+        """Index the cell slices of one group by (lat, lng) cell coordinates."""
+        parsed = {tuple(map(int, key.split(','))): tuple(bounds)
+                  for key, bounds in cells.items() if key != 'none'}
+        starts = [bounds[0] for bounds in cells.values()]
+        stops = [bounds[1] for bounds in cells.values()]
+        lats = [lat for lat, _ in parsed] or [0]
+        lngs = [lng for _, lng in parsed] or [0]
+        return {
+            'cells': parsed,
+            'all': (min(starts), max(stops)),
+            'bounds': (min(lats), max(lats), min(lngs), max(lngs)),
+        }
+
+    def ensure_loaded(self):
+        if self._refresh():
+            return
+        with self._build_lock:
+            if not self._refresh():
+                self.build()
+
+    # Writes
+
+    def apply(self, change):
+        """Record a committed property change in the overlay."""
+        now = time.time()
+        # Without a snapshot the first query builds one that includes this change
+        if self._snapshot is None and not self._refresh():
+            return False
+        with self._lock:
+            value = None
+            if change.action != 'deleted':
+                vector = self._snapshot['encoder'].encode(_row_columns(change.data))[0]
+                value = (change.data.get('listing_type') or '', vector)
+            self._overlay.put(change.id, value, now)
+            return len(self._overlay) > self.max_overlay and not self._builder.running
+
+    def rebuild_in_background(self, app):
+        self._builder.start(app, self.build)
+
+    def wait(self, timeout=None):
+        """Block until a rebuild in progress has finished."""
+        self._builder.wait(timeout)
+
+    # Queries
+
+    def _candidate_slices(self, group, data, needed):
+        """Return the (start, stop) slices of the group to compare against."""
+        if group is None:
+            return []
+        cell = self._cell(data['latitude'], data['longitude'])
+        if cell is None or not group['cells']:
+            return [group['all']]
+        min_lat, max_lat, min_lng, max_lng = group['bounds']
+        max_radius = max(cell[0] - min_lat, max_lat - cell[0], cell[1] - min_lng, max_lng - cell[1])
+
+        radius = 1
+        while True:
+            slices = []
+            for lat in range(cell[0] - radius, cell[0] + radius + 1):
+                for lng in range(cell[1] - radius, cell[1] + radius + 1):
+                    bounds = group['cells'].get((lat, lng))
+                    if bounds is None:
+                        continue
+                    # Neighbouring cells of one grid row are adjacent in the matrix
+                    if slices and slices[-1][1] == bounds[0]:
+                        slices[-1] = (slices[-1][0], bounds[1])
+                    else:
+                        slices.append(bounds)
+            if sum(stop - start for start, stop in slices) >= needed or radius >= max_radius:
+                return slices
+            radius *= 2
+
+    def similar(self, property, k):
+        """Return up to k ids of the listings most similar to property, nearest first."""
+        self.ensure_loaded()
+        with self._lock:
+            snapshot = self._snapshot
+            overlay, hidden = self._overlay.copy()
+
+        data = {name: getattr(property, name) for name in FEATURE_COLUMNS}
+        group = data['listing_type'] or ''
+        query = snapshot['encoder'].encode(_row_columns(data))[0]
+        query_norm = float(query @ query)
+
+        found_ids, found_distances = [], []
+        needed = k + 1 + len(hidden)
+        for start, stop in self._candidate_slices(snapshot['groups'].get(group), data, needed):
+            # Over-fetch by the number of hidden rows, which may all be near
+            ids, distances = _nearest(snapshot['matrix'][start:stop], snapshot['norms'][start:stop],
+                                      snapshot['ids'][start:stop], query, query_norm, needed)
+            keep = [i for i, id_ in enumerate(ids.tolist()) if id_ not in hidden]
+            found_ids.append(ids[keep])
+            found_distances.append(distances[keep])
+
+        overlay = [(id_, vector) for id_, (g, vector) in overlay.items() if g == group]
+        if overlay:
+            matrix = np.stack([vector for _, vector in overlay])
+            ids, distances = _nearest(matrix, (matrix * matrix).sum(axis=1),
+                                      np.array([id_ for id_, _ in overlay], dtype=np.int64),
+                                      query, query_norm, k + 1)
+            found_ids.append(ids)
+            found_distances.append(distances)
+
+        if not found_ids:
+            return []
+        ids = np.concatenate(found_ids)
+        distances = np.concatenate(found_distances)
+        ranked = ids[np.argsort(distances, kind='stable')].tolist()
+        return [id_ for id_ in ranked if id_ != property.id][:k]
+
+
+def get_similarity_index(app=None):
+    """Return the similarity index of the given (or current) application."""
+    app = app or current_app
+    index = app.extensions.get('similarity_index')
+    if index is None:
+        index = app.extensions.setdefault('similarity_index', SimilarityIndex(
+            path=os.path.abspath(app.config.get('SIMILARITY_INDEX_PATH', 'media/similarity')),
+            max_overlay=app.config.get('SIMILARITY_MAX_OVERLAY', 1000),
+            cell_degrees=app.config.get('SIMILARITY_CELL_DEGREES', 0.25),
+        ))
+    return index
+
+
+@property_changed.connect
+def _update_on_write(sender, changes):
+    if not has_app_context():
+        return
+    index = get_similarity_index()
+    rebuild = False
+    for change in changes:
+        rebuild = index.apply(change) or rebuild
+    if rebuild:
+        index.rebuild_in_background(current_app._get_current_object())
@@ -0,0 +1,159 @@
+"""
+Single-flight coalescing of identical concurrent reads.
+
+When many requests ask for the same thing at once (a listing that goes viral),
+only the first one, the leader, runs the read; the others wait for its result
+instead of each querying the database and serializing the same rows. Calls
+are identified by a key built from the normalized route and parameters.
+
+What is shared is the serialized response body and status, never ORM objects:
+those belong to the leader's session and thread. An exception raised by the
+leader is re-raised in every waiting request. A waiter gives up after
+SINGLE_FLIGHT_TIMEOUT_MS with SingleFlightTimeout; the leader keeps running.
+
+Keys are forgotten as soon as their call finishes, so nothing is cached. A
+committed property change also detaches every call in flight, so a read that
+starts after a write never joins one that started before it.
+
+Per-group call, execution, shared and timeout counts are reported under
+``single_flight`` in ``GET /api/metrics``.
+"""
+
+import threading
+from flask import current_app, has_app_context
+from services.events import property_changed
+from services.metrics import metric_source
+
+
+class SingleFlightTimeout(Exception):
+    """Raised when a waiting call does not get its result in time."""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class _GroupStats:
+    def __init__(self):
+        self.calls = 0
+        self.executions = 0
+        self.shared = 0
+        self.timeouts = 0
+        self.errors = 0
+
+
+class SingleFlight:
+    """Run at most one call per key at a time and share its result."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._calls = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def do(self, group, key, func):
+        """Return func(), or the result of the identical call already in flight."""
+        with self._lock:
+            stats = self._stats.setdefault(group, _GroupStats())
+            stats.calls += 1
+            call = self._calls.get((group, key))
+            leader = call is None
+            if leader:
+                call = self._calls[(group, key)] = _Call()
+                stats.executions += 1
+            else:
+                call.waiters += 1
+
+        if leader:
+            try:
+                call.result = func()
+            except BaseException as e:
+                call.error = e
+                with self._lock:
+                    stats.errors += 1
+                raise
+            finally:
+                with self._lock:
+                    # A write may already have detached this call
+                    if self._calls.get((group, key)) is call:
+                        del self._calls[(group, key)]
+                call.done.set()
+            return call.result
+
+        if not call.done.wait(self.timeout):
+            with self._lock:
+                call.waiters -= 1
+                stats.timeouts += 1
+            raise SingleFlightTimeout(f'Timed out waiting for {group} {key!r}')
+        with self._lock:
+            stats.shared += 1
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def forget(self):
+        """Detach all calls in flight; later callers start new ones."""
+        with self._lock:
+            self._calls.clear()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def waiting(self, group, key):
+        """Return how many callers are waiting on the call for key."""
+        with self._lock:
+            call = self._calls.get((group, key))
+            return call.waiters if call is not None else 0
+
+    def metrics(self):
+        with self._lock:
+            groups = {group: {
+                'calls': stats.calls,
+                'executions': stats.executions,
+                'shared': stats.shared,
+                'timeouts': stats.timeouts,
+                'errors': stats.errors,
+                'coalescing_ratio': stats.shared / stats.calls if stats.calls else 0.0,
+            } for group, stats in self._stats.items()}
+            in_flight = len(self._calls)
+        return {'in_flight': in_flight, 'groups': groups}
+
+
+def get_single_flight(app=None):
+    """Return the single-flight group of the given (or current) application."""
+    app = app or current_app
+    flight = app.extensions.get('single_flight')
+    if flight is None:
+        flight = app.extensions.setdefault('single_flight', SingleFlight(
+            timeout=app.config.get('SINGLE_FLIGHT_TIMEOUT_MS', 5000) / 1000
+        ))
+    return flight
+
+
+def coalesced_response(group, key, build):
+    """Return a response for build(), sharing one build among identical requests.
+
+    build returns a response (or a (response, status) pair) as a view would.
+    """
+    def render():
+        response = current_app.make_response(build())
+        return response.get_data(), response.status_code, response.mimetype
+
+    body, status, mimetype = get_single_flight().do(group, key, render)
+    return current_app.response_class(body, status=status, mimetype=mimetype)
+
+
+@property_changed.connect
+def _forget_on_write(sender, changes):
+    if has_app_context():
+        get_single_flight().forget()
+
+
+@metric_source('single_flight')
+def _single_flight_metrics(app):
+    return get_single_flight(app).metrics()
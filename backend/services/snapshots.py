@@ -0,0 +1,167 @@
+"""
+Index snapshots: publishing, background rebuilds and write overlays.
+
+The similarity index and the column engine write a snapshot as versioned
+``<name>-<version>.npy`` files plus a ``meta.json`` that names the current
+version, and every worker maps the files meta.json points to. Several workers
+may build at once, so publishing a snapshot takes a lock file, never replaces a
+newer snapshot with an older one, and only removes the files of versions older
+than the snapshot it replaces: workers may still be loading that one, and other
+builds may still be writing newer ones.
+
+Indexes rebuild their snapshot with a BackgroundBuild, one build at a time off
+the request path, and keep the writes made since it was built in a
+WriteOverlay.
+"""
+
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: concurrent builds are not coordinated
+    fcntl = None
+
+META_NAME = 'meta.json'
+LOCK_NAME = 'build.lock'
+
+
+def snapshot_version(built_at):
+    """Return the version name of a snapshot built at the given epoch time."""
+    return f'{int(built_at * 1000)}-{os.getpid()}'
+
+
+def _version_time(version):
+    return int(version.split('-', 1)[0])
+
+
+def read_meta(path):
+    """Return the meta of the current snapshot in path, or None if there is none."""
+    try:
+        with open(os.path.join(path, META_NAME)) as f:
+            return json.load(f)
+    except OSError:
+        return None
+
+
+@contextmanager
+def _locked(path):
+    with open(os.path.join(path, LOCK_NAME), 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _remove_files(path, stale):
+    for name in os.listdir(path):
+        if not name.endswith('.npy') or '-' not in name:
+            continue
+        version = name[:-len('.npy')].split('-', 1)[1]
+        try:
+            if stale(version):
+                os.remove(os.path.join(path, name))
+        except (OSError, ValueError):
+            pass
+
+
+def publish_snapshot(path, meta):
+    """Make meta, whose files are already written, the current snapshot of path.
+
+    Returns False, and removes the files of meta, if a newer snapshot has been
+    published in the meantime.
+    """
+    version = meta['version']
+    with _locked(path):
+        previous = read_meta(path)
+        if previous is not None and previous['built_at'] > meta['built_at']:
+            _remove_files(path, lambda v: v == version)
+            return False
+
+        fd, temp_path = tempfile.mkstemp(dir=path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, os.path.join(path, META_NAME))
+
+        if previous is not None:
+            cutoff = _version_time(previous['version'])
+            _remove_files(path, lambda v: v != version and _version_time(v) < cutoff)
+    return True
+
+
+class BackgroundBuild:
+    """Runs an index build in a daemon thread, at most one at a time."""
+
+    def __init__(self, name):
+        self.name = name
+        self.running = False
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, app, build):
+        """Run build() in the context of app unless a build is running; return whether it started."""
+        with self._lock:
+            if self.running:
+                return False
+            self.running = True
+
+        def _run():
+            try:
+                with app.app_context():
+                    build()
+            except Exception as e:
+                app.logger.error(f"Error building {self.name}: {str(e)}")
+            finally:
+                self.running = False
+
+        self._thread = threading.Thread(target=_run, daemon=True)
+        self._thread.start()
+        return True
+
+    def wait(self, timeout=None):
+        """Block until a build in progress has finished."""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+
+class WriteOverlay:
+    """The listings written since a snapshot was built, by epoch time of the write.
+
+    ``entries`` maps each written listing that still exists to (changed_at,
+    value), where value is whatever the index needs to search it. ``hidden``
+    maps every written id, deleted ones included, to changed_at: their rows in
+    the snapshot are out of date. Callers hold their own lock.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.hidden = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, id_, value, changed_at):
+        """Record a write of id_, with value None for a delete; return the value it replaces."""
+        self.hidden[id_] = changed_at
+        previous = self.entries.pop(id_, None)
+        if value is not None:
+            self.entries[id_] = (changed_at, value)
+        return previous[1] if previous is not None else None
+
+    def prune(self, built_at):
+        """Drop the writes a snapshot built at built_at already contains; return (id, value) of each."""
+        stale = [id_ for id_, (changed_at, _) in self.entries.items() if changed_at < built_at]
+        removed = [(id_, self.entries.pop(id_)[1]) for id_ in stale]
+        self.hidden = {id_: changed_at for id_, changed_at in self.hidden.items() if changed_at >= built_at}
+        return removed
+
+    def copy(self):
+        """Return ({id: value}, set of hidden ids) for a search to use without the lock."""
+        return {id_: value for id_, (_, value) in self.entries.items()}, set(self.hidden)
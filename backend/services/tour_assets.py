@@ -0,0 +1,204 @@
+"""
+Virtual-tour asset storage and byte-range serving.
+
+Panoramas and 3D tour files live on disk under ``<TOUR_ASSET_PATH>/<property id>/``.
+An in-memory integrity index maps (property id, file name) to the file's size,
+modification time and sha256, so a lookup is a dict access plus one ``stat``
+to detect replaced files. The hashes are persisted in a manifest next to the
+assets and are only recomputed for files that changed.
+
+Responses avoid copying file contents through Python where the server allows
+it: full and single-range responses hand an open file, positioned at the start
+of the range, to the server's ``wsgi.file_wrapper`` (gunicorn sends it with
+``sendfile``). Without a file wrapper, and for multi-range responses, the body
+is streamed from a memory map in bounded chunks.
+"""
+
+import base64
+import hashlib
+import json
+import mmap
+import os
+import re
+import tempfile
+import threading
+from collections import namedtuple
+from flask import current_app
+
+# File names only; assets are never served from nested or hidden paths
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]{0,199}$')
+
+MANIFEST_NAME = '.manifest.json'
+
+CHUNK_SIZE = 256 * 1024
+
+AssetEntry = namedtuple('AssetEntry', ['path', 'size', 'mtime_ns', 'sha256'])
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AssetIndex:
+    """O(1) lookup of tour assets with their content hashes."""
+
+    def __init__(self, root):
+        self.root = root
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._load_manifest()
+
+    def _manifest_path(self):
+        return os.path.join(self.root, MANIFEST_NAME)
+
+    def _load_manifest(self):
+        try:
+            with open(self._manifest_path()) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        for key, (size, mtime_ns, sha256) in manifest.items():
+            property_id, name = key.split('/', 1)
+            path = os.path.join(self.root, property_id, name)
+            self._entries[(int(property_id), name)] = AssetEntry(path, size, mtime_ns, sha256)
+
+    def _save_manifest(self):
+        with self._lock:
+            manifest = {f'{pid}/{name}': [e.size, e.mtime_ns, e.sha256]
+                        for (pid, name), e in self._entries.items()}
+        os.makedirs(self.root, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, self._manifest_path())
+
+    def lookup(self, property_id, name):
+        """Return the AssetEntry of an asset, or None if it does not exist."""
+        if not NAME_PATTERN.match(name):
+            return None
+        key = (property_id, name)
+        path = os.path.join(self.root, str(property_id), name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            with self._lock:
+                self._entries.pop(key, None)
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry.size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns:
+            return entry
+
+        # New or replaced file: hash it once and remember the result
+        entry = AssetEntry(path, stat.st_size, stat.st_mtime_ns, _file_sha256(path))
+        with self._lock:
+            self._entries[key] = entry
+        self._save_manifest()
+        return entry
+
+
+def get_asset_index(app=None):
+    """Return the tour asset index of the given (or current) application."""
+    app = app or current_app
+    index = app.extensions.get('tour_asset_index')
+    if index is None:
+        index = app.extensions.setdefault('tour_asset_index', AssetIndex(
+            os.path.abspath(app.config.get('TOUR_ASSET_PATH', 'media/tours'))
+        ))
+    return index
+
+
+def etag_for(entry):
+    return entry.sha256
+
+
+def repr_digest(entry):
+    """Value of the Repr-Digest header (RFC 9530) for the full asset."""
+    raw = bytes.fromhex(entry.sha256)
+    return f'sha-256=:{base64.b64encode(raw).decode()}:'
+
+
+def resolve_ranges(byte_range, size, max_ranges):
+    """Turn a parsed Range header into sorted, merged (start, stop) pairs.
+
+    Returns None when the header should be ignored (the whole file is sent)
+    and an empty list when no range is satisfiable.
+    """
+    if byte_range is None or byte_range.units != 'bytes':
+        return None
+    if len(byte_range.ranges) > max_ranges:
+        return None
+    resolved = []
+    for begin, end in byte_range.ranges:
+        if begin < 0:
+            start, stop = max(size + begin, 0), size
+        else:
+            start, stop = begin, size if end is None else min(end, size)
+        if start < stop:
+            resolved.append((start, stop))
+    resolved.sort()
+    merged = []
+    for start, stop in resolved:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def iter_mapped(path, spans):
+    """Yield the bytes of each (start, stop) span from a memory map.
+
+    ``spans`` may also contain bytes objects, which are yielded as-is; this is
+    how multipart boundaries are interleaved with the file contents.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            for span in spans:
+                if isinstance(span, bytes):
+                    yield span
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for span in spans:
+                if isinstance(span, bytes):
+                    yield span
+                    continue
+                start, stop = span
+                for offset in range(start, stop, CHUNK_SIZE):
+                    yield mapped[offset:min(offset + CHUNK_SIZE, stop)]
+
+
+def multipart_body(path, ranges, size, content_type, boundary):
+    """Build the multipart/byteranges body and its exact length."""
+    parts, length = [], 0
+    for start, stop in ranges:
+        header = (f'\r\n--{boundary}\r\n'
+                  f'Content-Type: {content_type}\r\n'
+                  f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode()
+        parts.extend([header, (start, stop)])
+        length += len(header) + stop - start
+    closing = f'\r\n--{boundary}--\r\n'.encode()
+    parts.append(closing)
+    length += len(closing)
+    return iter_mapped(path, parts), length
+
+
+def file_body(environ, path, start, stop):
+    """Body for one contiguous span, sent by the server's file wrapper if it has one.
+
+    The file is positioned at ``start``; servers such as gunicorn send from the
+    current offset using ``sendfile``, and PEP 3333 requires servers to stop
+    at Content-Length, which bounds the span.
+    """
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper is None or stop == start:
+        return iter_mapped(path, [(start, stop)])
+    f = open(path, 'rb')
+    f.seek(start)
+    return file_wrapper(f, CHUNK_SIZE)
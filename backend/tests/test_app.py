@@ -6,16 +6,25 @@ from flask_cors import CORS
 from models.property import Property, db
 from app import app as real_app  # Import the real app
 from routes.property_routes import property_bp
+from routes.image_routes import image_bp
+from routes.asset_routes import asset_bp
+from routes.metrics_routes import metrics_bp
+from routes.saved_search_routes import saved_search_bp
+from services.query_log import assert_max_queries, init_query_log
+from services.sharding import init_sharding
 from logging.handlers import RotatingFileHandler
 
 @pytest.fixture
-def app():
+def app(tmp_path):
     """Create application for the tests."""
     app = Flask(__name__)
     app.config.update({
         'TESTING': True,
-        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
         'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'IMAGE_STORAGE_PATH': str(tmp_path / 'images'),
+        'TOUR_ASSET_PATH': str(tmp_path / 'tours'),
+        'SIMILARITY_INDEX_PATH': str(tmp_path / 'similarity'),
         'RATELIMIT_ENABLED': False,  # Disable rate limiting for tests
         'WTF_CSRF_ENABLED': False,   # Disable CSRF for tests
     })
@@ -46,11 +55,17 @@ def app():
 
     # Initialize extensions
     db.init_app(app)
+    init_query_log(app)
+    init_sharding(app)
     CORS(app)
     Talisman(app, force_https=False, content_security_policy=None)
 
     # Register blueprints
     app.register_blueprint(property_bp, url_prefix='/api')
+    app.register_blueprint(image_bp, url_prefix='/api')
+    app.register_blueprint(asset_bp, url_prefix='/api')
+    app.register_blueprint(metrics_bp, url_prefix='/api')
+    app.register_blueprint(saved_search_bp, url_prefix='/api')
 
     with app.app_context():
         db.create_all()
@@ -762,3 +777,1302 @@ def test_main_block_configuration(monkeypatch):
         # Restore original sys.argv and module name
         sys.argv = original_argv
         sys.modules['__main__'].__name__ = original_module_name
+
+def _add_property(**overrides):
+    """Insert a property with sensible defaults for the fields not given."""
+    fields = {
+        'title': 'Listing',
+        'description': 'A listing',
+        'price': 250000,
+        'address': '1 Main St',
+        'city': 'Test City',
+        'state': 'CA',
+        'zip_code': '12345',
+        'bedrooms': 3,
+        'bathrooms': 2,
+        'square_feet': 1500,
+        'property_type': 'house',
+        'listing_type': 'sale',
+    }
+    fields.update(overrides)
+    property = Property(**fields)
+    db.session.add(property)
+    db.session.commit()
+    return property
+
+def test_get_properties_filters(client):
+    """Test list filters narrow the results"""
+    _add_property(price=200000, property_type='condo')
+    _add_property(price=400000)
+    _add_property(price=2000, listing_type='rent', property_type='apartment')
+
+    response = client.get('/api/properties?listing_type=sale&min_price=300000')
+    assert response.status_code == 200
+    assert response.json['total'] == 1
+    assert response.json['properties'][0]['price'] == 400000
+
+    # Unparseable values are ignored like page/per_page
+    response = client.get('/api/properties?min_price=cheap')
+    assert response.json['total'] == 3
+
+    # The documented ``type`` parameter is an alias of property_type
+    response = client.get('/api/properties?type=condo')
+    assert response.json['total'] == 1
+    assert response.json['properties'][0]['property_type'] == 'condo'
+
+def test_get_properties_facets(client):
+    """Test facet counts for the current filter"""
+    _add_property(bedrooms=1, price=1800, listing_type='rent', property_type='apartment')
+    _add_property(bedrooms=2, price=2200, listing_type='rent', property_type='apartment')
+    _add_property(bedrooms=5, price=3000, listing_type='rent', property_type='house')
+    _add_property(bedrooms=3, price=450000)
+
+    response = client.get('/api/properties?listing_type=rent&facets=property_type,bedrooms,price,listing_type')
+    assert response.status_code == 200
+    facets = response.json['facets']
+    assert facets['property_type'] == {'apartment': 2, 'house': 1}
+    assert facets['bedrooms'] == {'1': 1, '2': 1, '4+': 1}
+    assert facets['price'] == {'1000-2500': 2, '2500-5000': 1}
+    assert facets['listing_type'] == {'rent': 3}
+
+def test_get_properties_facets_invalidated_on_write(client):
+    """Test cached facet counts are refreshed after a write"""
+    _add_property(property_type='condo')
+    response = client.get('/api/properties?facets=property_type')
+    assert response.json['facets']['property_type'] == {'condo': 1}
+
+    client.post('/api/properties', json={
+        'title': 'New', 'description': 'New', 'price': 100000, 'address': '2 Main St',
+        'city': 'Test City', 'state': 'CA', 'zip_code': '12345', 'property_type': 'house'
+    })
+    response = client.get('/api/properties?facets=property_type')
+    assert response.json['facets']['property_type'] == {'condo': 1, 'house': 1}
+
+def test_get_properties_unknown_facet(client):
+    """Test unknown facets are rejected"""
+    response = client.get('/api/properties?facets=property_type,color')
+    assert response.status_code == 400
+    assert response.json['unknown_facets'] == ['color']
+
+def _png_bytes(width=800, height=600):
+    """Return an in-memory PNG image."""
+    import io
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 30, 30)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+def test_upload_property_images(client, app, test_property):
+    """Test image upload, deduplication, thumbnailing and serving"""
+    import io
+    from services.images import get_image_store
+    png = _png_bytes()
+
+    response = client.post(f'/api/properties/{test_property.id}/images', data={
+        'images': [(io.BytesIO(png), 'front.png'), (io.BytesIO(png), 'copy.png')]
+    }, content_type='multipart/form-data')
+    assert response.status_code == 201
+    images = response.json
+    assert len(images) == 2
+    assert images[0]['id'] == images[1]['id']
+    assert images[0]['width'] == 800
+
+    store = get_image_store()
+    try:
+        store.wait(images[0]['content_hash'], timeout=30)
+    finally:
+        store.shutdown()
+
+    response = client.get(images[0]['variants']['320'])
+    assert response.status_code == 200
+    assert response.mimetype == 'image/webp'
+    assert 'immutable' in response.headers['Cache-Control']
+    etag = response.headers['ETag']
+    response.close()
+
+    response = client.get(images[0]['variants']['320'], headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    listing = client.get(f'/api/properties/{test_property.id}').json
+    assert listing['images'] == [images[0]['variants']['1280']]
+    assert listing['images'][0] == f"http://localhost/api/images/{images[0]['content_hash']}/1280.webp"
+
+def test_upload_property_images_invalid(client, test_property):
+    """Test non-image uploads are rejected"""
+    import io
+    response = client.post(f'/api/properties/{test_property.id}/images', data={
+        'images': [(io.BytesIO(b'not an image'), 'notes.txt')]
+    }, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert response.json['error'] == 'Unsupported image'
+
+    response = client.post(f'/api/properties/{test_property.id}/images', data={},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert response.json['missing_fields'] == ['images']
+
+def test_delete_property_image(client, test_property):
+    """Test an image is removed from its listing only"""
+    import io
+    from services.images import get_image_store
+
+    response = client.post(f'/api/properties/{test_property.id}/images', data={
+        'images': [(io.BytesIO(_png_bytes()), 'front.png')]
+    }, content_type='multipart/form-data')
+    image_id = response.json[0]['id']
+    get_image_store().shutdown()
+
+    assert client.delete(f'/api/properties/{test_property.id + 1}/images/{image_id}').status_code == 404
+    assert client.delete(f'/api/properties/{test_property.id}/images/{image_id}').status_code == 204
+    assert client.get(f'/api/properties/{test_property.id}/images').json == []
+    assert client.delete(f'/api/properties/{test_property.id}/images/{image_id}').status_code == 404
+
+def test_sharded_images(sharded_app, client):
+    """Test images of a listing on a shard are deleted there and served while resizing"""
+    import io
+    from services.images import get_image_store, image_directory
+
+    listing = _create_listing(client, 'CA', 300000)
+    response = client.post(f"/api/properties/{listing['id']}/images", data={
+        'images': [(io.BytesIO(_png_bytes()), 'front.png')]
+    }, content_type='multipart/form-data')
+    image = response.json[0]
+    store = get_image_store()
+    store.shutdown()
+
+    # A variant not written yet falls back to the original, uncached
+    os.remove(os.path.join(image_directory(store.root, image['content_hash']), '320.webp'))
+    response = client.get(image['variants']['320'])
+    assert response.status_code == 200 and response.mimetype == 'image/png'
+    assert 'no-cache' in response.headers['Cache-Control']
+    response.close()
+
+    assert client.delete(f"/api/properties/{listing['id']}/images/{image['id']}").status_code == 204
+    assert client.get(f"/api/properties/{listing['id']}/images").json == []
+
+@pytest.fixture
+def tour_asset(app):
+    """Write a 1000-byte tour asset for property 1."""
+    directory = os.path.join(app.config['TOUR_ASSET_PATH'], '1')
+    os.makedirs(directory)
+    content = bytes(range(256)) * 3 + bytes(232)
+    with open(os.path.join(directory, 'pano.jpg'), 'wb') as f:
+        f.write(content)
+    return content
+
+def test_tour_asset_full_and_conditional(client, tour_asset):
+    """Test full asset responses carry validators and honour If-None-Match"""
+    response = client.get('/api/properties/1/assets/pano.jpg')
+    assert response.status_code == 200
+    assert response.data == tour_asset
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.mimetype == 'image/jpeg'
+    etag = response.headers['ETag']
+
+    response = client.get('/api/properties/1/assets/pano.jpg', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    assert client.get('/api/properties/1/assets/missing.jpg').status_code == 404
+    assert client.get('/api/properties/2/assets/pano.jpg').status_code == 404
+
+def test_tour_asset_ranges(client, tour_asset):
+    """Test single, suffix, multi and unsatisfiable ranges"""
+    url = '/api/properties/1/assets/pano.jpg'
+    response = client.get(url, headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.data == tour_asset[10:20]
+    assert response.headers['Content-Range'] == 'bytes 10-19/1000'
+
+    response = client.get(url, headers={'Range': 'bytes=-100'})
+    assert response.status_code == 206
+    assert response.data == tour_asset[900:]
+
+    response = client.get(url, headers={'Range': 'bytes=0-4,500-504'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    assert int(response.headers['Content-Length']) == len(response.data)
+    assert b'Content-Range: bytes 0-4/1000' in response.data
+    assert b'Content-Range: bytes 500-504/1000' in response.data
+    assert tour_asset[500:505] in response.data
+
+    response = client.get(url, headers={'Range': 'bytes=5000-6000'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */1000'
+
+    # A stale If-Range validator falls back to the full asset
+    response = client.get(url, headers={'Range': 'bytes=10-19', 'If-Range': '"outdated"'})
+    assert response.status_code == 200
+    assert response.data == tour_asset
+
+def test_similar_properties(client):
+    """Test similar listings are ranked by features and location"""
+    target = _add_property(price=500000, bedrooms=3, latitude=25.77, longitude=-80.13)
+    near = _add_property(price=510000, bedrooms=3, latitude=25.78, longitude=-80.14)
+    _add_property(price=520000, bedrooms=3, latitude=40.71, longitude=-74.00)
+    _add_property(price=2500000, bedrooms=7, latitude=25.76, longitude=-80.12)
+    _add_property(price=505000, bedrooms=3, latitude=25.77, longitude=-80.13, listing_type='rent')
+
+    response = client.get(f'/api/properties/{target.id}/similar?k=2')
+    assert response.status_code == 200
+    ids = [p['id'] for p in response.json['properties']]
+    assert ids[0] == near.id
+    assert target.id not in ids
+    assert all(p['listing_type'] == 'sale' for p in response.json['properties'])
+
+    assert client.get('/api/properties/999/similar').status_code == 404
+
+def test_similar_properties_follow_writes(client):
+    """Test the index reflects listings created and deleted after it was built"""
+    target = _add_property(price=500000, latitude=25.77, longitude=-80.13)
+    _add_property(price=900000, latitude=25.90, longitude=-80.30)
+    client.get(f'/api/properties/{target.id}/similar')
+
+    twin = client.post('/api/properties', json={
+        'title': 'Twin', 'description': 'Twin', 'price': 500000, 'address': '3 Main St',
+        'city': 'Test City', 'state': 'CA', 'zip_code': '12345', 'bedrooms': 3,
+        'bathrooms': 2, 'square_feet': 1500, 'property_type': 'house',
+        'listing_type': 'sale', 'latitude': 25.77, 'longitude': -80.13
+    }).json
+    response = client.get(f'/api/properties/{target.id}/similar?k=1')
+    assert [p['id'] for p in response.json['properties']] == [twin['id']]
+
+    client.delete(f"/api/properties/{twin['id']}")
+    response = client.get(f'/api/properties/{target.id}/similar?k=1')
+    assert twin['id'] not in [p['id'] for p in response.json['properties']]
+
+def test_autocomplete(client):
+    """Test suggestions are ranked by listing count across fields"""
+    _add_property(city='Miami', state='FL', zip_code='33101', address='1 Ocean Dr')
+    _add_property(city='Miami', state='FL', zip_code='33139', address='2 Ocean Dr')
+    _add_property(city='Miami Beach', state='FL', zip_code='33139', address='3 Collins Ave')
+    _add_property(city='Orlando', state='FL', zip_code='32801', address='4 Main St')
+
+    response = client.get('/api/autocomplete?q=mia')
+    assert response.status_code == 200
+    suggestions = response.json['suggestions']
+    assert suggestions[0] == {'type': 'city', 'value': 'Miami, FL', 'count': 2}
+    assert suggestions[1] == {'type': 'city', 'value': 'Miami Beach, FL', 'count': 1}
+
+    response = client.get('/api/autocomplete?q=331&fields=zip_code')
+    assert [s['value'] for s in response.json['suggestions']] == ['33139', '33101']
+
+    response = client.get('/api/autocomplete?q=ocean&limit=1')
+    assert len(response.json['suggestions']) == 0
+    response = client.get('/api/autocomplete?q=2 ocean')
+    assert response.json['suggestions'][0]['value'] == '2 Ocean Dr, Miami, FL'
+
+def test_autocomplete_follows_writes(client):
+    """Test the index is updated by creates, updates and deletes"""
+    property = _add_property(city='Tampa', state='FL')
+    assert client.get('/api/autocomplete?q=tam').json['suggestions'][0]['count'] == 1
+
+    client.post('/api/properties', json={
+        'title': 'New', 'description': 'New', 'price': 100000, 'address': '9 Bay St',
+        'city': 'Tampa', 'state': 'FL', 'zip_code': '33602'
+    })
+    assert client.get('/api/autocomplete?q=tam').json['suggestions'][0]['count'] == 2
+
+    client.put(f'/api/properties/{property.id}', json={'city': 'Tallahassee'})
+    suggestions = client.get('/api/autocomplete?q=ta&fields=city').json['suggestions']
+    assert {s['value']: s['count'] for s in suggestions} == {'Tampa, FL': 1, 'Tallahassee, FL': 1}
+
+    client.delete(f'/api/properties/{property.id}')
+    assert client.get('/api/autocomplete?q=tal').json['suggestions'] == []
+
+    metrics = client.get('/api/metrics').json['autocomplete']
+    assert metrics['fields']['city']['entries'] == 1
+    assert metrics['bytes'] > 0
+
+def test_autocomplete_rebuilds_for_other_workers(app, client, monkeypatch):
+    """Test an old index picks up listings written elsewhere and survives being dropped mid-lookup"""
+    import time
+    from services.autocomplete import get_autocomplete
+
+    _add_property(city='Tampa', state='FL')
+    assert client.get('/api/autocomplete?q=tam').json['suggestions'][0]['count'] == 1
+
+    # Written by another worker: no change reaches this process's index
+    db.session.execute(Property.__table__.insert().values(_listing_payload(city='Tampa', state='FL')))
+    db.session.commit()
+    assert client.get('/api/autocomplete?q=tam').json['suggestions'][0]['count'] == 1
+    autocomplete = get_autocomplete(app)
+    autocomplete.max_age = 0.01
+    time.sleep(0.02)
+    client.get('/api/autocomplete?q=tam')
+    autocomplete.wait()
+    assert client.get('/api/autocomplete?q=tam').json['suggestions'][0]['count'] == 2
+
+    # A write drops the indexes between the build check and the lookup
+    ensure_built = autocomplete._ensure_built
+    calls = []
+
+    def dropped_after_check():
+        ensure_built()
+        if not calls:
+            autocomplete._indexes = None
+        calls.append(1)
+
+    monkeypatch.setattr(autocomplete, '_ensure_built', dropped_after_check)
+    autocomplete.max_age = 3600
+    response = client.get('/api/autocomplete?q=tam')
+    assert response.status_code == 200 and response.json['suggestions'][0]['count'] == 2
+    assert len(calls) == 2
+
+def test_engine_options_per_backend():
+    """Test engine profiles differ by backend"""
+    from services.database import InstrumentedQueuePool, engine_options
+
+    assert engine_options('sqlite:///:memory:', env={}) == {}
+
+    sqlite = engine_options('sqlite:///realtor.db', env={})
+    assert sqlite['poolclass'] is InstrumentedQueuePool
+    assert sqlite['max_overflow'] == 10
+    assert engine_options('sqlite:///realtor.db', env={'DB_MAX_OVERFLOW': '0'})['max_overflow'] == 0
+
+    postgres = engine_options('postgresql://user:pw@db/realtor', env={'DB_POOL_SIZE': '20'})
+    assert postgres['pool_size'] == 20
+    assert postgres['pool_pre_ping'] is True
+    assert postgres['max_overflow'] == 10
+
+def test_sqlite_engine_profile(tmp_path):
+    """Test SQLite pragmas are applied and pool statistics recorded"""
+    from flask_sqlalchemy import SQLAlchemy
+    from sqlalchemy import text
+    from services.database import engine_options, init_engine_profiles, pool_metrics
+
+    uri = f"sqlite:///{tmp_path / 'profile.db'}"
+    profile_app = Flask(__name__)
+    profile_app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    profile_app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(uri, env={})
+    profile_db = SQLAlchemy()
+    profile_db.init_app(profile_app)
+    init_engine_profiles(profile_app, profile_db, env={})
+
+    with profile_app.app_context():
+        assert profile_db.session.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert profile_db.session.execute(text('PRAGMA synchronous')).scalar() == 1
+        assert profile_db.session.execute(text('PRAGMA busy_timeout')).scalar() == 5000
+        metrics = pool_metrics(profile_db.engine)
+        assert metrics['pool'] == 'InstrumentedQueuePool'
+        assert metrics['checked_out'] == 1
+        assert metrics['checkouts'] >= 1
+        assert metrics['timeouts'] == 0
+
+def test_query_count_per_endpoint(client, test_property):
+    """Test endpoints stay within their query budget"""
+    with assert_max_queries(3):
+        client.get('/api/properties')
+    with assert_max_queries(2):
+        client.get(f'/api/properties/{test_property.id}')
+
+    with pytest.raises(AssertionError, match='expected at most 1'):
+        with assert_max_queries(1):
+            client.get('/api/properties')
+
+def test_slow_query_and_n_plus_one_logging(app, client, caplog):
+    """Test slow statements are logged with a plan and repeated shapes flagged"""
+    for i in range(3):
+        _add_property(title=f'Listing {i}')
+    app.config['SLOW_QUERY_MS'] = 0
+    app.config['N_PLUS_ONE_THRESHOLD'] = 3
+
+    @app.route('/n-plus-one')
+    def n_plus_one():
+        ids = [p.id for p in Property.query.all()]
+        db.session.expire_all()
+        return jsonify([db.session.get(Property, id_).title for id_ in ids])
+
+    client.get('/n-plus-one')
+    messages = [record.getMessage() for record in caplog.records]
+    assert any(m.startswith('Slow query') and 'plan=[' in m for m in messages)
+    assert any(m.startswith('Possible N+1: 3 executions of SELECT') for m in messages)
+
+def test_single_flight_shares_one_call():
+    """Test concurrent identical calls run once and share the result"""
+    import threading
+    import time
+    from services.single_flight import SingleFlight
+
+    flight = SingleFlight(timeout=5)
+    release = threading.Event()
+    executions = []
+
+    def fetch():
+        executions.append(1)
+        release.wait(5)
+        return 'listing'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('detail', 1, fetch)))
+               for _ in range(8)]
+    threads[0].start()
+    while flight.in_flight() == 0:
+        time.sleep(0.001)
+    for thread in threads[1:]:
+        thread.start()
+    while flight.waiting('detail', 1) < 7:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == ['listing'] * 8
+    assert len(executions) == 1
+    stats = flight.metrics()['groups']['detail']
+    assert stats['calls'] == 8 and stats['executions'] == 1 and stats['shared'] == 7
+    assert stats['coalescing_ratio'] == 7 / 8
+    assert flight.in_flight() == 0
+
+def test_single_flight_errors_and_timeouts():
+    """Test waiters see the leader's error and give up after the timeout"""
+    import threading
+    import time
+    from services.single_flight import SingleFlight, SingleFlightTimeout
+
+    flight = SingleFlight(timeout=0.05)
+    release = threading.Event()
+
+    def failing():
+        release.wait(5)
+        raise ValueError('database unavailable')
+
+    outcomes = []
+    def call():
+        try:
+            flight.do('list', 'key', failing)
+        except Exception as e:
+            outcomes.append(type(e))
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    while flight.in_flight() == 0:
+        time.sleep(0.001)
+    call()  # Waits 50 ms, then gives up
+    assert outcomes == [SingleFlightTimeout]
+
+    flight.timeout = 5
+    waiter = threading.Thread(target=call)
+    waiter.start()
+    while flight.waiting('list', 'key') < 1:
+        time.sleep(0.001)
+    release.set()
+    leader.join()
+    waiter.join()
+    assert sorted(outcomes, key=lambda e: e.__name__) == [SingleFlightTimeout, ValueError, ValueError]
+
+    stats = flight.metrics()['groups']['list']
+    assert stats['timeouts'] == 1 and stats['errors'] == 1 and stats['shared'] == 1
+    # Nothing is cached once the call is over
+    assert flight.do('list', 'key', lambda: 'fresh') == 'fresh'
+
+def test_coalesced_reads_see_writes(client, test_property):
+    """Test coalesced detail reads return fresh data and report metrics"""
+    client.get(f'/api/properties/{test_property.id}')
+    client.put(f'/api/properties/{test_property.id}', json={'price': 275000.0})
+    response = client.get(f'/api/properties/{test_property.id}')
+    assert response.status_code == 200
+    assert response.get_json()['price'] == 275000.0
+
+    metrics = client.get('/api/metrics').get_json()['single_flight']
+    assert metrics['in_flight'] == 0
+    assert metrics['groups']['detail']['executions'] == 2
+
+def test_search_matcher_against_brute_force():
+    """Test the indexed matcher agrees with checking every search"""
+    import random
+    from services.filters import matches_filters
+    from services.saved_searches import SearchMatcher
+
+    rng = random.Random(7)
+    cities = ['Miami', 'Austin', 'Denver']
+    searches = {}
+    for search_id in range(500):
+        criteria = {}
+        if rng.random() < 0.3:
+            criteria['city'] = rng.choice(cities)
+        if rng.random() < 0.2:
+            criteria['listing_type'] = rng.choice(['sale', 'rent'])
+        if rng.random() < 0.5:
+            criteria['min_price'] = rng.randrange(0, 900000, 50000)
+        if rng.random() < 0.5:
+            criteria['max_price'] = rng.randrange(100000, 1000000, 50000)
+        if rng.random() < 0.3:
+            criteria['min_square_feet'] = rng.randrange(500, 3000, 250)
+        if not criteria:
+            criteria['min_bedrooms'] = rng.randrange(1, 5)
+        searches[search_id] = criteria
+
+    matcher = SearchMatcher()
+    for search_id, criteria in searches.items():
+        matcher.add(search_id, criteria)
+    for search_id in range(0, 500, 7):
+        matcher.remove(search_id)
+        del searches[search_id]
+
+    for _ in range(200):
+        listing = {
+            'city': rng.choice(cities),
+            'listing_type': rng.choice(['sale', 'rent']),
+            'price': rng.randrange(0, 1000000, 25000),
+            'square_feet': rng.choice([None, rng.randrange(400, 4000)]),
+            'bedrooms': rng.randrange(0, 6),
+        }
+        expected = sorted(i for i, criteria in searches.items() if matches_filters(criteria, listing))
+        assert matcher.match(listing) == expected
+
+def test_saved_search_alerts(app, client):
+    """Test new and repriced listings alert the searches they now match"""
+    from services.saved_searches import get_search_alerts
+
+    response = client.post('/api/saved-searches', json={
+        'email': 'buyer@example.com',
+        'name': 'Miami under 400k',
+        'criteria': {'city': 'Miami', 'max_price': 400000, 'min_bedrooms': 2}
+    })
+    assert response.status_code == 201
+    search_id = response.get_json()['id']
+    assert response.get_json()['criteria'] == {'city': 'Miami', 'max_price': 400000.0, 'min_bedrooms': 2}
+
+    match = _add_property(city='Miami', price=350000)
+    _add_property(city='Miami', price=450000, title='Too expensive')
+    _add_property(city='Austin', price=300000, title='Elsewhere')
+    pricey = db.session.query(Property).filter_by(title='Too expensive').one()
+    client.put(f'/api/properties/{pricey.id}', json={'price': 390000.0})
+    client.put(f'/api/properties/{pricey.id}', json={'price': 380000.0})
+    get_search_alerts(app).wait()
+
+    alerts = client.get(f'/api/saved-searches/{search_id}/alerts').get_json()['alerts']
+    assert [alert['property']['id'] for alert in alerts] == [pricey.id, match.id]
+
+    metrics = client.get('/api/metrics').get_json()['saved_searches']
+    assert metrics['searches'] == 1 and metrics['delivered'] == 2
+
+    listed = client.get('/api/saved-searches?email=buyer@example.com').get_json()
+    assert [search['id'] for search in listed] == [search_id]
+    assert client.delete(f'/api/saved-searches/{search_id}').status_code == 204
+    assert client.get(f'/api/saved-searches/{search_id}/alerts').status_code == 404
+
+def test_saved_search_invalid(client):
+    """Test saved searches with missing, unknown or invalid criteria are rejected"""
+    response = client.post('/api/saved-searches', json={'email': 'buyer@example.com'})
+    assert response.status_code == 400
+    assert response.get_json()['missing_fields'] == ['criteria']
+
+    response = client.post('/api/saved-searches', json={
+        'email': 'buyer@example.com', 'criteria': {'city': 'Miami', 'pool': True}
+    })
+    assert response.get_json()['unknown_criteria'] == ['pool']
+
+    response = client.post('/api/saved-searches', json={
+        'email': 'buyer@example.com', 'criteria': {'min_price': 'cheap'}
+    })
+    assert response.status_code == 400
+    assert response.get_json()['invalid_criteria'] == ['min_price']
+
+def test_price_history_encoding():
+    """Test delta encoding round-trips and downsampling keeps the endpoints"""
+    from models.price_history import decode_deltas, encode_deltas
+    from services.price_history import lttb
+
+    values = [0, 5, -3, 2 ** 40, 17, 17, -2 ** 33]
+    assert list(decode_deltas(encode_deltas(values))) == values
+    assert list(decode_deltas(encode_deltas(values[:3]) + encode_deltas(values[3:], values[2]))) == values
+
+    times = list(range(1000))
+    prices = [(t % 50) * 100 for t in times]
+    sampled_times, sampled_prices = lttb(times, prices, 100)
+    assert len(sampled_times) == 100
+    assert sampled_times[0] == 0 and sampled_times[-1] == 999
+    assert sampled_times == sorted(sampled_times)
+    assert lttb(times[:10], prices[:10], 100) == (times[:10], prices[:10])
+
+def test_price_history_and_drops(client):
+    """Test price changes are recorded and recent drops are found"""
+    from models.price_history import PriceHistory
+
+    reduced = _add_property(price=400000)
+    raised = _add_property(price=300000, title='Raised')
+    small = _add_property(price=500000, title='Small cut')
+
+    client.put(f'/api/properties/{reduced.id}', json={'price': 390000.0})
+    client.put(f'/api/properties/{reduced.id}', json={'price': 360000.0})
+    client.put(f'/api/properties/{reduced.id}', json={'title': 'Renamed'})
+    client.put(f'/api/properties/{raised.id}', json={'price': 320000.0})
+    client.put(f'/api/properties/{small.id}', json={'price': 490000.0})
+
+    history = client.get(f'/api/properties/{reduced.id}/price-history').get_json()
+    assert history['count'] == 3
+    assert history['prices'] == [400000.0, 390000.0, 360000.0]
+    assert history['timestamps'] == sorted(history['timestamps'])
+
+    sampled = client.get(f'/api/properties/{reduced.id}/price-history?points=2').get_json()
+    assert sampled['prices'] == [400000.0, 360000.0]
+
+    drops = client.get('/api/properties/price-drops?min_drop=5&days=7').get_json()['price_drops']
+    assert [(d['property']['id'], d['previous_price'], d['price'], d['drop_percent'])
+            for d in drops] == [(reduced.id, 400000.0, 360000.0, 10.0)]
+    drops = client.get('/api/properties/price-drops?min_drop=1').get_json()['price_drops']
+    assert [d['property']['id'] for d in drops] == [reduced.id, small.id]
+
+    assert client.delete(f'/api/properties/{reduced.id}').status_code == 204
+    assert client.get(f'/api/properties/{reduced.id}/price-history').status_code == 404
+    assert db.session.get(PriceHistory, reduced.id) is None
+
+def test_price_history_accepts_numeric_strings(client):
+    """Test a price sent as a string is still saved and recorded"""
+    listing = _add_property(price=250000)
+    response = client.put(f'/api/properties/{listing.id}', json={'price': '240000'})
+    assert response.status_code == 200
+    assert response.get_json()['price'] == 240000.0
+    assert client.get(f'/api/properties/{listing.id}/price-history').get_json()['prices'] == [250000.0, 240000.0]
+
+@pytest.fixture
+def sharded_app(app, tmp_path):
+    """Route listings to two SQLite shards: west (CA, WA) and east (everything else)."""
+    from services.sharding import get_shard_router
+
+    app.config['PROPERTY_SHARDS'] = (f"east=sqlite:///{tmp_path / 'east.db'};"
+                                     f"west=sqlite:///{tmp_path / 'west.db'}")
+    app.config['PROPERTY_SHARD_STATES'] = 'west=CA,WA;east=NY'
+    router = get_shard_router(app)
+    router.create_all()
+    yield app
+    for engine in router.engines.values():
+        engine.dispose()
+
+def _create_listing(client, state, price, **overrides):
+    data = {'title': f'{state} listing', 'description': 'A listing', 'price': price,
+            'address': '1 Main St', 'city': 'Test City', 'state': state, 'zip_code': '12345'}
+    data.update(overrides)
+    response = client.post('/api/properties', json=data)
+    assert response.status_code == 201
+    return response.get_json()
+
+def test_sharded_routing(sharded_app, client):
+    """Test creates, reads, updates and deletes go to the owning shard"""
+    from services.sharding import SHARD_ID_STRIDE, get_shard_router
+
+    router = get_shard_router(sharded_app)
+    # Scatter threads are shared by concurrent requests, not one per shard
+    assert router.max_workers == 32
+    west = _create_listing(client, 'CA', 500000)
+    east = _create_listing(client, 'TX', 300000)
+    assert router.shard_for_id(west['id']) == 'west'
+    assert router.shard_for_id(east['id']) == 'east'
+    # Nothing lands in the main database
+    assert Property.query.count() == 0
+
+    assert client.get(f"/api/properties/{west['id']}").get_json()['state'] == 'CA'
+    assert client.get(f"/api/properties/{west['id'] + SHARD_ID_STRIDE}").status_code == 404
+    assert client.get(f"/api/properties/{SHARD_ID_STRIDE - 1}").status_code == 404
+
+    response = client.put(f"/api/properties/{west['id']}", json={'price': 450000.0})
+    assert response.get_json()['price'] == 450000.0
+    response = client.put(f"/api/properties/{west['id']}", json={'state': 'NY'})
+    assert response.status_code == 400
+    history = client.get(f"/api/properties/{west['id']}/price-history").get_json()
+    assert history['prices'] == [500000.0, 450000.0]
+
+    assert client.delete(f"/api/properties/{east['id']}").status_code == 204
+    assert client.get(f"/api/properties/{east['id']}").status_code == 404
+
+def test_sharded_scatter_gather_pagination(sharded_app, client):
+    """Test list pages merged across shards match a single sorted listing"""
+    from services.sharding import get_shard_router
+
+    states = ['CA', 'NY', 'TX', 'WA', 'NY', 'CA', 'FL']
+    created = [_create_listing(client, states[i % len(states)], 100000 + i * 1000,
+                               listing_type='rent' if i % 3 else 'sale')
+               for i in range(23)]
+    expected = sorted(listing['id'] for listing in created)
+
+    seen = []
+    for page in range(1, 5):
+        body = client.get(f'/api/properties?page={page}&per_page=7').get_json()
+        assert body['total'] == 23 and body['total_pages'] == 4
+        assert body['has_next'] == (page < 4) and body['has_prev'] == (page > 1)
+        seen += [listing['id'] for listing in body['properties']]
+    assert seen == expected
+
+    body = client.get('/api/properties?state=CA&per_page=50&facets=listing_type').get_json()
+    in_ca = [listing for listing in created if listing['state'] == 'CA']
+    assert sorted(p['id'] for p in body['properties']) == sorted(listing['id'] for listing in in_ca)
+    assert body['facets']['listing_type'] == {
+        'sale': sum(listing['listing_type'] == 'sale' for listing in in_ca),
+        'rent': sum(listing['listing_type'] == 'rent' for listing in in_ca),
+    }
+
+    body = client.get('/api/properties?facets=listing_type').get_json()
+    assert sum(body['facets']['listing_type'].values()) == 23
+
+    by_price = sorted(created, key=lambda listing: (-listing['price'], listing['id']))
+    body = client.get('/api/properties?sort=price&order=desc&page=2&per_page=5').get_json()
+    assert [p['id'] for p in body['properties']] == [listing['id'] for listing in by_price[5:10]]
+
+    metrics = client.get('/api/metrics').get_json()['shards']
+    assert metrics['enabled'] and metrics['pruned_shards'] >= 1
+    assert set(metrics['shards']) == {'east', 'west'}
+    assert get_shard_router(sharded_app).names == ['east', 'west']
+
+def test_admission_sheds_low_priority_first():
+    """Test searches are shed under queueing delay while detail reads get through"""
+    import threading
+    import time
+    from services.admission import AdmissionController, Shed
+
+    controller = AdmissionController(initial_limit=4, min_limit=1, target_delay=0.01,
+                                     max_wait=1.0, low_share=0.5)
+    controller.acquire('search')
+    controller.acquire('search')
+    # Searches may only fill half the limit; detail reads use the rest
+    with pytest.raises(Shed):
+        controller.acquire('search')
+    controller.acquire('detail')
+    controller.acquire('detail')
+
+    # A detail read that has to queue reports the delay it waited
+    admitted = threading.Event()
+    waiter = threading.Thread(target=lambda: (controller.acquire('detail'), admitted.set()))
+    waiter.start()
+    time.sleep(0.2)
+    assert not admitted.is_set()
+    controller.release()
+    waiter.join()
+    assert controller.overloaded
+
+    # Overloaded: searches are refused at once even with capacity, the limit backs off
+    for _ in range(4):
+        controller.release()
+    assert controller.inflight == 0
+    assert controller.limit < 4
+    with pytest.raises(Shed):
+        controller.acquire('search')
+    controller.acquire('detail')
+    controller.release()
+
+    metrics = controller.metrics()
+    assert metrics['classes']['search']['shed'] == 2
+    assert metrics['classes']['detail'] == {'admitted': 4, 'queued': 1, 'shed': 0}
+
+def test_admission_limit_grows_when_used():
+    """Test the limit increases additively while it is being used"""
+    from services.admission import AdmissionController
+
+    controller = AdmissionController(initial_limit=4, max_limit=5)
+    for _ in range(50):
+        for _ in range(4):
+            controller.acquire('detail')
+        for _ in range(4):
+            controller.release()
+    assert controller.limit == 5
+
+def test_admission_recovers_after_spike(monkeypatch):
+    """Test searches are admitted again once a delay spike has passed, even if all were shed"""
+    import time
+    from services import admission
+    from services.admission import AdmissionController, Shed
+
+    monkeypatch.setattr(admission, 'DELAY_DECAY', 0.05)
+    controller = AdmissionController(initial_limit=4, target_delay=0.01)
+    with controller._cond:
+        controller._record_delay(1.0)
+    for _ in range(3):
+        with pytest.raises(Shed):
+            controller.acquire('search')
+
+    time.sleep(0.3)
+    assert not controller.overloaded
+    controller.acquire('search')
+    controller.release()
+    assert controller.metrics()['classes']['search'] == {'admitted': 1, 'queued': 0, 'shed': 3}
+
+def test_admission_middleware(app, client, test_property):
+    """Test shed requests get 503 with Retry-After while health checks pass"""
+    from services.admission import get_admission_controller, init_admission
+
+    app.config.update({'ADMISSION_INITIAL_LIMIT': 2, 'ADMISSION_MIN_LIMIT': 2,
+                       'ADMISSION_TARGET_DELAY_MS': 10, 'ADMISSION_MAX_WAIT_MS': 10})
+    init_admission(app)
+    controller = get_admission_controller(app)
+
+    assert client.get('/api/properties').status_code == 200
+    assert controller.inflight == 0
+
+    controller.acquire('search')
+    response = client.get('/api/properties')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'].isdigit()
+    assert client.get(f'/api/properties/{test_property.id}').status_code == 200
+
+    controller.acquire('detail')
+    assert client.get(f'/api/properties/{test_property.id}').status_code == 503
+    assert client.get('/health').status_code == 200
+    assert client.get('/api/metrics').get_json()['admission']['inflight'] == 2
+
+def _listing_payload(**overrides):
+    data = {'title': 'New listing', 'description': 'A listing', 'price': 300000,
+            'address': '1 Main St', 'city': 'Test City', 'state': 'CA', 'zip_code': '12345'}
+    data.update(overrides)
+    return data
+
+def test_idempotent_create_replays_response(client):
+    """Test retried creates with the same Idempotency-Key create one listing"""
+    headers = {'Idempotency-Key': 'retry-1'}
+    first = client.post('/api/properties', json=_listing_payload(), headers=headers)
+    assert first.status_code == 201
+    assert 'Idempotent-Replayed' not in first.headers
+
+    # Same request with the keys in another order is still the same request
+    retry = client.post('/api/properties', json=dict(reversed(list(_listing_payload().items()))),
+                        headers=headers)
+    assert retry.status_code == 201
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.get_json() == first.get_json()
+    assert Property.query.count() == 1
+
+    reused = client.post('/api/properties', json=_listing_payload(price=1), headers=headers)
+    assert reused.status_code == 422
+
+    assert client.post('/api/properties', json=_listing_payload(),
+                       headers={'Idempotency-Key': 'retry-2'}).status_code == 201
+    assert client.post('/api/properties', json=_listing_payload()).status_code == 201
+    assert Property.query.count() == 3
+
+def test_idempotent_create_concurrent_and_expired(app, client):
+    """Test duplicates of a running request wait for it, and claims expire"""
+    import threading
+    from services.idempotency import StoredResponse, get_idempotency_store, request_fingerprint
+
+    app.config['IDEMPOTENCY_WAIT_MS'] = 100
+    store = get_idempotency_store(app)
+    key = 'POST /api/properties slow'
+    with app.test_request_context('/api/properties', method='POST', json=_listing_payload()):
+        fingerprint = request_fingerprint()
+
+    # Another worker holds the key and has not answered yet
+    assert store.claim(key, fingerprint, 60) is None
+    assert store.claim(key, fingerprint, 60).status is None
+    response = client.post('/api/properties', json=_listing_payload(), headers={'Idempotency-Key': 'slow'})
+    assert response.status_code == 409
+
+    # It answers while the duplicate waits: the duplicate replays the answer
+    app.config['IDEMPOTENCY_WAIT_MS'] = 5000
+    def respond():
+        with app.app_context():
+            store.save(key, StoredResponse(fingerprint, 201, 'application/json', b'{"id": 42}'), 60)
+    answer = threading.Timer(0.1, respond)
+    answer.start()
+    response = client.post('/api/properties', json=_listing_payload(), headers={'Idempotency-Key': 'slow'})
+    answer.join()
+    assert response.status_code == 201 and response.get_json() == {'id': 42}
+    assert Property.query.count() == 0
+
+    # A claim whose request never finished expires
+    assert store.claim('POST /api/properties stale', fingerprint, 0) is None
+    assert store.claim('POST /api/properties stale', fingerprint, 60) is None
+
+def test_markers_columnar_payload(client):
+    """Test the JSON and binary marker payloads decode to the listings' markers"""
+    from services.markers import COORD_SCALE, decode_markers_binary
+
+    first = _add_property(latitude=25.77471, longitude=-80.13419, price=512345, property_type='condo')
+    _add_property(latitude=None, longitude=None)
+    second = _add_property(latitude=40.71281, longitude=-74.00602, price=2460, property_type=None)
+    third = _add_property(latitude=25.76, longitude=-80.19, price=899999, state='FL')
+
+    body = client.get('/api/properties/markers').get_json()
+    assert body['count'] == 3
+    ids, lats, prices = [], [], []
+    for i in range(body['count']):
+        ids.append((ids[-1] if ids else 0) + body['id'][i])
+        lats.append((lats[-1] if lats else 0) + body['lat'][i])
+        prices.append(body['price'][i] * body['price_unit'])
+    assert ids == [first.id, second.id, third.id]
+    assert [lat / COORD_SCALE for lat in lats] == [25.77471, 40.71281, 25.76]
+    assert prices == [512300, 2500, 900000]
+    assert [body['types'][t] for t in body['type']] == ['condo', None, 'house']
+
+    response = client.get('/api/properties/markers?format=binary')
+    assert response.mimetype == 'application/octet-stream'
+    decoded = decode_markers_binary(response.get_data())
+    assert decoded['id'].tolist() == ids
+    assert decoded['longitude'].tolist() == [-80.13419, -74.00602, -80.19]
+    assert decoded['price'].tolist() == prices
+    assert decoded['property_type'] == ['condo', None, 'house']
+
+    body = client.get('/api/properties/markers?state=FL').get_json()
+    assert body['count'] == 1 and body['id'] == [third.id]
+    assert decode_markers_binary(client.get('/api/properties/markers?format=binary&state=TX').get_data())['id'].size == 0
+    assert client.get('/api/properties/markers?format=xml').status_code == 400
+
+def test_markers_sharded(sharded_app, client):
+    """Test markers from every shard are merged in id order"""
+    created = [_create_listing(client, state, 100000, latitude=30.0 + i, longitude=-90.0)
+               for i, state in enumerate(['CA', 'NY', 'WA', 'TX'])]
+    body = client.get('/api/properties/markers').get_json()
+    ids = [sum(body['id'][:i + 1]) for i in range(body['count'])]
+    assert ids == sorted(listing['id'] for listing in created)
+    assert client.get('/api/properties/markers?state=WA').get_json()['count'] == 1
+
+@pytest.fixture
+def column_engine(app, tmp_path):
+    """Serve listing searches from the column engine."""
+    from services.column_engine import get_column_engine
+
+    app.config['COLUMN_ENGINE'] = True
+    app.config['COLUMN_ENGINE_PATH'] = str(tmp_path / 'columns')
+    return get_column_engine(app)
+
+def _page_ids(client, query):
+    response = client.get(f'/api/properties?{query}')
+    assert response.status_code == 200
+    return [listing['id'] for listing in response.get_json()['properties']], response.get_json()['total']
+
+def test_column_engine_matches_sql(app, client, column_engine):
+    """Test engine searches return the same pages as SQL once warm"""
+    import random
+    from services.filters import apply_filters, apply_sort, parse_filters, parse_sort
+    from werkzeug.datastructures import MultiDict
+
+    rng = random.Random(7)
+    for i in range(60):
+        _add_property(price=rng.choice([150000, 250000, 400000, 900000]),
+                      bedrooms=rng.choice([None, 1, 2, 3, 4]),
+                      square_feet=rng.choice([None, 800, 1500, 2500]),
+                      city=rng.choice(['Miami', 'Austin', 'Denver']),
+                      property_type=rng.choice(['house', 'condo', None]),
+                      listing_type=rng.choice(['sale', 'rent']))
+
+    # Cold: answered by SQL while the snapshot is built
+    assert _page_ids(client, 'per_page=5')[1] == 60
+    assert client.get('/api/metrics').get_json()['column_engine']['fallbacks'] == 1
+    column_engine.wait()
+
+    queries = ['per_page=7&page=2', 'city=Miami&sort=price', 'sort=price&order=desc&per_page=50',
+               'min_bedrooms=2&sort=bedrooms&page=3&per_page=4', 'property_type=condo&sort=square_feet',
+               'max_price=300000&listing_type=rent&sort=date_listed&order=desc', 'city=Nowhere',
+               'sort=square_feet&order=desc&page=20']
+    for query in queries:
+        args = MultiDict([pair.split('=') for pair in query.split('&')])
+        page = args.get('page', 1, type=int)
+        per_page = args.get('per_page', 12, type=int)
+        expected = apply_sort(apply_filters(Property.query, parse_filters(args)), parse_sort(args))
+        assert _page_ids(client, query) == (
+            [p.id for p in expected.offset((page - 1) * per_page).limit(per_page)], expected.count()), query
+
+    metrics = client.get('/api/metrics').get_json()['column_engine']
+    assert metrics['ready'] and metrics['rows'] == 60 and metrics['queries'] == len(queries)
+    assert client.get('/api/properties?sort=color').status_code == 400
+    assert client.get('/api/properties?sort=price&order=up').status_code == 400
+
+def test_column_engine_follows_change_log(app, client, column_engine):
+    """Test writes reach the engine through the change log and rebuilds prune it"""
+    from models.change_log import PropertyChangeLog
+
+    first = _add_property(price=100000, city='Miami')
+    second = _add_property(price=200000, city='Miami')
+    column_engine.build()
+    assert _page_ids(client, 'city=Miami&sort=price') == ([first.id, second.id], 2)
+
+    created = _create_listing(client, 'FL', 150000, city='Miami')
+    client.put(f'/api/properties/{second.id}', json={'price': 50000.0})
+    client.delete(f'/api/properties/{first.id}')
+    assert _page_ids(client, 'city=Miami&sort=price') == ([second.id, created['id']], 2)
+    assert _page_ids(client, 'city=Miami&max_price=120000') == ([second.id], 1)
+    assert client.get('/api/metrics').get_json()['column_engine']['overlay'] == 3
+
+    column_engine.max_changes = 2
+    client.put(f"/api/properties/{created['id']}", json={'city': 'Tampa'})
+    assert _page_ids(client, 'city=Miami') == ([second.id], 1)
+    column_engine.wait()
+    assert client.get('/api/metrics').get_json()['column_engine']['overlay'] == 0
+    assert _page_ids(client, 'city=Tampa') == ([created['id']], 1)
+
+    # Entries up to the first snapshot are pruned; later ones stay for workers still on it
+    column_engine.build()
+    assert PropertyChangeLog.query.count() == 0
+
+def test_column_engine_waits_for_skipped_log_entries(app, client, column_engine):
+    """Test a change logged with a lower seq but committed after a higher one is still applied"""
+    import time
+    from models.change_log import PropertyChangeLog
+
+    first = _add_property(price=100000, city='Miami')
+    column_engine.build()
+    late = _add_property(price=90000, city='Miami')
+    # Simulate a concurrent writer: seq 5 is visible before seq 3 commits
+    db.session.query(PropertyChangeLog).delete()
+    db.session.add(PropertyChangeLog(seq=5, property_id=first.id, changed_at=time.time()))
+    db.session.commit()
+    assert _page_ids(client, 'city=Miami&sort=price') == ([first.id], 1)
+    assert client.get('/api/metrics').get_json()['column_engine']['gaps'] >= 1
+
+    db.session.add(PropertyChangeLog(seq=3, property_id=late.id, changed_at=time.time()))
+    db.session.commit()
+    assert _page_ids(client, 'city=Miami&sort=price') == ([late.id, first.id], 2)
+    assert client.get('/api/metrics').get_json()['column_engine']['overlay'] == 2
+
+def test_group_commit_batches_and_isolates_failures(app):
+    """Test concurrent writes share commits and a failing write only fails its caller"""
+    import threading
+    from sqlalchemy.exc import IntegrityError
+    from services.group_commit import GroupCommitWriter
+
+    writer = GroupCommitWriter(app, window=0.05, max_batch=8)
+    results, errors = {}, {}
+
+    def write(i):
+        def apply(session):
+            # Listing 5 has no title, which fails the NOT NULL constraint on flush
+            property = Property(title=None if i == 5 else f'Listing {i}', description='A listing',
+                                price=100000 + i, address=f'{i} Main St', city='Test City',
+                                state='CA', zip_code='12345')
+            session.add(property)
+            return property
+        try:
+            results[i] = writer.submit(apply, lambda property: property.id)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert list(errors) == [5] and isinstance(errors[5], IntegrityError)
+    assert sorted(results) == [i for i in range(16) if i != 5]
+    assert sorted(p.title for p in Property.query) == sorted(f'Listing {i}' for i in results)
+    assert {p.id for p in Property.query} == set(results.values())
+
+    metrics = writer.metrics()
+    assert metrics['writes'] == 16 and metrics['failed'] == 1
+    assert metrics['batches'] < 16 and metrics['max_batch_size'] <= 8
+
+def test_group_commit_routes(app, client):
+    """Test creates and updates through the group-commit writer"""
+    app.config['GROUP_COMMIT'] = True
+
+    import io
+    from services.images import get_image_store
+
+    created = _create_listing(client, 'CA', 300000)
+    client.post(f"/api/properties/{created['id']}/images", data={
+        'images': [(io.BytesIO(_png_bytes()), 'front.png')]
+    }, content_type='multipart/form-data')
+    get_image_store().shutdown()
+    response = client.put(f"/api/properties/{created['id']}", json={'price': 280000.0})
+    assert response.status_code == 200 and response.get_json()['price'] == 280000.0
+    # Serialized in the writer thread, with the URLs the request would build
+    assert response.get_json()['images'][0].startswith('http://localhost/api/images/')
+    assert client.get(f"/api/properties/{created['id']}/price-history").get_json()['prices'] == [300000.0, 280000.0]
+
+    assert client.post('/api/properties', json=_listing_payload(color='blue')).status_code == 500
+    assert client.put(f"/api/properties/{created['id']}", json={'title': None}).status_code == 500
+    assert client.get(f"/api/properties/{created['id']}").get_json()['title'] == 'CA listing'
+
+    metrics = client.get('/api/metrics').get_json()['group_commit']
+    assert metrics['enabled'] and metrics['writes'] == 4 and metrics['failed'] == 2
+
+def test_group_commit_updates_leave_pool_to_writer(tmp_path):
+    """Test concurrent updates do not hold the connections the group-commit writer needs"""
+    import threading
+
+    small = Flask(__name__)
+    small.config.update({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'small.db'}",
+        'SQLALCHEMY_ENGINE_OPTIONS': {'pool_size': 2, 'max_overflow': 0, 'pool_timeout': 2},
+        'GROUP_COMMIT': True,
+        'GROUP_COMMIT_WINDOW_MS': 20,
+    })
+    db.init_app(small)
+    small.register_blueprint(property_bp, url_prefix='/api')
+    with small.app_context():
+        db.create_all()
+        ids = [_add_property(price=100000 + i).id for i in range(6)]
+        db.session.remove()
+
+    statuses = []
+
+    def update(id):
+        response = small.test_client().put(f'/api/properties/{id}', json={'price': 90000.0})
+        statuses.append(response.status_code)
+
+    threads = [threading.Thread(target=update, args=(id,)) for id in ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [200] * len(ids)
+    with small.app_context():
+        assert {p.price for p in Property.query} == {90000.0}
+
+def test_normalize_address_and_minhash():
+    """Test address formatting variants normalize alike and MinHash tracks description overlap"""
+    from services.dedupe import MinHasher, normalize_address
+
+    a = normalize_address({'address': '12 North Ocean Avenue, Apt. #4B', 'city': 'Saint Augustine',
+                           'state': 'Florida', 'zip_code': '32080-1234'})
+    b = normalize_address({'address': '12 N Ocean Ave Unit 4b', 'city': 'St. Augustine',
+                           'state': 'FL', 'zip_code': '32080'})
+    assert a == b == '12 n ocean ave unit 4b|st augustine|fl|32080'
+
+    hasher = MinHasher(num_perm=128, bands=16)
+    text = 'Bright corner unit with ocean views, a renovated kitchen, two balconies and a pool'
+    signatures = hasher.signatures([text, text.upper() + '!', text + ' and a garage',
+                                    'Quiet cabin in the woods near the lake'])
+    assert (signatures[0] == signatures[1]).all()
+    assert (signatures[0] == signatures[2]).mean() > 0.6
+    assert (signatures[0] == signatures[3]).mean() < 0.1
+
+DESCRIPTION = ('Spacious three bedroom home on a quiet cul-de-sac with an updated kitchen, '
+               'hardwood floors throughout, a fenced backyard and a two car garage close to schools')
+
+def test_duplicate_detection(app, client):
+    """Test duplicates are flagged on create, found in batches and clustered"""
+    original = _add_property(description=DESCRIPTION, address='12 Oak Street', zip_code='12345')
+    _add_property(description='Modern loft downtown with exposed brick', address='9 Elm St')
+    _add_property(description=DESCRIPTION, address='12 Oak Street', listing_type='rent')
+
+    # The first use builds the index; reading the clusters waits for it
+    response = client.get('/api/properties/duplicates')
+    assert response.status_code == 200
+    assert response.get_json()['clusters'] == []
+
+    relisted = client.post('/api/properties', json=_listing_payload(
+        title='Oak St home', description=DESCRIPTION.replace('schools', 'schools and parks'),
+        address='12 Oak St.', zip_code='12345-0001', listing_type='sale')).get_json()
+    assert [d['id'] for d in relisted['possible_duplicates']] == [original.id]
+    assert relisted['possible_duplicates'][0]['same_address']
+
+    # Same description at another address in the zip code still matches; other zip codes do not
+    rows = [
+        _listing_payload(description=DESCRIPTION, address='40 Pine Rd', listing_type='sale'),
+        _listing_payload(description=DESCRIPTION, address='40 Pine Road', listing_type='sale'),
+        _listing_payload(description=DESCRIPTION, address='40 Pine Rd', zip_code='99999', listing_type='sale'),
+    ]
+    results = client.post('/api/properties/duplicates/check', json={'properties': rows}).get_json()['results']
+    assert {d['id'] for d in results[0]['duplicates']} == {original.id, relisted['id']}
+    assert not any(d['same_address'] for d in results[0]['duplicates'])
+    assert results[1]['batch_duplicates'] == [0]
+    assert results[2] == {'duplicates': [], 'batch_duplicates': []}
+    assert client.post('/api/properties/duplicates/check', json={'properties': 'x'}).status_code == 400
+
+    response = client.get('/api/properties/duplicates').get_json()
+    assert response['clusters'] == [{'ids': [original.id, relisted['id']], 'size': 2}]
+
+    app.config['DEDUPE_ON_CREATE'] = 'reject'
+    payload = _listing_payload(description=DESCRIPTION, address='12 Oak St', listing_type='sale')
+    response = client.post('/api/properties', json=payload)
+    assert response.status_code == 409
+    assert {d['id'] for d in response.get_json()['duplicates']} == {original.id, relisted['id']}
+    assert client.post('/api/properties?allow_duplicate=true', json=payload).status_code == 201
+
+    client.delete(f"/api/properties/{relisted['id']}")
+    assert relisted['id'] not in client.get('/api/properties/duplicates').get_json()['clusters'][0]['ids']
+
+    # A copy written by another worker is only seen once this worker's index is rebuilt
+    import time
+    from services.dedupe import get_dedupe_index
+    other = db.session.execute(Property.__table__.insert().values(
+        _listing_payload(description=DESCRIPTION, address='12 Oak Street', listing_type='sale'))
+    ).inserted_primary_key[0]
+    db.session.commit()
+    index = get_dedupe_index(app)
+    assert other not in client.get('/api/properties/duplicates').get_json()['clusters'][0]['ids']
+    index.max_age = 0.01
+    time.sleep(0.02)
+    client.get('/api/properties/duplicates')
+    index.wait()
+    assert other in client.get('/api/properties/duplicates').get_json()['clusters'][0]['ids']
+
+def test_upgrade_schema_adds_missing_columns(tmp_path):
+    """Test a database created before latitude/longitude is upgraded in place"""
+    from sqlalchemy import create_engine, text
+    from services.database import upgrade_schema
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        columns = [c for c in Property.__table__.columns if c.name not in ('latitude', 'longitude')]
+        connection.execute(text('CREATE TABLE property (%s)' % ', '.join(
+            f"{c.name} {c.type.compile(dialect=engine.dialect)}" for c in columns)))
+        connection.execute(text("INSERT INTO property (id, title, description, price, address, city, state, zip_code) "
+                                "VALUES (1, 'Old', 'Old listing', 1, '1 Main St', 'City', 'CA', '12345')"))
+
+    assert sorted(upgrade_schema(engine, db.metadata)) == ['property.latitude', 'property.longitude']
+    assert upgrade_schema(engine, db.metadata) == []
+    with engine.connect() as connection:
+        assert connection.execute(text('SELECT title, latitude FROM property')).one() == ('Old', None)
+
+def test_write_overlay_and_background_build(app):
+    """Test overlays forget writes a snapshot contains and builds run one at a time"""
+    import threading
+    from services.snapshots import BackgroundBuild, WriteOverlay
+
+    overlay = WriteOverlay()
+    overlay.put(1, 'a', 10.0)
+    assert overlay.put(1, 'b', 20.0) == 'a'
+    assert overlay.put(2, None, 15.0) is None
+    assert overlay.copy() == ({1: 'b'}, {1, 2})
+    assert overlay.prune(16.0) == []
+    assert overlay.copy() == ({1: 'b'}, {1})
+    assert overlay.prune(25.0) == [(1, 'b')] and len(overlay) == 0
+
+    release, builds = threading.Event(), []
+    builder = BackgroundBuild('test index')
+    assert builder.start(app, lambda: (builds.append(1), release.wait(5)))
+    assert not builder.start(app, lambda: builds.append(2))
+    release.set()
+    builder.wait()
+    assert builds == [1] and not builder.running
+
+def test_snapshot_publish_keeps_concurrent_builds(tmp_path):
+    """Test publishing only removes versions older than the replaced snapshot"""
+    import numpy as np
+    from services.snapshots import publish_snapshot, read_meta
+
+    def write(version, built_at):
+        np.save(tmp_path / f'ids-{version}.npy', np.arange(3))
+        return {'version': version, 'built_at': built_at}
+
+    assert publish_snapshot(str(tmp_path), write('1000-1', 1.0))
+    assert publish_snapshot(str(tmp_path), write('2000-1', 2.0))
+    # Builds of other workers still writing their files
+    write('2500-2', 2.5)
+    slow = write('1500-3', 1.5)
+    assert publish_snapshot(str(tmp_path), write('3000-1', 3.0))
+    # The replaced snapshot and newer builds stay; only older versions go
+    assert sorted(p.name for p in tmp_path.glob('*.npy')) == [
+        'ids-2000-1.npy', 'ids-2500-2.npy', 'ids-3000-1.npy']
+
+    # A build that started earlier and finishes last does not replace the newer snapshot
+    assert not publish_snapshot(str(tmp_path), slow)
+    assert read_meta(str(tmp_path))['version'] == '3000-1'
+
+def test_sharded_indexes(sharded_app, client):
+    """Test similar homes, autocomplete, price drops and alerts read listings from the shards"""
+    from services.saved_searches import get_search_alerts
+
+    search_id = client.post('/api/saved-searches', json={
+        'email': 'buyer@example.com', 'criteria': {'city': 'Miami'}
+    }).get_json()['id']
+
+    target = _create_listing(client, 'CA', 500000, city='Miami',
+                             latitude=25.77, longitude=-80.13)
+    near = _create_listing(client, 'CA', 510000, city='Miami', latitude=25.78, longitude=-80.14)
+    east = _create_listing(client, 'NY', 505000, city='Miami', latitude=25.77, longitude=-80.13)
+    assert Property.query.count() == 0
+
+    ids = [p['id'] for p in client.get(f"/api/properties/{target['id']}/similar?k=2").get_json()['properties']]
+    assert sorted(ids) == sorted([near['id'], east['id']])
+
+    suggestions = client.get('/api/autocomplete?q=mia&fields=city').get_json()['suggestions']
+    assert [(s['value'], s['count']) for s in suggestions] == [('Miami, CA', 2), ('Miami, NY', 1)]
+
+    client.put(f"/api/properties/{east['id']}", json={'price': 400000.0})
+    drops = client.get('/api/properties/price-drops?min_drop=5').get_json()['price_drops']
+    assert [d['property']['id'] for d in drops] == [east['id']]
+
+    get_search_alerts(sharded_app).wait()
+    alerts = client.get(f'/api/saved-searches/{search_id}/alerts').get_json()['alerts']
+    assert sorted(a['property']['id'] for a in alerts) == sorted([target['id'], near['id'], east['id']])
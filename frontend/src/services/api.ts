@@ -9,6 +9,47 @@ import { Property } from '../types/property';
 
 const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:5000/api';
 
+/** Attempts of a create before its error is thrown, all with one Idempotency-Key */
+const CREATE_ATTEMPTS = 3;
+const CREATE_RETRY_DELAY_MS = 500;
+
+/**
+ * Generate a random (version 4) UUID for an Idempotency-Key.
+ * crypto.randomUUID only exists in secure contexts, which the Capacitor dev
+ * build served over http://<LAN IP> is not, so fall back to getRandomValues.
+ * @returns {string} A new UUID
+ */
+export const newIdempotencyKey = (): string => {
+  if (typeof crypto !== 'undefined' && typeof crypto.randomUUID === 'function') {
+    return crypto.randomUUID();
+  }
+  const bytes = new Uint8Array(16);
+  if (typeof crypto !== 'undefined' && typeof crypto.getRandomValues === 'function') {
+    crypto.getRandomValues(bytes);
+  } else {
+    for (let i = 0; i < bytes.length; i++) {
+      bytes[i] = Math.floor(Math.random() * 256);
+    }
+  }
+  bytes[6] = (bytes[6] & 0x0f) | 0x40;
+  bytes[8] = (bytes[8] & 0x3f) | 0x80;
+  const hex = Array.from(bytes, (byte) => byte.toString(16).padStart(2, '0')).join('');
+  return `${hex.slice(0, 8)}-${hex.slice(8, 12)}-${hex.slice(12, 16)}-${hex.slice(16, 20)}-${hex.slice(20)}`;
+};
+
+/**
+ * Map markers as parallel arrays, index i describing one listing
+ * @interface MapMarkers
+ */
+export interface MapMarkers {
+  ids: Float64Array;
+  latitudes: Float64Array;
+  longitudes: Float64Array;
+  /** Prices rounded to the server's price unit */
+  prices: Float64Array;
+  types: Array<string | null>;
+}
+
 /**
  * API service object containing all API endpoints
  */
@@ -47,15 +88,140 @@ const api = {
   },
 
   /**
-   * Create a new property listing
+   * Fetch the listings most similar to a property, nearest first
+   * @async
+   * @param {string} id - Property ID
+   * @param {number} [k=6] - Number of listings to return
+   * @returns {Promise<Property[]>} Array of similar property objects
+   * @throws {Error} If the property is not found or request fails
+   */
+  getSimilarProperties: async (id: string, k: number = 6): Promise<Property[]> => {
+    const response = await axios.get(`${API_URL}/properties/${id}/similar`, { params: { k } });
+    return response.data.properties;
+  },
+
+  /**
+   * Fetch the price history of a property for charting
+   * @async
+   * @param {string} id - Property ID
+   * @param {number} [points=100] - Maximum number of points
+   * @returns {Promise<{timestamps: number[], prices: number[]}>} Unix-second timestamps and prices
+   * @throws {Error} If the property is not found or request fails
+   */
+  getPriceHistory: async (
+    id: string,
+    points: number = 100
+  ): Promise<{ timestamps: number[]; prices: number[] }> => {
+    const response = await axios.get(`${API_URL}/properties/${id}/price-history`, { params: { points } });
+    return response.data;
+  },
+
+  /**
+   * Fetch map markers for every listing matching the filters, decoded from the
+   * packed binary columns of /properties/markers
+   * @async
+   * @param {Object} [filters] - Same filters as the list endpoint
+   * @returns {Promise<MapMarkers>} Parallel arrays of ids, coordinates, prices and types
+   * @throws {Error} If the request fails
+   */
+  getMarkers: async (filters?: Record<string, string | number>): Promise<MapMarkers> => {
+    const response = await axios.get(`${API_URL}/properties/markers`, {
+      params: { ...filters, format: 'binary' },
+      responseType: 'arraybuffer'
+    });
+    const buffer: ArrayBuffer = response.data;
+    const header = new DataView(buffer);
+    const count = header.getUint32(4, true);
+    const coordScale = header.getUint32(8, true);
+    const priceUnit = header.getUint32(12, true);
+    const namesLength = header.getUint32(16, true);
+    const names = new TextDecoder().decode(new Uint8Array(buffer, 20, namesLength)).replace(/\0+$/, '');
+    const types = count ? names.split('\n').map((name) => name || null) : [];
+
+    // Columns are 4-byte aligned after the header and names, so typed arrays view them directly
+    let offset = 20 + namesLength;
+    const column = <T>(Type: { new (b: ArrayBuffer, o: number, n: number): T; BYTES_PER_ELEMENT: number }): T => {
+      const values = new Type(buffer, offset, count);
+      offset += count * Type.BYTES_PER_ELEMENT;
+      return values;
+    };
+    const idDeltas = column(Uint32Array);
+    const latDeltas = column(Int32Array);
+    const lngDeltas = column(Int32Array);
+    const prices = column(Uint32Array);
+    const typeIds = column(Uint16Array);
+
+    const markers: MapMarkers = {
+      ids: new Float64Array(count),
+      latitudes: new Float64Array(count),
+      longitudes: new Float64Array(count),
+      prices: new Float64Array(count),
+      types: new Array(count)
+    };
+    let id = 0, lat = 0, lng = 0;
+    for (let i = 0; i < count; i++) {
+      id += idDeltas[i];
+      lat += latDeltas[i];
+      lng += lngDeltas[i];
+      markers.ids[i] = id;
+      markers.latitudes[i] = lat / coordScale;
+      markers.longitudes[i] = lng / coordScale;
+      markers.prices[i] = prices[i] * priceUnit;
+      markers.types[i] = types[typeIds[i]];
+    }
+    return markers;
+  },
+
+  /**
+   * Fetch search box suggestions for a city, zip code or address prefix
+   * @async
+   * @param {string} q - Text typed so far
+   * @param {number} [limit=8] - Maximum number of suggestions
+   * @returns {Promise<Array<{type: string, value: string, count: number}>>} Suggestions, most listed first
+   * @throws {Error} If the request fails
+   */
+  autocomplete: async (
+    q: string,
+    limit: number = 8
+  ): Promise<Array<{ type: string; value: string; count: number }>> => {
+    const response = await axios.get(`${API_URL}/autocomplete`, { params: { q, limit } });
+    return response.data.suggestions;
+  },
+
+  /**
+   * Create a new property listing. The request is retried after network
+   * errors, server errors and a 409 for a key still in progress, with the same
+   * Idempotency-Key, so a retry whose first attempt did reach the server
+   * replays its response instead of creating the listing twice. A 409 listing
+   * duplicates is final.
    * @async
    * @param {Omit<Property, 'id'>} property - Property data without ID
+   * @param {string} [idempotencyKey] - Key of this logical create, generated if omitted
    * @returns {Promise<Property>} Created property object
-   * @throws {Error} If validation fails or request fails
+   * @throws {Error} If validation fails or every attempt fails
    */
-  createProperty: async (property: Omit<Property, 'id'>): Promise<Property> => {
-    const response = await axios.post(`${API_URL}/properties`, property);
-    return response.data;
+  createProperty: async (
+    property: Omit<Property, 'id'>,
+    idempotencyKey: string = newIdempotencyKey()
+  ): Promise<Property> => {
+    for (let attempt = 1; ; attempt++) {
+      try {
+        const response = await axios.post(`${API_URL}/properties`, property, {
+          headers: { 'Idempotency-Key': idempotencyKey }
+        });
+        return response.data;
+      } catch (error) {
+        const response = axios.isAxiosError(error) ? error.response : undefined;
+        const status = response?.status;
+        // 409 also answers a create rejected as a duplicate, which carries the duplicates
+        const inProgress = status === 409 && !response?.data?.duplicates;
+        const retryable = axios.isAxiosError(error) && (status === undefined || status >= 500 || inProgress);
+        if (!retryable || attempt >= CREATE_ATTEMPTS) {
+          throw error;
+        }
+        await new Promise((resolve) => setTimeout(resolve, CREATE_RETRY_DELAY_MS * attempt));
+      }
+    }
   }
 };
 